@@ -0,0 +1,127 @@
+#!/usr/bin/python
+## Benchmark for backupController collection engines
+##
+## Runs a full backupSettings() against the sleeping stand-in collectors in
+## fakebin/ (serveradmin, system_profiler and cvlabel) once with the
+## "threads" engine and once with the "events" engine (see
+## collectionEngine), and reports the wall time of each. Every collector
+## sleeps for --latency seconds, so the events engine should approach a
+## small multiple of that regardless of how many commands are run. Results
+## are written as JSON.
+##
+## Usage: bench_engine.py [--latency=0.5] [--jobs=4] [--enginejobs=32]
+##          [--deadline=0] [--services=afp,dns,smb,...] [--tmpdir=/tmp]
+##          [--output=results.json]
+
+import getopt,json,os,shutil,sys,tempfile,time
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(benchDir,".."))
+import sabackup
+
+fakeBinDir = os.path.join(benchDir,"fakebin")
+
+def makeXsanConfigDir(dirPath):
+  '''Creates a minimal Xsan configuration directory at dirPath, whose
+  cvlabel is our stand-in'''
+  os.makedirs(os.path.join(dirPath,"config"))
+  os.makedirs(os.path.join(dirPath,"bin"))
+  os.symlink(os.path.join(fakeBinDir,"cvlabel"),os.path.join(dirPath,"bin","cvlabel"))
+  theFile = open(os.path.join(dirPath,"config","BenchVolume.cfg"),"w")
+  theFile.write("GlobalSuperUser Yes\n\n[Disk \"LUN0\"]\nStatus UP\n")
+  theFile.close()
+  theFile = open(os.path.join(dirPath,"config","fsnameservers"),"w")
+  theFile.write("127.0.0.1\n")
+  theFile.close()
+
+def runBackup(engine,backupPath,xsanConfigDir,services,jobs,engineJobs,deadline):
+  '''Performs a backup of services to backupPath using engine, returns
+  (seconds,controller)'''
+
+  controller = sabackup.backupController()
+  controller.echoLogs = False
+  controller.registerService(sabackup.saService().servicesMap.keys(),sabackup.saService)
+  controller.registerService("profile",sabackup.systemProfilerService)
+  controller.registerService("xsan",sabackup.xsanService)
+  controller.registeredServices["xsan"].xsanConfigDir = xsanConfigDir
+  controller.registeredServices["profile"].useCache = False
+  controller.useTimeStamps = True
+  controller.timeStamp = time.strftime("%Y%m%d%H%M%S")
+  controller.overWriteExistingFiles = False
+  controller.pruneBackups = False
+  controller.jobs = jobs
+  controller.engine = engine
+  controller.engineJobs = engineJobs
+  controller.deadline = deadline
+  controller.setServices(services)
+  controller.setBackupPath(backupPath)
+
+  startTime = time.time()
+  controller.backupSettings()
+  return time.time() - startTime,controller
+
+def main():
+  latency = 0.5
+  jobs = 4
+  engineJobs = 32
+  deadline = 0
+  services = ["afp","dns","smb","ftp","nfs","web","mail","dhcp","vpn",
+              "sharing","profile","xsan"]
+  tmpDir = None
+  outputPath = None
+
+  optlist,args = getopt.getopt(sys.argv[1:],"",["latency=","jobs=","enginejobs=",
+                                                  "deadline=","services=","tmpdir=",
+                                                  "output="])
+  for opt,arg in optlist:
+    if opt == "--latency":
+      latency = float(arg)
+    elif opt == "--jobs":
+      jobs = int(arg)
+    elif opt == "--enginejobs":
+      engineJobs = int(arg)
+    elif opt == "--deadline":
+      deadline = float(arg)
+    elif opt == "--services":
+      services = arg.split(",")
+    elif opt == "--tmpdir":
+      tmpDir = arg
+    elif opt == "--output":
+      outputPath = arg
+
+  for name in ("SERVERADMIN","PROFILER","CVLABEL"):
+    os.environ["FAKE_%s_LATENCY" % name] = str(latency)
+  sabackup.saService.serverAdminPath = os.path.join(fakeBinDir,"serveradmin")
+  sabackup.systemProfilerService.systemProfilerCMDPath = os.path.join(fakeBinDir,"system_profiler")
+
+  results = {"benchmark": "engine",
+              "latency": latency,
+              "jobs": jobs,
+              "engineJobs": engineJobs,
+              "deadline": deadline,
+              "services": services,
+            }
+  scratchDir = tempfile.mkdtemp(prefix="bench_engine_",dir=tmpDir)
+  try:
+    xsanConfigDir = os.path.join(scratchDir,"xsan")
+    makeXsanConfigDir(xsanConfigDir)
+    for engine in ("threads","events"):
+      backupPath = os.path.join(scratchDir,engine)
+      os.mkdir(backupPath)
+      seconds,controller = runBackup(engine,backupPath,xsanConfigDir,services,
+                                      jobs,engineJobs,deadline)
+      results["%sSeconds" % engine] = round(seconds,4)
+      results["%sFailedServices" % engine] = [theService.name for theService in controller.failedServices]
+      results["%sRunningServices" % engine] = controller.runningServices
+  finally:
+    shutil.rmtree(scratchDir,True)
+
+  output = json.dumps(results,indent=2,sort_keys=True)
+  if outputPath:
+    theFile = open(outputPath,"w")
+    theFile.write(output + "\n")
+    theFile.close()
+  print output
+
+if __name__ == "__main__":
+  main()
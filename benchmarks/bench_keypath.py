@@ -0,0 +1,128 @@
+#!/usr/bin/python
+## Microbenchmark for backupController.valueForKeyPath()
+##
+## Builds a controller with synthetic serveradmin, system profiler and Xsan
+## data, then times report style lookups (hosts x columns) in three modes:
+##   uncompiled  compiled keypaths are discarded before every lookup
+##   compiled    keypaths are compiled once, results are not memoized
+##   memoized    keypaths are compiled once and results are memoized
+## Results are written as JSON.
+##
+## Usage: bench_keypath.py [--hosts=200] [--rounds=5] [--output=results.json]
+
+import getopt,json,os,sys,time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import sabackup
+
+keyPaths = ["hostname",
+            "isServer",
+            "runningServices",
+            "afp.guestAccess",
+            "afp.maxConnections",
+            "afp.loggingAttributes.logOpenFork",
+            "profile.SPHardwareDataType.processorSummary",
+            "profile.SPHardwareDataType.serial_number",
+            "profile.SPHardwareDataType.physical_memory",
+            "profile.SPSoftwareDataType.os_version",
+            "profile.SPNetworkDataType.0.ip_address",
+            "xsan.Volumes.Vol1.FsBlockSize",
+            "xsan.Volumes.Vol1.cfg.FileLocks",
+            "xsan.Volumes.Vol1.StripeGroup.Data.Node",
+           ]
+
+def buildController():
+  '''Returns a backupController populated with synthetic data'''
+
+  theController = sabackup.backupController()
+  theController.echoLogs = False
+  theController.registerService(["afp"],sabackup.saService)
+  theController.registerService("profile",sabackup.systemProfilerService)
+  theController.registerService("xsan",sabackup.xsanService)
+  theController.info = {"hostname" : "server.example.com", "isServer" : True}
+  theController.runningServices = ["afp","xsan"]
+
+  services = theController.registeredServices
+  services["afp"].loadSettingsPlist({"configuration" : {"guestAccess" : False,
+                      "maxConnections" : -1,
+                      "loggingAttributes" : {"logOpenFork" : True}}})
+
+  profilePlist = []
+  for dataType in services["profile"].systemProfilerDataTypes:
+    profilePlist.append({"_dataType" : dataType, "_items" : [{"_name" : dataType}]})
+  profilePlist[0]["_items"] = [{"serial_number" : "XX0000", "physical_memory" : "8 GB",
+                                "number_processors" : 8, "current_processor_speed" : "2.8 GHz",
+                                "cpu_type" : "Quad-Core Intel Xeon"}]
+  for dataTypeDict in profilePlist:
+    if dataTypeDict["_dataType"] == "SPSoftwareDataType":
+      dataTypeDict["_items"] = [{"os_version" : "Mac OS X Server 10.6.8"}]
+    elif dataTypeDict["_dataType"] == "SPNetworkDataType":
+      dataTypeDict["_items"] = [{"ip_address" : ["10.0.0.1"]}]
+  services["profile"].plist = profilePlist
+  services["profile"].plistDidChange()
+
+  services["xsan"].plist = {"Volumes" : {"Vol1" : {
+                              "global" : {"FsBlockSize" : "16K", "FileLocks" : "Yes"},
+                              "StripeGroup" : {"Data" : {"Node" : ["LUN1","LUN2"]}}}}}
+  services["xsan"].plistDidChange()
+
+  for serviceObj in services.values():
+    serviceObj.echoLogs = False
+  return theController
+
+def runLookups(controllers,rounds,discardCompiled=False):
+  '''Queries each of our keyPaths on each controller, rounds times. Returns
+  the elapsed time in seconds'''
+
+  startTime = time.time()
+  for count in range(rounds):
+    for theController in controllers:
+      for keyPath in keyPaths:
+        if discardCompiled:
+          sabackup.baseService.compiledKeyPaths.clear()
+        try:
+          theController.valueForKeyPath(keyPath)
+        except Exception:
+          pass
+  return time.time() - startTime
+
+def main():
+  numHosts = 200
+  rounds = 5
+  outputPath = None
+
+  optlist,args = getopt.getopt(sys.argv[1:],"",["hosts=","rounds=","output="])
+  for opt,arg in optlist:
+    if opt == "--hosts":
+      numHosts = int(arg)
+    elif opt == "--rounds":
+      rounds = int(arg)
+    elif opt == "--output":
+      outputPath = arg
+
+  controllers = [buildController() for count in range(numHosts)]
+  numLookups = numHosts * rounds * len(keyPaths)
+
+  results = {"benchmark" : "keypath",
+              "hosts" : numHosts,
+              "rounds" : rounds,
+              "keyPaths" : len(keyPaths),
+              "lookups" : numLookups}
+
+  for mode in ("uncompiled","compiled","memoized"):
+    for theController in controllers:
+      theController.memoizeKeyPaths = (mode == "memoized")
+      theController.keyPathValues = {}
+    elapsed = runLookups(controllers,rounds,discardCompiled=(mode == "uncompiled"))
+    results["%sSeconds" % mode] = round(elapsed,4)
+    results["%sMicrosecondsPerLookup" % mode] = round(elapsed * 1000000 / numLookups,2)
+
+  output = json.dumps(results,indent=2,sort_keys=True)
+  if outputPath:
+    theFile = open(outputPath,"w")
+    theFile.write(output + "\n")
+    theFile.close()
+  print output
+
+if __name__ == "__main__":
+  main()
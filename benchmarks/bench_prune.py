@@ -0,0 +1,89 @@
+#!/usr/bin/python
+## Benchmark for baseService.pruneBackupsFromDirectory()
+##
+## Populates a scratch directory with synthetic timestamped snapshot files
+## and times a single prune pass over it. Results are written as JSON.
+##
+## Usage: bench_prune.py [--files=100000] [--maxcopies=10] [--mincopies=1]
+##          [--maxage=30] [--tmpdir=/tmp] [--output=results.json]
+
+import getopt,json,os,shutil,sys,tempfile,time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import sabackup
+
+def populate(dirPath,baseName,numFiles):
+  '''Creates numFiles empty snapshot files, one per hour, oldest first,
+  plus a "latest" stub which must survive pruning.'''
+  now = time.time()
+  for count in range(numFiles):
+    fileTime = now - ((numFiles - count) * 3600)
+    fileName = "%s_%s.plist" % (baseName,time.strftime("%Y-%m-%d_%H%M%S",time.localtime(fileTime)))
+    filePath = os.path.join(dirPath,fileName)
+    open(filePath,"w").close()
+    os.utime(filePath,(fileTime,fileTime))
+  open(os.path.join(dirPath,"%s_latest.plist" % baseName),"w").close()
+
+def main():
+  numFiles = 100000
+  maxCopies = 10
+  minCopies = 1
+  maxAge = 30
+  tmpDir = None
+  outputPath = None
+
+  optlist,args = getopt.getopt(sys.argv[1:],"",["files=","maxcopies=","mincopies=",
+                                                  "maxage=","tmpdir=","output="])
+  for opt,arg in optlist:
+    if opt == "--files":
+      numFiles = int(arg)
+    elif opt == "--maxcopies":
+      maxCopies = int(arg)
+    elif opt == "--mincopies":
+      minCopies = int(arg)
+    elif opt == "--maxage":
+      maxAge = int(arg)
+    elif opt == "--tmpdir":
+      tmpDir = arg
+    elif opt == "--output":
+      outputPath = arg
+
+  scratchDir = tempfile.mkdtemp(prefix="bench_prune_",dir=tmpDir)
+  try:
+    theService = sabackup.baseService()
+    theService.name = "bench"
+    theService.baseName = "sa_bench"
+    theService.echoLogs = False
+
+    startTime = time.time()
+    populate(scratchDir,theService.baseName,numFiles)
+    populateTime = time.time() - startTime
+
+    startTime = time.time()
+    result = theService.pruneBackupsFromDirectory(dirPath=scratchDir,maxAge=maxAge,
+                                                  minCopies=minCopies,maxCopies=maxCopies,
+                                                  globString="%s_*" % theService.baseName)
+    pruneTime = time.time() - startTime
+    remaining = len(os.listdir(scratchDir))
+  finally:
+    shutil.rmtree(scratchDir,True)
+
+  results = {"benchmark": "prune",
+              "files": numFiles,
+              "maxCopies": maxCopies,
+              "minCopies": minCopies,
+              "maxAge": maxAge,
+              "result": result,
+              "remainingFiles": remaining,
+              "populateSeconds": round(populateTime,4),
+              "pruneSeconds": round(pruneTime,4),
+            }
+  output = json.dumps(results,indent=2,sort_keys=True)
+  if outputPath:
+    theFile = open(outputPath,"w")
+    theFile.write(output + "\n")
+    theFile.close()
+  print output
+
+if __name__ == "__main__":
+  main()
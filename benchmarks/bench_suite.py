@@ -0,0 +1,344 @@
+#!/usr/bin/python
+## Benchmark suite for sabackup
+##
+## Puts the stand-in serveradmin, system_profiler, cvlabel and hdiutil from
+## fakebin/ on the PATH, points sabackup's tool paths and xsanConfigDir at
+## them, and times:
+##   backup.threads   backupController.backupSettings(), "threads" engine
+##   backup.events    backupController.backupSettings(), "events" engine
+##   prune            baseService.pruneBackupsFromDirectory()
+##   summary          backupSummary.load() over a fleet of backup images
+##   parse.settings   batched 'serveradmin settings' output
+##   parse.profile    system_profiler data type output
+##   parse.cvlabel    'cvlabel -ls' output
+##   parse.xsancfg    Xsan volume.cfg files
+## Each benchmark is run --rounds times and its fastest and median rounds
+## are reported. Stand-in latency and payload size are configurable. Results
+## are written as JSON. With --compare, results are compared against those
+## of a previous run: benchmarks whose fastest round is slower by more than
+## --threshold (a fraction) are reported as regressions, and we exit 1.
+##
+## Usage: bench_suite.py [--latency=0.05] [--payload=100] [--luns=64]
+##          [--hosts=20] [--files=20000] [--disks=2000] [--rounds=3]
+##          [--only=backup.events,prune,...] [--tmpdir=/tmp]
+##          [--output=results.json] [--compare=previous.json] [--threshold=0.1]
+
+import getopt,json,os,plistlib,shutil,sys,tempfile,time
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0,os.path.join(benchDir,".."))
+sys.path.insert(0,benchDir)
+import sabackup
+import bench_engine,bench_prune,bench_xsancfg
+
+fakeBinDir = os.path.join(benchDir,"fakebin")
+backupServices = ["afp","dns","smb","ftp","nfs","web","mail","dhcp","vpn",
+                  "sharing","profile","xsan"]
+
+def useStandIns(scratchDir,latency,payload,luns):
+  '''Points sabackup at our stand-in tools, and configures them'''
+
+  os.environ["PATH"] = fakeBinDir + os.pathsep + os.environ.get("PATH","")
+  for name in ("SERVERADMIN","PROFILER","CVLABEL","HDIUTIL"):
+    os.environ["FAKE_%s_LATENCY" % name] = str(latency)
+  os.environ["FAKE_SERVERADMIN_PAYLOAD"] = str(payload)
+  os.environ["FAKE_PROFILER_PAYLOAD"] = str(payload)
+  os.environ["FAKE_CVLABEL_LUNS"] = str(luns)
+  os.environ["FAKE_HDIUTIL_MOUNTDIR"] = scratchDir
+
+  xsanConfigDir = os.path.join(scratchDir,"xsan")
+  bench_engine.makeXsanConfigDir(xsanConfigDir)
+
+  sabackup.saService.serverAdminPath = os.path.join(fakeBinDir,"serveradmin")
+  sabackup.odService.serveradmin = os.path.join(fakeBinDir,"serveradmin")
+  sabackup.systemProfilerService.systemProfilerCMDPath = os.path.join(fakeBinDir,"system_profiler")
+  sabackup.xsanService.xsanConfigDir = xsanConfigDir
+  sabackup.diskImage.hdiutilPath = os.path.join(fakeBinDir,"hdiutil")
+  sabackup.backupSummary.hdiutilPath = os.path.join(fakeBinDir,"hdiutil")
+  return xsanConfigDir
+
+def timeRounds(benchFunction,rounds):
+  '''Calls benchFunction, which returns the seconds taken by its timed
+  section, rounds times. Returns a result dictionary'''
+
+  times = []
+  for count in range(rounds):
+    times.append(benchFunction())
+  times.sort()
+  return {"rounds" : [round(seconds,4) for seconds in times],
+          "seconds" : round(times[0],4),
+          "median" : round(times[len(times) / 2],4)}
+
+def runCapture(argList):
+  '''Returns the output of one of our stand-ins'''
+  result = sabackup.runCommand(argList)
+  if not result.returncode == 0:
+    raise RuntimeError("%s failed: %s" % (argList[0],result.stderr))
+  return result.stdout
+
+def benchBackup(scratchDir,xsanConfigDir,engine):
+  '''Returns a function timing a full backup using engine'''
+  def runRound():
+    backupPath = tempfile.mkdtemp(prefix="backup_%s_" % engine,dir=scratchDir)
+    try:
+      seconds,controller = bench_engine.runBackup(engine,backupPath,xsanConfigDir,
+                                                    backupServices,4,32,0)
+      if controller.failedServices:
+        raise RuntimeError("Backup failed for: %s"
+                            % [theService.name for theService in controller.failedServices])
+    finally:
+      shutil.rmtree(backupPath,True)
+    return seconds
+  return runRound
+
+def benchPrune(scratchDir,numFiles):
+  '''Returns a function timing a prune of numFiles snapshots'''
+  def runRound():
+    dirPath = tempfile.mkdtemp(prefix="prune_",dir=scratchDir)
+    try:
+      theService = sabackup.baseService()
+      theService.name = "bench"
+      theService.baseName = "sa_bench"
+      theService.echoLogs = False
+      bench_prune.populate(dirPath,theService.baseName,numFiles)
+      startTime = time.time()
+      theService.pruneBackupsFromDirectory(dirPath=dirPath,maxAge=30,minCopies=1,
+                                            maxCopies=10,globString="sa_bench_*")
+      return time.time() - startTime
+    finally:
+      shutil.rmtree(dirPath,True)
+  return runRound
+
+def makeFleet(scratchDir,xsanConfigDir,numHosts):
+  '''Backs up once, then copies the backup as numHosts disk images, each
+  with its own hostname. Returns the fleet directory'''
+
+  templatePath = os.path.join(scratchDir,"template")
+  os.mkdir(templatePath)
+  seconds,controller = bench_engine.runBackup("events",templatePath,xsanConfigDir,
+                                                backupServices,4,32,0)
+  fleetPath = os.path.join(scratchDir,"fleet")
+  os.mkdir(fleetPath)
+  for count in range(numHosts):
+    imagePath = os.path.join(fleetPath,"host%03d.sparseimage" % count)
+    shutil.copytree(templatePath,imagePath,symlinks=True)
+    globalPath = os.path.join(imagePath,"sa_global.plist")
+    globalPlist = plistlib.readPlist(globalPath)
+    globalPlist["sabackup"]["hostname"] = "host%03d.example.com" % count
+    globalPlist["sabackup"]["shortname"] = "host%03d" % count
+    plistlib.writePlist(globalPlist,globalPath)
+  shutil.rmtree(templatePath,True)
+  return fleetPath
+
+def benchSummary(fleetPath,numHosts):
+  '''Returns a function timing backupSummary.load() over fleetPath'''
+  def runRound():
+    theSummary = sabackup.backupSummary()
+    theSummary.echoLogs = False
+    theSummary.useCache = False
+    theSummary.jobs = 4
+    theSummary.registerService(sabackup.saService().servicesMap.keys(),sabackup.saService)
+    theSummary.registerService("profile",sabackup.systemProfilerService)
+    theSummary.registerService("xsan",sabackup.xsanService)
+    startTime = time.time()
+    theSummary.load(fleetPath)
+    seconds = time.time() - startTime
+    if not len(theSummary.clientData) == numHosts:
+      raise RuntimeError("Summary loaded %s of %s hosts" % (len(theSummary.clientData),numHosts))
+    return seconds
+  return runRound
+
+def benchParseSettings():
+  '''Returns a function timing the parse of batched serveradmin settings'''
+  services = []
+  for name in backupServices:
+    theService = sabackup.saService(name=name)
+    if theService.displayName:
+      services.append(theService)
+  output = runCapture(services[0].settingsArgList(services))
+  def runRound():
+    chunk = []
+    for theService in services:
+      chunk.append(sabackup.saService(name=theService.name))
+      chunk[-1].echoLogs = False
+    result = sabackup.commandResult()
+    result.stdout = output
+    result.stdoutBytes = len(output)
+    startTime = time.time()
+    loadedServices = chunk[0]._settingsFetched(chunk,result)
+    seconds = time.time() - startTime
+    if not len(loadedServices) == len(chunk):
+      raise RuntimeError("Loaded %s of %s services" % (len(loadedServices),len(chunk)))
+    return seconds
+  return runRound
+
+def benchParseProfile():
+  '''Returns a function timing the parse of system_profiler output'''
+  theService = sabackup.systemProfilerService()
+  theService.echoLogs = False
+  outputs = []
+  for dataType in theService.systemProfilerDataTypes:
+    outputs.append((dataType,runCapture(theService.argListForDataType(dataType))))
+  def runRound():
+    startTime = time.time()
+    for dataType,output in outputs:
+      result = sabackup.commandResult()
+      result.stdout = output
+      result.stdoutBytes = len(output)
+      theService.dataTypeFromResult(dataType,result)
+    return time.time() - startTime
+  return runRound
+
+def benchParseCVLabel(luns):
+  '''Returns a function timing the parse of 'cvlabel -ls' output'''
+  theService = sabackup.xsanService()
+  theService.echoLogs = False
+  output = runCapture(theService.cvlabelArgList())
+  def runRound():
+    startTime = time.time()
+    parsedLUNs = [myLun for myLun in theService._parseCVLabelOutput(output.splitlines(True)) if myLun]
+    seconds = time.time() - startTime
+    if not len(parsedLUNs) == luns:
+      raise RuntimeError("Parsed %s of %s LUNs" % (len(parsedLUNs),luns))
+    return seconds
+  return runRound
+
+def benchParseXsanConfig(scratchDir,numDisks):
+  '''Returns a function timing the parse of a volume.cfg with numDisks'''
+  filePath = os.path.join(scratchDir,"BenchVolume.cfg")
+  bench_xsancfg.writeVolumeConfig(filePath,numDisks)
+  def runRound():
+    theService = sabackup.xsanService()
+    theService.echoLogs = False
+    startTime = time.time()
+    theService._loadXsanVolumeConfigFromFilePath(filePath)
+    return time.time() - startTime
+  return runRound
+
+def compareResults(results,previousResults,threshold):
+  '''Compares our benchmark results against previousResults, returns a
+  comparison dictionary and a list of regressed benchmark names'''
+
+  comparison = {}
+  regressions = []
+  previousBenchmarks = previousResults.get("benchmarks",{})
+  for name,result in sorted(results["benchmarks"].iteritems()):
+    if not name in previousBenchmarks:
+      continue
+    previousSeconds = previousBenchmarks[name]["seconds"]
+    if previousSeconds > 0:
+      ratio = result["seconds"] / previousSeconds
+    else:
+      ratio = 1.0
+    comparison[name] = {"previousSeconds" : previousSeconds,
+                        "ratio" : round(ratio,3),
+                        "regression" : ratio > 1 + threshold}
+    if comparison[name]["regression"]:
+      regressions.append(name)
+  return comparison,regressions
+
+def main():
+  latency = 0.05
+  payload = 100
+  luns = 64
+  numHosts = 20
+  numFiles = 20000
+  numDisks = 2000
+  rounds = 3
+  onlyBenchmarks = []
+  tmpDir = None
+  outputPath = None
+  comparePath = None
+  threshold = 0.1
+
+  optlist,args = getopt.getopt(sys.argv[1:],"",["latency=","payload=","luns=",
+                                                  "hosts=","files=","disks=",
+                                                  "rounds=","only=","tmpdir=",
+                                                  "output=","compare=","threshold="])
+  for opt,arg in optlist:
+    if opt == "--latency":
+      latency = float(arg)
+    elif opt == "--payload":
+      payload = int(arg)
+    elif opt == "--luns":
+      luns = int(arg)
+    elif opt == "--hosts":
+      numHosts = int(arg)
+    elif opt == "--files":
+      numFiles = int(arg)
+    elif opt == "--disks":
+      numDisks = int(arg)
+    elif opt == "--rounds":
+      rounds = int(arg)
+    elif opt == "--only":
+      onlyBenchmarks = arg.split(",")
+    elif opt == "--tmpdir":
+      tmpDir = arg
+    elif opt == "--output":
+      outputPath = arg
+    elif opt == "--compare":
+      comparePath = arg
+    elif opt == "--threshold":
+      threshold = float(arg)
+
+  results = {"benchmark": "suite",
+              "version": sabackup.version,
+              "build": sabackup.build,
+              "python": sys.version.split()[0],
+              "parameters": {"latency": latency,
+                              "payload": payload,
+                              "luns": luns,
+                              "hosts": numHosts,
+                              "files": numFiles,
+                              "disks": numDisks,
+                              "rounds": rounds},
+              "benchmarks": {},
+            }
+
+  scratchDir = tempfile.mkdtemp(prefix="bench_suite_",dir=tmpDir)
+  try:
+    xsanConfigDir = useStandIns(scratchDir,latency,payload,luns)
+    benchmarks = [("backup.threads",lambda: benchBackup(scratchDir,xsanConfigDir,"threads")),
+                  ("backup.events",lambda: benchBackup(scratchDir,xsanConfigDir,"events")),
+                  ("prune",lambda: benchPrune(scratchDir,numFiles)),
+                  ("summary",lambda: benchSummary(makeFleet(scratchDir,xsanConfigDir,numHosts),numHosts)),
+                  ("parse.settings",benchParseSettings),
+                  ("parse.profile",benchParseProfile),
+                  ("parse.cvlabel",lambda: benchParseCVLabel(luns)),
+                  ("parse.xsancfg",lambda: benchParseXsanConfig(scratchDir,numDisks)),
+                 ]
+    for name,setupFunction in benchmarks:
+      if onlyBenchmarks and not name in onlyBenchmarks:
+        continue
+      sys.stderr.write("Running %s...\n" % name)
+      results["benchmarks"][name] = timeRounds(setupFunction(),rounds)
+  finally:
+    shutil.rmtree(scratchDir,True)
+
+  regressions = []
+  if comparePath:
+    previousFH = open(comparePath)
+    previousResults = json.load(previousFH)
+    previousFH.close()
+    results["comparison"],regressions = compareResults(results,previousResults,threshold)
+    ## Timings are only comparable between runs with the same parameters
+    previousParameters = dict(previousResults.get("parameters",{}))
+    parameters = dict(results["parameters"])
+    previousParameters.pop("rounds",None)
+    parameters.pop("rounds",None)
+    results["parametersMatch"] = previousParameters == parameters
+    results["regressions"] = regressions
+
+  output = json.dumps(results,indent=2,sort_keys=True)
+  if outputPath:
+    theFile = open(outputPath,"w")
+    theFile.write(output + "\n")
+    theFile.close()
+  print output
+
+  if regressions:
+    return 1
+  return 0
+
+if __name__ == "__main__":
+  sys.exit(main())
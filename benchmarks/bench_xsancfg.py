@@ -0,0 +1,161 @@
+#!/usr/bin/python
+## Benchmark for xsanService volume.cfg parsing
+##
+## Writes synthetic Xsan volume.cfg files (global settings, stripe groups with
+## Node entries, and Disk/DiskType sections, with comments and blank lines
+## mixed in) and times xsanService._loadXsanVolumeConfigFromFilePath() 
+## against the previous line by line re.search() parser, which is kept below 
+## as a reference. Resulting Volumes trees are compared for equality.
+## Results are written as JSON.
+##
+## Usage: bench_xsancfg.py [--volumes=4] [--disks=20000] [--rounds=3] 
+##                         [--tmpdir=/tmp] [--output=results.json]
+
+import getopt,json,os,re,shutil,sys,tempfile,time
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),".."))
+import sabackup
+
+def writeVolumeConfig(filePath,numDisks):
+  '''Writes a synthetic volume.cfg with numDisks disks to filePath'''
+
+  theFile = open(filePath,"w")
+  theFile.write("# Globals\n\n")
+  for key,value in (("GlobalSuperUser","Yes"),("FileLocks","Yes"),
+                    ("FsBlockSize","16K"),("JournalSize","16M"),
+                    ("InodeCacheSize","32K"),("BufferCacheSize","64M")):
+    theFile.write("%s %s\n" % (key,value))
+  theFile.write("\n# Disk Types\n\n")
+  theFile.write("[DiskType \"MetadataDiskType\"]\nSectors 285212672\nSectorSize 512\n\n")
+  theFile.write("[DiskType \"DataDiskType\"]\nSectors 7812500000\nSectorSize 512\n\n")
+  theFile.write("# Disks\n\n")
+  for count in range(numDisks):
+    theFile.write("[Disk \"LUN%d\"]\nStatus UP\nType %s\n\n" 
+                  % (count,count < 2 and "MetadataDiskType" or "DataDiskType"))
+  theFile.write("# Stripe Groups\n\n")
+  theFile.write("[StripeGroup \"MetadataAndJournal\"]\nStatus Up\nMetadata Yes\n"
+                "Journal Yes\nExclusive Yes\nRead Enabled\nWrite Enabled\n"
+                "StripeBreadth 256K\nMultiPathMethod Rotate\n"
+                "Node \"LUN0\" 0\nNode \"LUN1\" 1\n\n")
+  for group in range(max(1,(numDisks - 2) / 64)):
+    theFile.write("[StripeGroup \"Data%d\"]\nStatus Up\nMetadata No\nJournal No\n"
+                  "StripeBreadth 256K\n" % group)
+    for count in range(2 + group * 64,min(numDisks,2 + (group + 1) * 64)):
+      theFile.write("Node \"LUN%d\" %d\n" % (count,count))
+    theFile.write("\n")
+  theFile.close()
+
+def legacyLoadVolumeConfig(theService,filePath):
+  '''The previous volume.cfg parser, for comparison'''
+
+  if not "Volumes" in theService.plist:
+    theService.plist["Volumes"] = {}
+  volumeName = os.path.splitext(os.path.basename(filePath))[0]
+  myVolumeData = {"global" : {}, "volumeName" : volumeName}
+  theFile = open(filePath,"r")
+  currentSection = myVolumeData["global"]
+  for row in theFile:
+    sectionMatch = re.search("^\[(.*?)\s*?\"(.*?)\"\]",row)
+    try:
+      sectionGroup = sectionMatch.groups()[0]
+      sectionName = sectionMatch.groups()[1]
+      if not sectionGroup in myVolumeData:
+        myVolumeData[sectionGroup] = {}
+      if not sectionName in myVolumeData[sectionGroup]:
+        myVolumeData[sectionGroup][sectionName] = {}
+      currentSection = myVolumeData[sectionGroup][sectionName]
+      continue
+    except:
+      pass
+    try:
+      reMatch = re.search("^([^\#].*?)\s{1,4}(.*)$",row)
+      key = reMatch.groups()[0]
+      value = reMatch.groups()[1]
+      if key == "Node":
+        if not key in currentSection:
+          currentSection[key] = []
+        reMatch = re.search("^\"(.*?)\".*$",value)
+        currentSection[key].append(reMatch.groups()[0])
+      else:
+        currentSection[key] = value
+    except:
+      theService.logger("_loadXsanVolumeConfigFromFilePath() Skipping line:\n%s" 
+                        % row ,"debug")
+  theFile.close()
+  theService.plist["Volumes"][volumeName] = myVolumeData
+
+def timeParser(parseFunction,configFiles,rounds):
+  '''Parses each of configFiles with parseFunction, rounds times. Returns
+  the elapsed time in seconds and the resulting xsanService plist'''
+
+  startTime = time.time()
+  for count in range(rounds):
+    theService = sabackup.xsanService()
+    theService.echoLogs = False
+    for configFile in configFiles:
+      parseFunction(theService,configFile)
+  return time.time() - startTime,theService.plist
+
+def main():
+  numVolumes = 4
+  numDisks = 20000
+  rounds = 3
+  tmpDir = None
+
+  outputPath = None
+
+  optlist,args = getopt.getopt(sys.argv[1:],"",["volumes=","disks=","rounds=",
+                                                "tmpdir=","output="])
+  for opt,arg in optlist:
+    if opt == "--volumes":
+      numVolumes = int(arg)
+    elif opt == "--disks":
+      numDisks = int(arg)
+    elif opt == "--rounds":
+      rounds = int(arg)
+    elif opt == "--tmpdir":
+      tmpDir = arg
+    elif opt == "--output":
+      outputPath = arg
+
+  workDir = tempfile.mkdtemp(prefix="bench_xsancfg_",dir=tmpDir)
+  try:
+    configFiles = []
+    totalBytes = 0
+    totalLines = 0
+    for count in range(numVolumes):
+      configFile = os.path.join(workDir,"Vol%d.cfg" % count)
+      writeVolumeConfig(configFile,numDisks)
+      configFiles.append(configFile)
+      totalBytes += os.path.getsize(configFile)
+      totalLines += len(open(configFile).readlines())
+
+    legacySeconds,legacyPlist = timeParser(legacyLoadVolumeConfig,configFiles,rounds)
+    tokenizerSeconds,tokenizerPlist = timeParser(
+      sabackup.xsanService._loadXsanVolumeConfigFromFilePath,configFiles,rounds)
+  finally:
+    shutil.rmtree(workDir)
+
+  megabytes = float(totalBytes) * rounds / (1024 * 1024)
+  results = {"benchmark" : "xsancfg",
+              "volumes" : numVolumes,
+              "disksPerVolume" : numDisks,
+              "rounds" : rounds,
+              "bytes" : totalBytes,
+              "lines" : totalLines,
+              "identical" : legacyPlist == tokenizerPlist,
+              "legacySeconds" : round(legacySeconds,4),
+              "legacyMBPerSecond" : round(megabytes / legacySeconds,2),
+              "tokenizerSeconds" : round(tokenizerSeconds,4),
+              "tokenizerMBPerSecond" : round(megabytes / tokenizerSeconds,2),
+              "speedup" : round(legacySeconds / tokenizerSeconds,2)}
+
+  output = json.dumps(results,indent=2,sort_keys=True)
+  if outputPath:
+    theFile = open(outputPath,"w")
+    theFile.write(output + "\n")
+    theFile.close()
+  print output
+
+if __name__ == "__main__":
+  main()
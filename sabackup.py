@@ -24,12 +24,38 @@ import syslog,logging,logging.handlers,plistlib,shutil,subprocess
 import platform
 import codecs
 import sqlite3
+import threading,Queue
+import hashlib,tempfile
+import bisect,fnmatch
+import copy,cStringIO,collections
+import errno,select,fcntl,math
+import cProfile,pstats,resource
+
+## Use scandir for directory scans where available
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+## Use tracemalloc for --profile memory reports where available
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None
 
 ## init our vars
 version = ".60"
 build = "20111213"
 DEBUG = False
 
+commandSpoolSize = 8 * 1024 * 1024  ## Command output beyond this is spooled to disk
+commandHistorySize = 1000           ## Number of commands kept in commandHistory
+commandHistory = collections.deque(maxlen=commandHistorySize)  ## Timing of our most recent commands
+commandHistoryLock = threading.Lock()
+
 
 ######################### START FUNCTIONS ###############################
 
@@ -45,6 +71,14 @@ Syntax:
 Flags: 
   --plist=         ## Path to a plist to read configuration information from
                     This will override any other provided options!
+                    Keys are our long flag names (i.e. "outputdir"), 
+                    plus the following keys which have no flag:
+                    "profilerjobs"     Concurrent system_profiler
+                                       collectors (default 4)
+                    "profilertimeout"  Seconds before a data type 
+                                       collector is abandoned (default 120)
+                    "profilerttls"     Dictionary of seconds to cache each
+                                       data type for, keyed by data type
                     
   --outputfile=    ## path to save exported plist or sparseimage file.
   --outputdir=     ## path to directory for export. If multiple services are
@@ -94,6 +128,37 @@ Flags:
     --mincopies=   ## Minimum number of copies to keep of a file, overrides maxage
     --maxcopies=   ## Maximum number of copies to keep of a file, regardless of age
 
+  --jobs=          ## Number of services to back up concurrently. Defaults
+                    to 1 (services are backed up one after another)
+
+  --engine=        ## Collection engine, "threads" (default) runs each
+                    service's commands from its own backup job. "events"
+                    runs every collector (serveradmin, system_profiler,
+                    cvlabel) and the OD archive from a single event loop
+                    before backing up. A failed OD archive marks the
+                    backup failed and skips pruning
+  --deadline=      ## Seconds allowed for "events" collection, collectors
+                    still running are abandoned. Defaults to 0 (no limit)
+
+  --timings        ## Print the time spent (and bytes processed) in each
+                    phase of the backup once complete, slowest first.
+                    Timings are always recorded in sa_global.plist and
+                    in the backup history database
+
+  --profile=       ## Directory to write a cProfile profile of the backup 
+                    to, as a .pstats file and a text report of the top
+                    functions (and allocations, if tracemalloc is
+                    available). See runProfiled() to profile other passes,
+                    such as backupSummary.load()
+
+  --layout=        ## Output layout, "directory" (default) writes service
+                    plists to per-service directories. "store" writes
+                    de-duplicated, content-addressed blobs plus a manifest
+                    per backup, pruning then garbage collects the store
+  --storepath=     ## Path to the object store used by --layout=store,
+                    defaults to "store" in the backup directory. A store
+                    may be shared by several hosts
+
   -f,--force       ## Do not prompt for verification when overwriting 
                     existing files or performing restore operations. 
 
@@ -140,13 +205,591 @@ def getNextFSName(self,filePath,dirPath=""):
     myCount += 1
 
   return myFilePath
-  
-  
+
+def runConcurrentJobs(jobFunction,jobArgs,maxJobs=1):
+  '''Calls jobFunction once for each entry in jobArgs, using a pool of at most
+  maxJobs worker threads. Returns a list of (result,error) tuples in the same
+  order as jobArgs, where error is the exception raised by the job (or None).
+  With maxJobs <= 1 the jobs are simply run in order in the calling thread.'''
+
+  results = [(None,None)] * len(jobArgs)
+
+  try:
+    maxJobs = int(maxJobs)
+  except:
+    maxJobs = 1
+
+  def runJob(index):
+    try:
+      results[index] = (jobFunction(jobArgs[index]),None)
+    except Exception,err:
+      results[index] = (None,err)
+
+  if maxJobs <= 1 or len(jobArgs) <= 1:
+    for index in range(len(jobArgs)):
+      runJob(index)
+    return results
+
+  jobQueue = Queue.Queue()
+  for index in range(len(jobArgs)):
+    jobQueue.put(index)
+
+  def worker():
+    while True:
+      try:
+        index = jobQueue.get_nowait()
+      except Queue.Empty:
+        return
+      runJob(index)
+
+  workers = []
+  for count in range(min(maxJobs,len(jobArgs))):
+    workerThread = threading.Thread(target=worker)
+    workerThread.setDaemon(True)
+    workerThread.start()
+    workers.append(workerThread)
+  for workerThread in workers:
+    workerThread.join()
+
+  return results
+
+def pruneCountForSnapshots(snapshotTimes,expiredTime,minCopies=1,maxCopies=0):
+  '''Accepts a list of snapshot times (epoch seconds) sorted oldest first.
+  Returns the number of snapshots, counted from the start of the list, which
+  should be pruned: all snapshots at or before expiredTime, while retaining
+  at least minCopies, and removing further snapshots if more than maxCopies
+  (when non-zero) would remain.'''
+
+  numSnapshots = len(snapshotTimes)
+  numExpired = bisect.bisect_right(snapshotTimes,expiredTime)
+
+  numToRemove = min(numExpired,numSnapshots - minCopies)
+  if maxCopies > 0 and numSnapshots - numToRemove > maxCopies:
+    numToRemove = numSnapshots - maxCopies
+
+  return max(numToRemove,0)
+
+def timeForSnapshot(filePath,baseName):
+  '''Returns the backup time (epoch seconds) of the snapshot at filePath,
+  as recorded by the timestamp in its name (i.e. "<baseName>_20100101_0101.plist").
+  Snapshots which are not timestamped fall back to their mtime, which is 
+  not reliable for hard linked snapshots as it is shared by every link. 
+  Returns None if filePath cannot be read.'''
+
+  fileName = os.path.basename(filePath)
+  stampString = os.path.splitext(fileName[len(baseName) + 1:])[0]
+  stampDigits = re.sub("[^0-9]","",stampString)
+  if len(stampDigits) in (8,12,14):
+    ## YYYYMMDD[HHMM[SS]]
+    timeTuple = [int(stampDigits[0:4]),int(stampDigits[4:6]),int(stampDigits[6:8]),
+                  int(stampDigits[8:10] or 0),int(stampDigits[10:12] or 0),
+                  int(stampDigits[12:14] or 0),0,0,-1]
+    if 1 <= timeTuple[1] <= 12 and 1 <= timeTuple[2] <= 31:
+      try:
+        return time.mktime(tuple(timeTuple))
+      except (ValueError,OverflowError):
+        pass
+  try:
+    return os.stat(filePath).st_mtime
+  except OSError:
+    return None
+
+def valueForKey(currentItem,key,intKey=None,indexLists=True):
+  '''Returns the value for a single keypath element of currentItem, see
+  keyPathAccessor.valueForObject()'''
+
+  if indexLists and type(currentItem) == type([]):
+    if intKey is not None:
+      try:
+        return currentItem[intKey]
+      except IndexError:
+        pass
+    currentItem = currentItem[0]
+  return currentItem[key]
+
+def valuesForAccessors(accessors,currentItem,startIndex=0,indexLists=True):
+  '''Resolves each keyPathAccessor in accessors from currentItem, walking 
+  keypath prefixes shared between accessors only once. Returns a list of 
+  (value,error) tuples in the same order as accessors, where error is the 
+  exception raised resolving the keypath (or None)'''
+
+  results = [(None,None)] * len(accessors)
+
+  def walk(item,depth,indexes):
+    branches = {}
+    branchOrder = []
+    for index in indexes:
+      keys = accessors[index].keys
+      if len(keys) <= depth:
+        results[index] = (item,None)
+        continue
+      if not keys[depth] in branches:
+        branches[keys[depth]] = []
+        branchOrder.append(keys[depth])
+      branches[keys[depth]].append(index)
+
+    for key,intKey in branchOrder:
+      try:
+        nextItem = valueForKey(item,key,intKey,indexLists)
+      except Exception,err:
+        for index in branches[(key,intKey)]:
+          results[index] = (None,err)
+        continue
+      walk(nextItem,depth + 1,branches[(key,intKey)])
+
+  walk(currentItem,startIndex,range(len(accessors)))
+  return results
+
+def runCommand(argList,timeout=None,stdinData=None,spoolSize=None):
+  '''Executes argList directly (without a shell) and returns a commandResult.
+  If timeout (in seconds) is provided and the command has not finished by
+  then, it is killed and the result is flagged as timedOut. If spoolSize
+  (in bytes) is provided, stdout beyond that size is streamed to a temporary
+  file rather than held in memory, see commandResult.openStdout(). The wall 
+  clock and CPU (rusage) time of each command is recorded in the result and
+  appended to commandHistory. See collectionEngine to run many commands
+  concurrently.'''
+
+  engine = collectionEngine()
+  result = engine.addCommand(argList,timeout=timeout,stdinData=stdinData,
+                              spoolSize=spoolSize)
+  engine.run()
+  return result
+
+def isLocalFilesystem(path):
+  '''Returns True if path resides on a local filesystem, as reported by
+  'df -l'. Returns False if this could not be determined'''
+
+  result = runCommand(["/bin/df","-l",path],timeout=10)
+  if result.timedOut or not result.returncode == 0:
+    return False
+  return len(result.stdout.strip().splitlines()) > 1
+
+def recordCommand(result):
+  '''Appends the timing of the commandResult result to commandHistory, 
+  which holds the most recent commandHistorySize commands'''
+
+  commandHistoryLock.acquire()
+  try:
+    commandHistory.append({"command" : os.path.basename(str(result.argList[0])),
+                            "arguments" : result.argList[1:],
+                            "returncode" : result.returncode,
+                            "timedOut" : result.timedOut,
+                            "wallTime" : result.wallTime,
+                            "userTime" : result.userTime,
+                            "systemTime" : result.systemTime,
+                            "stdoutBytes" : result.stdoutBytes})
+  finally:
+    commandHistoryLock.release()
+
+def runProfiled(profileDir,name,function,args=(),topCount=30):
+  '''Calls function with args under cProfile and returns its result. The
+  profile is written to profileDir as sabackup_<name>_<timestamp>.pstats,
+  along with a .txt report of the topCount functions by cumulative and by
+  internal time. If tracemalloc is available, allocations are traced and
+  the report includes the topCount allocating lines, otherwise it notes
+  our peak resident set size. Only the calling thread is profiled, so 
+  work done by runConcurrentJobs() workers appears as time spent waiting'''
+
+  basePath = os.path.join(profileDir,"sabackup_%s_%s" 
+                            % (name,time.strftime("%Y%m%d_%H%M%S")))
+  profiler = cProfile.Profile()
+  if tracemalloc:
+    tracemalloc.start()
+  startTime = time.time()
+  try:
+    return profiler.runcall(function,*args)
+  finally:
+    wallTime = time.time() - startTime
+    memorySnapshot = None
+    if tracemalloc:
+      memorySnapshot = tracemalloc.take_snapshot()
+      peakMemory = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+
+    try:
+      if not os.path.isdir(profileDir):
+        os.makedirs(profileDir)
+      profiler.dump_stats("%s.pstats" % basePath)
+
+      report = cStringIO.StringIO()
+      report.write("sabackup profile: %s (%.3fs)\n\n" % (name,wallTime))
+      stats = pstats.Stats(profiler,stream=report)
+      stats.sort_stats("cumulative").print_stats(topCount)
+      stats.sort_stats("time").print_stats(topCount)
+      if memorySnapshot:
+        report.write("Peak traced memory: %s bytes\n\n" % peakMemory)
+        report.write("Top %s allocations by line:\n" % topCount)
+        for stat in memorySnapshot.statistics("lineno")[:topCount]:
+          report.write("  %s\n" % stat)
+      else:
+        ## ru_maxrss is reported in bytes on OS X, kilobytes elsewhere
+        report.write("Peak resident set size (ru_maxrss): %s\n" 
+                      % resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        report.write("tracemalloc is unavailable, allocations were not traced\n")
+
+      reportFH = open("%s.txt" % basePath,"w")
+      reportFH.write(report.getvalue())
+      reportFH.close()
+      print "   - Wrote profile: %s.pstats" % basePath
+    except Exception,err:
+      print "ERROR: Could not write profile to '%s': %s" % (profileDir,err)
+
 
 ######################### END FUNCTIONS #################################
 
 ######################### START CLASSES ###############################
 
+class commandResult:
+  '''Stores the outcome of a command executed by runCommand()'''
+
+  def __init__(self,argList=[]):
+    self.argList = argList
+    self.returncode = None    ## None if the command could not be executed
+    self.stdout = ""          ## Empty if our output was spooled to stdoutPath
+    self.stderr = ""
+    self.stdoutPath = ""      ## Temporary file holding spooled output
+    self.stdoutBytes = 0
+    self.timedOut = False     ## True if the command was killed by our timeout
+    self.wallTime = 0         ## Seconds elapsed
+    self.userTime = 0         ## CPU seconds used by the command
+    self.systemTime = 0
+
+  def openStdout(self):
+    '''Returns a file object from which our output can be read'''
+    if self.stdoutPath:
+      return open(self.stdoutPath,"rb")
+    return cStringIO.StringIO(self.stdout)
+
+  def cleanup(self):
+    '''Removes our spooled output, if any'''
+    if self.stdoutPath and os.path.exists(self.stdoutPath):
+      os.remove(self.stdoutPath)
+    self.stdoutPath = ""
+
+class collectionEngine:
+  '''Runs external commands concurrently from a single thread. Commands are
+  added with addCommand() and executed by run(), which multiplexes the I/O
+  of every in-flight command with poll() (or select() where poll() is not
+  available). At most maxInFlight commands run at once. Each command may 
+  have its own timeout, and timeout applies a deadline to the run as a 
+  whole: commands still running when it passes are killed, and those not 
+  yet started are abandoned (both are flagged as timedOut). A callback 
+  passed to addCommand() is called with the command's commandResult as it
+  completes, and may itself add further commands.'''
+
+  maxInFlight = 16        ## Max number of commands to run at once
+  timeout = 0             ## Seconds allowed for the entire run, 0 for no limit
+  pendingJobs = []        ## Commands waiting to be started
+  runningJobs = []        ## Commands in flight
+  errors = []             ## (commandResult,error) for each callback which raised
+  bytesRead = 0           ## Total stdout bytes read from our commands
+  usePoll = hasattr(select,"poll")  ## Wait for I/O with poll(), else select()
+
+  def __init__(self,maxInFlight=16,timeout=0):
+    self.maxInFlight = maxInFlight
+    self.timeout = timeout
+    self.pendingJobs = []
+    self.runningJobs = []
+    self.errors = []
+    self.bytesRead = 0
+
+  def addCommand(self,argList,callback=None,timeout=None,stdinData=None,spoolSize=None):
+    '''Queues argList for execution, see runCommand() for our arguments. 
+    Returns the commandResult, which is populated once the command completes'''
+
+    result = commandResult(argList)
+    self.pendingJobs.append({"result" : result,
+                              "callback" : callback,
+                              "timeout" : timeout,
+                              "stdinData" : stdinData,
+                              "spoolSize" : spoolSize})
+    return result
+
+  def run(self):
+    '''Runs all queued commands. Returns False if our deadline passed before
+    all commands completed'''
+
+    deadline = None
+    if self.timeout:
+      deadline = time.time() + self.timeout
+    didFinish = True
+
+    while self.pendingJobs or self.runningJobs:
+      while self.pendingJobs and len(self.runningJobs) < max(self.maxInFlight,1):
+        self._startJob(self.pendingJobs.pop(0))
+
+      now = time.time()
+      if deadline is not None and now >= deadline:
+        didFinish = False
+        for job in self.runningJobs[:]:
+          self._killJob(job)
+        for job in self.pendingJobs:
+          job["result"].timedOut = True
+          self._finishJob(job)
+        self.pendingJobs = []
+        break
+
+      ## Determine how long we can wait for I/O
+      waitTimes = []
+      if deadline is not None:
+        waitTimes.append(deadline - now)
+      readers = {}
+      writers = {}
+      for job in self.runningJobs[:]:
+        if job["deadline"] is not None:
+          if job["deadline"] <= now:
+            self._killJob(job)
+            continue
+          waitTimes.append(job["deadline"] - now)
+        if not job["readers"] and job["stdinFD"] is None:
+          ## Our output is closed, but we have not yet exited
+          if not self._reapJob(job,os.WNOHANG):
+            waitTimes.append(0.01)
+          continue
+        for fd in job["readers"]:
+          readers[fd] = job
+        if job["stdinFD"] is not None:
+          writers[job["stdinFD"]] = job
+      if not self.runningJobs:
+        continue
+      waitTime = None
+      if waitTimes:
+        waitTime = max(min(waitTimes),0)
+      if not readers and not writers:
+        time.sleep(waitTime or 0.01)
+        continue
+
+      try:
+        readable,writable = self._waitForIO(readers.keys(),writers.keys(),waitTime)
+      except select.error,err:
+        if err.args[0] == errno.EINTR:
+          continue
+        raise
+
+      for fd in writable:
+        self._writeStdin(writers[fd])
+      for fd in readable:
+        self._readOutput(readers[fd],fd)
+
+    return didFinish
+
+  def _waitForIO(self,readFDs,writeFDs,waitTime):
+    '''Waits up to waitTime seconds (None to block) for any of readFDs to be
+    readable or writeFDs to be writable. Returns (readable,writable) lists
+    of fds. poll() is used where available, as select() cannot handle fds
+    numbered FD_SETSIZE (1024) or above'''
+
+    if not self.usePoll:
+      readable,writable,failed = select.select(readFDs,writeFDs,[],waitTime)
+      return readable,writable
+
+    poller = select.poll()
+    for fd in readFDs:
+      poller.register(fd,select.POLLIN)
+    for fd in writeFDs:
+      poller.register(fd,select.POLLOUT)
+    if waitTime is not None:
+      waitTime = int(math.ceil(waitTime * 1000))
+
+    ## Hangups and errors are reported as ready, so that the following 
+    ## read or write sees EOF or the error
+    readable = []
+    writable = []
+    for fd,event in poller.poll(waitTime):
+      if fd in writeFDs:
+        writable.append(fd)
+      else:
+        readable.append(fd)
+    return readable,writable
+
+  def _startJob(self,job):
+    '''Starts the process for job'''
+
+    result = job["result"]
+    job["startTime"] = time.time()
+    job["deadline"] = None
+    if job["timeout"]:
+      job["deadline"] = job["startTime"] + job["timeout"]
+
+    if job["stdinData"] is not None:
+      stdin = subprocess.PIPE
+    else:
+      stdin = None
+    try:
+      process = subprocess.Popen(result.argList,stdin=stdin,stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,close_fds=True)
+    except OSError,err:
+      result.stderr = "Could not execute '%s': %s" % (result.argList[0],err)
+      self._finishJob(job)
+      return
+
+    job["process"] = process
+    job["readers"] = [process.stdout.fileno(),process.stderr.fileno()]
+    job["stdoutChunks"] = []
+    job["stderrChunks"] = []
+    job["spoolFH"] = None
+    job["stdinFD"] = None
+    job["stdinOffset"] = 0
+    if stdin:
+      if job["stdinData"]:
+        job["stdinFD"] = process.stdin.fileno()
+      else:
+        process.stdin.close()
+    self.runningJobs.append(job)
+
+  def _writeStdin(self,job):
+    '''Writes the next chunk of stdinData to job'''
+
+    stdinData = job["stdinData"]
+    try:
+      job["stdinOffset"] += os.write(job["stdinFD"],
+                            stdinData[job["stdinOffset"]:job["stdinOffset"] + 65536])
+    except OSError,err:
+      if not err.errno == errno.EPIPE:
+        raise
+      job["stdinOffset"] = len(stdinData)
+    if job["stdinOffset"] >= len(stdinData):
+      job["process"].stdin.close()
+      job["stdinFD"] = None
+
+  def _readOutput(self,job,fd):
+    '''Reads available output from fd, spooling stdout to disk once it 
+    exceeds the job's spoolSize'''
+
+    result = job["result"]
+    process = job["process"]
+    data = os.read(fd,65536)
+    if not data:
+      job["readers"].remove(fd)
+      if not job["readers"] and job["stdinFD"] is None:
+        self._reapJob(job,os.WNOHANG)
+      return
+    if fd == process.stderr.fileno():
+      job["stderrChunks"].append(data)
+      return
+
+    result.stdoutBytes += len(data)
+    if job["spoolFH"]:
+      job["spoolFH"].write(data)
+    elif job["spoolSize"] is not None and result.stdoutBytes > job["spoolSize"]:
+      ## Our output is too large to hold in memory, spool it to disk
+      spoolFD,result.stdoutPath = tempfile.mkstemp(prefix="sabackup_cmd_")
+      job["spoolFH"] = os.fdopen(spoolFD,"wb")
+      job["spoolFH"].write("".join(job["stdoutChunks"]))
+      job["spoolFH"].write(data)
+      job["stdoutChunks"] = []
+    else:
+      job["stdoutChunks"].append(data)
+
+  def _killJob(self,job):
+    '''Kills job, which has exceeded its deadline'''
+
+    job["result"].timedOut = True
+    try:
+      job["process"].kill()
+    except OSError:
+      pass
+    job["readers"] = []
+    job["stdinFD"] = None
+    self._reapJob(job,0)
+
+  def _reapJob(self,job,options):
+    '''Collects the exit status and resource usage of job, if it has exited.
+    options are passed to os.wait4(), os.WNOHANG returns immediately if 
+    job is still running'''
+
+    result = job["result"]
+    process = job["process"]
+    while True:
+      try:
+        pid,status,rusage = os.wait4(process.pid,options)
+        break
+      except OSError,err:
+        if err.errno == errno.EINTR:
+          continue
+        pid,status,rusage = process.pid,None,None
+        break
+    if not pid:
+      return False
+
+    if status is None:
+      process.wait()
+      result.returncode = process.returncode
+    else:
+      if os.WIFSIGNALED(status):
+        result.returncode = -os.WTERMSIG(status)
+      else:
+        result.returncode = os.WEXITSTATUS(status)
+      process.returncode = result.returncode
+      result.userTime = rusage.ru_utime
+      result.systemTime = rusage.ru_stime
+
+    if job["spoolFH"]:
+      job["spoolFH"].close()
+    for pipe in (process.stdin,process.stdout,process.stderr):
+      if pipe and not pipe.closed:
+        pipe.close()
+    result.stdout = "".join(job["stdoutChunks"])
+    result.stderr = "".join(job["stderrChunks"])
+    self.runningJobs.remove(job)
+    self._finishJob(job)
+    return True
+
+  def _finishJob(self,job):
+    '''Records job's timing and calls its callback'''
+
+    result = job["result"]
+    if "startTime" in job:
+      result.wallTime = time.time() - job["startTime"]
+    self.bytesRead += result.stdoutBytes
+    recordCommand(result)
+    if job["callback"]:
+      try:
+        job["callback"](result)
+      except Exception,err:
+        self.errors.append((result,err))
+
+class keyPathAccessor:
+  '''A compiled keyPath, as used by valueForKeyPath(). The keyPath is split,
+  and integer list indexes parsed, once at compile time rather than on each
+  lookup. Service classes compile their keyPaths via compileKeyPath(), which
+  may resolve aliases or service dispatch up front'''
+
+  keyPath = ""          ## Our dot (.) separated keypath
+  keys = []             ## List of (key,intKey) tuples, intKey is None if key is not an integer
+  aliasName = ""        ## Name of an alias which resolves this keypath, if any
+  aliasArgument = ""    ## Argument for our alias (i.e. a volume name)
+  aliasAccessors = []   ## keyPathAccessors to try, in order, in place of ours
+  serviceName = ""      ## The service our keypath is dispatched to (backupController)
+  serviceKeyPath = ""   ## The remainder of our keypath, passed to serviceName
+
+  def __init__(self,keyPath=""):
+    self.keyPath = keyPath
+    self.keys = []
+    self.aliasName = ""
+    self.aliasArgument = ""
+    self.aliasAccessors = []
+    self.serviceName = ""
+    self.serviceKeyPath = ""
+    if keyPath:
+      for key in keyPath.split("."):
+        try:
+          intKey = int(key)
+        except ValueError:
+          intKey = None
+        self.keys.append((key,intKey))
+
+  def valueForObject(self,currentItem,startIndex=0,indexLists=True):
+    '''Walks our keys, beginning at keys[startIndex], from currentItem and 
+    returns the resulting value. If indexLists is set, lists are indexed by 
+    integer keys, for any other key, the first item of the list is used. 
+    Raises an exception if our keypath does not exist'''
+
+    for key,intKey in self.keys[startIndex:]:
+      currentItem = valueForKey(currentItem,key,intKey,indexLists)
+    return currentItem
+
 class baseService: 
   '''This is our base object which contains members that store basic service 
   and backup information. It also defines logging routines used by our 
@@ -173,6 +816,17 @@ class baseService:
   canPrune = False
   pruneOptions = {"maxAge" : 30, "minCopies" : 1, "maxCopies" : 0}
 
+  previousSnapshot = {}    ## contentHash and path of our last snapshot
+  contentHash = ""         ## content hash of our most recent snapshot
+  snapshotFile = ""        ## path of our most recent snapshot
+  snapshotReused = False   ## True if our last snapshot linked an unchanged one
+  backupDuration = 0       ## Seconds taken by our last backup
+  timings = {}             ## Seconds and bytes spent per phase, see recordTiming()
+
+  controller = None        ## The backupController we are registered with
+  plistGeneration = 0      ## Incremented each time our plist changes
+  compiledKeyPaths = {}    ## keyPathAccessors, keyed by (class,keyPath)
+
   lastMSG = ""             ## Last log message
   lastError = ""           ## Last error log message
   log = []                 ## Array of logged messages
@@ -192,6 +846,14 @@ class baseService:
     self.lastError = ""
     self.log = []
     self.info = {}
+    self.previousSnapshot = {}
+    self.contentHash = ""
+    self.snapshotFile = ""
+    self.snapshotReused = False
+    self.backupDuration = 0
+    self.timings = {}
+    self.controller = None
+    self.plistGeneration = 0
 
 
     if backupPath:
@@ -199,6 +861,15 @@ class baseService:
     if name:
       self.setName(name)
 
+  def recordTiming(self,phase,startTime,byteCount=0):
+    """Adds the time elapsed since startTime, and byteCount bytes processed,
+    to our timings for phase. Phases recorded more than once accumulate"""
+
+    if not phase in self.timings:
+      self.timings[phase] = {"seconds" : 0.0, "bytes" : 0}
+    self.timings[phase]["seconds"] += time.time() - startTime
+    self.timings[phase]["bytes"] += byteCount
+
   def logger(self, logMSG, logLevel="normal"):
     """(very) Basic Logging Function, we'll probably migrate to msg module"""
     if logLevel[0:5] == "debug" and not self.debug:
@@ -287,7 +958,8 @@ class baseService:
   def pruneBackupsFromDirectory(self,dirPath,maxAge=10,minCopies=1,maxCopies=0,globString="*"):
     """This function prunes backups from the specified directory. When ran, it 
     will remove all files in the directory older that maxAge days.
-    Regardless of age, at least minCopies will be retained in the directory."""
+    Regardless of age, at least minCopies will be retained in the directory,
+    and if maxCopies is set, no more than maxCopies will be retained."""
   
     ## Sanitize our arguments
     try:
@@ -317,119 +989,75 @@ class baseService:
       print "Failed to prune backups! '%s' is not a directory!" % dirPath
       return False
     
-    ## Create our datetime objects which represent expired files
-    maxTimeDelta = datetime.timedelta(days=maxAgeInt)
-    expiredDateTime = datetime.datetime.today() - maxTimeDelta
-
-
-    ## Get a list of files in the directory, calculate their mtimes
-    myFiles = {}
-    expiredFiles = []   ## List of expired filenames sorted by date (oldest first)
-    allFiles = []       ## List of all filenames sorted by date (oldest first)
-      
-    fileList = glob.glob(os.path.join(dirPath,globString))
+    ## Files backed up at or before expiredTime have expired
+    expiredTime = time.time() - (maxAgeInt * 86400)
 
+    ## Scan the directory once, building a list of (backupTime,fileName) tuples,
+    ## excluding our "latest" link from pruning consideration
     latestStubName = "%s_latest" % self.baseName
     self.logger("latestStubName: %s" % latestStubName,"debug2")    
-    
-    for entity in fileList:
-      fileName = os.path.basename(entity)
-      ## Exclude the "lastest" link from pruning consideration
+    matchHidden = globString[0:1] == "."
 
-      self.logger("  - checking fileName %s" % fileName,"debug")
-      ##self.logger("fileName stub: %s" % fileName[0:len(latestStubName)],"debug")
-      
+    snapshots = []
+    for fileName in os.listdir(dirPath):
+      if fileName[0:1] == "." and not matchHidden:
+        continue
+      if not fnmatch.fnmatchcase(fileName,globString):
+        continue
       if fileName[0:len(latestStubName)] == latestStubName:
         self.logger("Skipping file for pruning: %s" % fileName,"debug")
         continue
-      myFilePath = entity
-      if os.path.exists(myFilePath):
-        myFileDateTime = datetime.datetime.fromtimestamp(os.path.getmtime(myFilePath))
-        if myFileDateTime > expiredDateTime:
-          myFileExpired = False
-        else:
-          myFileExpired = True
-          ## Add our file to the expiredFiles list based upon it's age
-          count = 0
-          for expiredFile in expiredFiles:
-            if myFiles[expiredFile]["datetime"] > myFileDateTime:
-              expiredFiles.insert(count,fileName)
-              break
-            count += 1
-          ## If it hasn't been inserted, append it to the end
-          if not entity in expiredFiles:
-            expiredFiles.append(fileName)
-        ## Add our file to the allFiles list based upon it's age
-        count = 0
-        for file in allFiles:
-          if myFiles[file]["datetime"] > myFileDateTime:
-            allFiles.insert(count,fileName)
-            break
-          count += 1
-        ## If it hasn't been inserted, append it to the end
-        if not fileName in allFiles:
-          allFiles.append(fileName)
-        
-        ## Add the file to the myFiles dictionary
-        myFiles[fileName] = {"datetime": myFileDateTime,"expired": myFileExpired,"path":myFilePath}
-      
-    ## We have now processed expiration for all files in the directory,
-    ## and have comprised an expired files list store at expiredFiles
-    ## Remove all expired files or until we have hit our minCopies parameter
-    if len(expiredFiles) > (len(myFiles) - minCopiesInt):
-      numFilesToRemove = len(myFiles) - minCopiesInt
-    else:
-      numFilesToRemove = len(expiredFiles)
-    
-    if maxCopiesInt:
-      if len(myFiles) - numFilesToRemove > maxCopiesInt:
-        numFilesToRemove = len(myFiles) - maxCopiesInt
-      
-      if numFilesToRemove > len(expiredFiles):
-        rmFileDelta = numFilesToRemove - len(expiredFiles)
-        count = 0
-        for file in allFiles:
-          if count < rmFileDelta:
-            expiredFiles.append(file)
-          else: 
-            break
-          count += 1
-          
-        
-    
-    
-    ## Debug
-    ##print "myFiles: %s\nexpiredFiles: %s\n" % (myFiles,expiredFiles)
+      snapshotTime = timeForSnapshot(os.path.join(dirPath,fileName),self.baseName)
+      if snapshotTime is not None:
+        snapshots.append((snapshotTime,fileName))
+
+    ## Sort once, oldest first. Ties (i.e. untimestamped hard linked 
+    ## snapshots) are broken by name
+    snapshots.sort()
+
+    numFilesToRemove = pruneCountForSnapshots([snapshot[0] for snapshot in snapshots],
+                                                expiredTime,minCopiesInt,maxCopiesInt)
     
     if numFilesToRemove <= 0:
       self.logger("     No files qualify for pruning!","detailed")
       return True
     
-    self.logger("     Pruning %s of %s files!" % (numFilesToRemove,len(myFiles)))
-    count = 0
-    failedFiles = []
-    while count < numFilesToRemove:
-      fileToRemove = expiredFiles[count]
-
-      try:
-        rmPath = myFiles[fileToRemove]["path"]
-        if os.path.isdir(rmPath):
-          shutil.rmtree(rmPath)
-          self.logger("     - Pruned Directory: %s" % fileToRemove,"detailed")
-        else:
-          os.remove(rmPath)
-          self.logger("     - Pruned file: %s" % fileToRemove,"detailed")
-
-      except:
-        self.logger("     ERROR: could not prune file: %s" % fileToRemove,"error")
-        failedFiles.append(fileToRemove)
-      count += 1
+    self.logger("     Pruning %s of %s files!" % (numFilesToRemove,len(snapshots)))
+    failedFiles = self.removeBackupFiles(dirPath,
+                      [snapshot[1] for snapshot in snapshots[:numFilesToRemove]])
     
     if len(failedFiles) == 0:
       self.logger("     Successfully pruned expired files!","detailed")
       return True
     
     return False
+
+  def removeBackupFiles(self,dirPath,fileNames,batchSize=500):
+    """Removes each file or directory in fileNames from dirPath. Progress is
+    logged once per batch of batchSize files. Returns a list of fileNames
+    which could not be removed."""
+
+    failedFiles = []
+    for batchStart in range(0,len(fileNames),batchSize):
+      batch = fileNames[batchStart:batchStart + batchSize]
+      for fileToRemove in batch:
+        rmPath = os.path.join(dirPath,fileToRemove)
+        try:
+          if os.path.isdir(rmPath) and not os.path.islink(rmPath):
+            shutil.rmtree(rmPath)
+            self.logger("     - Pruned Directory: %s" % fileToRemove,"debug")
+          else:
+            os.remove(rmPath)
+            self.logger("     - Pruned file: %s" % fileToRemove,"debug")
+        except:
+          self.logger("     ERROR: could not prune file: %s" % fileToRemove,"error")
+          failedFiles.append(fileToRemove)
+      if len(batch) == 1:
+        self.logger("     - Pruned: %s" % batch[0],"detailed")
+      else:
+        self.logger("     - Pruned: %s through %s" % (batch[0],batch[-1]),"detailed")
+
+    return failedFiles
   
   def setBackupPath(self,backupPath):
     """ Method which sets the backup directory"""
@@ -464,6 +1092,105 @@ class baseService:
     '''Returns a list of running services. This returns all registered
     services for the object, over-ride this for your specific object'''
     return self.servicesMap.keys()
+
+  def hashForData(self,data):
+    '''Returns the content hash used to identify snapshot data'''
+    return hashlib.sha1(data).hexdigest()
+
+  def writeSnapshot(self,plistObj,filePath):
+    '''Writes plistObj to filePath. The plist is serialized canonically (keys
+    are sorted by plistlib) and hashed, if the hash matches that of
+    self.previousSnapshot, filePath is hard linked to the previous snapshot
+    rather than writing out a new copy. Sets self.contentHash, 
+    self.snapshotFile and self.snapshotReused. Returns True on success'''
+
+    startTime = time.time()
+    plistData = plistlib.writePlistToString(plistObj)
+    self.recordTiming("serialize",startTime,len(plistData))
+    contentHash = self.hashForData(plistData)
+
+    self.contentHash = contentHash
+    self.snapshotFile = filePath
+    self.snapshotReused = False
+
+    previousPath = ""
+    if self.previousSnapshot and self.previousSnapshot.get("contentHash") == contentHash:
+      previousPath = self.previousSnapshot.get("path","")
+
+    if previousPath and os.path.isfile(previousPath):
+      if os.path.abspath(previousPath) == os.path.abspath(filePath):
+        self.logger("Settings unchanged, keeping snapshot: %s" % filePath,"detailed")
+        self.snapshotReused = True
+        return True
+      try:
+        if os.path.lexists(filePath):
+          os.remove(filePath)
+        os.link(previousPath,filePath)
+        self.logger("Settings unchanged, linked %s to previous snapshot: %s" 
+                      % (os.path.basename(filePath),os.path.basename(previousPath)),"detailed")
+        self.snapshotReused = True
+        return True
+      except Exception,err:
+        self.logger("Could not link to previous snapshot: %s, writing new copy. Error: %s" 
+                      % (previousPath,err),"warning")
+
+    ## Write to a temp file which replaces filePath, as filePath may be a
+    ## hard link shared with earlier snapshots
+    startTime = time.time()
+    tempPath = ""
+    try:
+      fileDescriptor,tempPath = tempfile.mkstemp(prefix=".%s." % os.path.basename(filePath),
+                                                  dir=os.path.dirname(filePath))
+      fileHandle = os.fdopen(fileDescriptor,"w")
+      try:
+        fileHandle.write(plistData)
+      finally:
+        fileHandle.close()
+      os.chmod(tempPath,0644)
+      os.rename(tempPath,filePath)
+    except Exception,err:
+      self.logger("Could not write snapshot to '%s': %s" % (filePath,err),"error")
+      if tempPath and os.path.exists(tempPath):
+        os.remove(tempPath)
+      return False
+    self.recordTiming("write",startTime,len(plistData))
+
+    return True
+
+  def backupToStore(self,store):
+    '''Fallback for services which do not write to a blobStore themselves:
+    performs a regular backupSettings() into a scratch directory and stores
+    each file written. Returns a dict mapping backup file names (relative to
+    the scratch directory) to their stored blob hashes'''
+
+    backupPath = self.backupPath
+    useTimeStamps = self.useTimeStamps
+    scratchDir = tempfile.mkdtemp(prefix=".tmp_backup_",dir=store.path)
+    self.backupPath = scratchDir
+    self.useTimeStamps = False
+    self.previousSnapshot = {}
+    try:
+      if not self.backupSettings():
+        raise RuntimeError("backupToStore() backup failed: %s" % self.lastError)
+      storedFiles = {}
+      startTime = time.time()
+      byteCount = 0
+      for dirPath,dirNames,fileNames in os.walk(scratchDir):
+        for fileName in fileNames:
+          ## Our "latest" links duplicate a stored file
+          if "_latest" in fileName:
+            continue
+          filePath = os.path.join(dirPath,fileName)
+          storedFiles[os.path.relpath(filePath,scratchDir)] = store.putFile(filePath)
+          byteCount += os.path.getsize(filePath)
+      self.recordTiming("write",startTime,byteCount)
+    finally:
+      self.backupPath = backupPath
+      self.useTimeStamps = useTimeStamps
+      self.snapshotFile = ""
+      shutil.rmtree(scratchDir,True)
+
+    return storedFiles
   
   def valueForAliasKeyPath(self,keyPath=""):
     """Returns a value for keyPath based upon a specific keyPath alias
@@ -472,6 +1199,37 @@ class baseService:
     mathematics, etc..."""
     
     raise RuntimeError("No alias exists for keyPath: %s" % keyPath)
+
+  def compileKeyPath(self,keyPath):
+    """Returns a keyPathAccessor for keyPath. Override this to resolve any
+    class specific aliases when the keyPath is compiled"""
+    return keyPathAccessor(keyPath)
+
+  def accessorForKeyPath(self,keyPath):
+    """Returns the compiled keyPathAccessor for keyPath. Accessors are
+    compiled once per class and keyPath, and shared between instances"""
+
+    cacheKey = (self.__class__,keyPath)
+    try:
+      return baseService.compiledKeyPaths[cacheKey]
+    except KeyError:
+      accessor = self.compileKeyPath(keyPath)
+      baseService.compiledKeyPaths[cacheKey] = accessor
+      return accessor
+
+  def valuesForKeyPaths(self,keyPaths):
+    """Returns a list of values, one for each keypath in keyPaths, as 
+    returned by valueForKeyPath(). Override this to resolve keypaths in a
+    single pass"""
+    return [self.valueForKeyPath(keyPath) for keyPath in keyPaths]
+
+  def plistDidChange(self):
+    """Should be called whenever self.plist is modified. Invalidates any
+    stored valueForKeyPath() results which may depend upon it"""
+
+    self.plistGeneration += 1
+    if self.controller:
+      self.controller.plistDidChange()
   
   def mergeTrees(self,tree1,tree2):
     """This function will merge array/dict/key value trees from tree2 to tree1.
@@ -481,38 +1239,23 @@ class baseService:
     if not type(tree1) == type(tree2):
       raise RuntimeError("mergeTrees() Passed trees do not have the same types! "
         " Tree1: %s, Tree2: %s" % (type(tree1),type(tree2)))
-    currentTree1Iterater = tree1
-    currentTree2Iterater = tree2
     
-    if type(currentTree2Iterater) == type({}):
-      for key,value in currentTree2Iterater.iteritems():
-        if not key in currentTree1Iterater:
-          currentTree1Iterater[key] = value
-        else:
-          if type(key) == type({}) or type(key) == type([]):
-            currentTree1Iterater[key] = self.mergeTrees(currentTree1Iterater[key],currentTree2Iterator[key])
-          else:
-            if not currentTree1Iterater[key] and currentTree2Iterator[key]:
-              self.logger("mergeTrees() found conflicting value for key: %s, "
-                            "utilizing tree2 value: %s over current value: %s"
-                            % (key,currentTree2Iterator[key],currentTree1Iterator[key]),"detailed")
-              currentTree1Iterater[key] = currentTree2Iterator[key]
-    elif type(currentTree2Iterator) == type([]):
-      for value in currentTree2Iterator:
-        if not value in currentTree1Iterater:
-          currentTree1Iterater.append(value)
-    else:
-      if not currentTree1Iterator[key] and currentTree2Iterator[key]:
-        self.logger("mergeTrees() found empty value for key: %s, "
-                      "utilizing tree2 value: %s"
-                      % (key,currentTree2Iterator[key]),"detailed")
-        currentTree1Iterater[key] = currentTree2Iterator[key]
-
-      elif currentTree1Iterator[key] and currentTree2Iterator[key]:
-        self.logger("mergeTrees() found conflicting value for key: %s, "
-                      "utilizing tree2 value: %s over current value: %s"
-                      % (key,currentTree2Iterator[key],currentTree1Iterator[key]),"debug")
-        currentTree1Iterater[key] = currentTree2Iterator[key]
+    if type(tree2) == type({}):
+      for key,value in tree2.iteritems():
+        if not key in tree1:
+          tree1[key] = value
+        elif type(value) in (type({}),type([])) and type(tree1[key]) == type(value):
+          tree1[key] = self.mergeTrees(tree1[key],value)
+        elif not tree1[key] and value:
+          self.logger("mergeTrees() found empty value for key: %s, "
+                        "utilizing tree2 value: %s" % (key,value),"detailed")
+          tree1[key] = value
+    elif type(tree2) == type([]):
+      for value in tree2:
+        if not value in tree1:
+          tree1.append(value)
+    elif not tree1 and tree2:
+      return tree2
     return tree1
   
 
@@ -522,6 +1265,10 @@ class saService(baseService):
   for performing and organizing backups for an individual service'''   
 
   serverAdminPath = "/usr/sbin/serveradmin"  
+  settingsBatchSize = 10   ## Max services per batched 'serveradmin settings' call
+  statusProbeJobs = 8      ## Number of concurrent 'serveradmin status' probes
+  statusProbeTimeout = 30  ## Seconds before a status probe is abandoned
+  settingsTimeout = 300    ## Seconds before a 'serveradmin settings' call is abandoned
 
   def __init__(self,name="",backupPath=""):
     """Our construct"""
@@ -581,32 +1328,159 @@ class saService(baseService):
       return False
 
     ## We have passed sanity checks.     
-    saCMD = subprocess.Popen('"%s" -x settings "%s"' 
-        % (serverAdminPath,name),shell=True,
-          stdout=subprocess.PIPE,universal_newlines=True)
-    saCMD_STDOUT, saCMD_STDERR = saCMD.communicate()
+    startTime = time.time()
+    saResult = runCommand([serverAdminPath,"-x","settings",name],
+                          timeout=self.settingsTimeout,spoolSize=commandSpoolSize)
+    self.recordTiming("collect",startTime,saResult.stdoutBytes)
+    if saResult.timedOut:
+      self.logger("serveradmin: settings for:'%s' timed out after %ss!" 
+                    % (name,self.settingsTimeout),"error")
+      saResult.cleanup()
+      return False
     
     ## This is where it actually dumps the settings
-    if len(saCMD_STDOUT) == 0:
-      ##self.logger("backupSettings() '%s -x settings \"%s\"'  "
-      ##  +"returned null string! " % (serverAdminPath,name),"error")
+    if saResult.stdoutBytes == 0:
       self.logger("serveradmin returned null string!","error")
       return False
-    ## initialize our new dictionary
-    plistDict = self.plist
 
     ## Create a plist object from our output.
-    plistObj = plistlib.readPlistFromString(saCMD_STDOUT)
+    try:
+      plistObj = plistlib.readPlist(saResult.openStdout())
+    finally:
+      saResult.cleanup()
+    if not self.loadSettingsPlist(plistObj):
+      self.logger("Could not interpret XML for '%s', key 'configuration' is not present!" % displayName,"error")
+      return False
+    return True
+
+  def loadSettingsPlist(self,plistObj):
+    """Loads our config from a parsed 'serveradmin -x settings' plist. The
+    plist may be the output for our service alone, or combined output
+    for several services, in which case our config is looked up by
+    '<displayName> Config' or by our service name. Returns True if a config
+    for our service was found"""
+
+    name = self.name
+    displayName = self.displayName
+    configKey = "%s Config" % displayName
+
     if "configuration" in plistObj:
-      plistDict["%s Config" % displayName] = plistObj["configuration"]
-    elif "%s Config" % displayName in plistObj:
-      plistDict["%s Config" % displayName] = plistObj["%s Config" % displayName]
+      config = plistObj["configuration"]
+    elif configKey in plistObj:
+      config = plistObj[configKey]
+    elif name in plistObj and "configuration" in plistObj[name]:
+      config = plistObj[name]["configuration"]
+    elif name in plistObj:
+      config = plistObj[name]
     else:
-      self.logger("Could not interpret XML for '%s', key 'configuration' is not present!" % displayName,"error")
       return False
-    self.plist = plistDict
+
+    self.plist[configKey] = config
+    self.plistDidChange()
     self.isLoaded = True
     self.loadedServices.append(name)
+    return True
+
+  def loadServices(self,serviceList,batchSize=0,maxJobs=1):
+    """Loads settings for each saService object in serviceList using as few
+    serveradmin invocations as possible. Services are requested batchSize
+    at a time (0 requests them all at once), chunks are run up to maxJobs
+    at a time. Services whose config could not be found in the combined
+    output are left unloaded, so backupSettings() will fall back to
+    load() for them. Returns a list of the services which were loaded."""
+
+    serverAdminPath = self.serverAdminPath
+
+    if not os.path.isfile(serverAdminPath):
+      self.logger("loadServices() Could not find serveradmin at path:'%s', cannot continue!" % serverAdminPath,"error")
+      return []
+
+    def loadChunk(chunk):
+      saResult = runCommand(self.settingsArgList(chunk),
+                            timeout=self.settingsTimeout,spoolSize=commandSpoolSize)
+      return self._settingsFetched(chunk,saResult)
+
+    chunks = self._settingsChunks(serviceList,batchSize)
+    loadedServices = []
+    for chunkServices,err in runConcurrentJobs(loadChunk,chunks,maxJobs=maxJobs):
+      if err:
+        self.logger("loadServices() batched fetch failed: %s" % err,"error")
+        continue
+      loadedServices.extend(chunkServices)
+
+    return loadedServices
+
+  def queueSettingsFetch(self,engine,serviceList,batchSize=0):
+    """Queues batched 'serveradmin settings' calls for each saService object
+    in serviceList on the collectionEngine engine, see loadServices(). 
+    Services are loaded as their chunk completes. Returns False if 
+    serveradmin could not be found"""
+
+    if not os.path.isfile(self.serverAdminPath):
+      self.logger("queueSettingsFetch() Could not find serveradmin at path:'%s', cannot continue!" % self.serverAdminPath,"error")
+      return False
+
+    for chunk in self._settingsChunks(serviceList,batchSize):
+      engine.addCommand(self.settingsArgList(chunk),
+                          callback=lambda result,chunk=chunk: self._settingsFetched(chunk,result),
+                          timeout=self.settingsTimeout,spoolSize=commandSpoolSize)
+    return True
+
+  def settingsArgList(self,serviceList):
+    """Returns the serveradmin argument list which fetches settings for 
+    each saService object in serviceList"""
+    serviceNames = [serviceObj.name for serviceObj in serviceList]
+    return [self.serverAdminPath,"-x","settings"] + serviceNames
+
+  def _settingsChunks(self,serviceList,batchSize):
+    """Splits the named saService objects in serviceList into lists of up 
+    to batchSize services (0 places them all in a single list)"""
+
+    services = []
+    for serviceObj in serviceList:
+      if serviceObj.name and serviceObj.displayName and not serviceObj in services:
+        services.append(serviceObj)
+    if not services:
+      return []
+
+    if not batchSize or batchSize < 1:
+      batchSize = len(services)
+    chunks = []
+    for index in range(0,len(services),batchSize):
+      chunks.append(services[index:index + batchSize])
+    return chunks
+
+  def _settingsFetched(self,chunk,saResult):
+    """Loads each service in chunk from the commandResult saResult of a 
+    batched 'serveradmin settings' call. Returns a list of the services
+    which were loaded"""
+
+    nameString = " ".join([serviceObj.name for serviceObj in chunk])
+    self.logger("Fetched settings for services: %s" % nameString,"debug")
+    try:
+      try:
+        if saResult.timedOut:
+          raise RuntimeError("serveradmin timed out after %ss fetching services: %s" 
+                              % (self.settingsTimeout,nameString))
+        if saResult.stdoutBytes == 0:
+          raise RuntimeError("serveradmin returned null string for services: %s" % nameString)
+        plistObj = plistlib.readPlist(saResult.openStdout())
+      finally:
+        saResult.cleanup()
+    except Exception,err:
+      self.logger("loadServices() batched fetch failed: %s" % err,"error")
+      return []
+
+    loadedServices = []
+    for serviceObj in chunk:
+      ## A single service chunk may be returned as a bare 'configuration'
+      if len(chunk) > 1 and "configuration" in plistObj:
+        continue
+      if serviceObj.loadSettingsPlist(plistObj):
+        loadedServices.append(serviceObj)
+      else:
+        self.logger("loadServices() no settings returned for service: %s" % serviceObj.name,"detailed")
+    return loadedServices
   
   def loadFromPath(self,path):
     """ Loads our object from a specified path. If a file is provided, it will
@@ -623,19 +1497,19 @@ class saService(baseService):
     if os.path.isfile(path):
       return self.loadFromFile(filePath=path)
     
+    ## Look for our latest file directly before resorting to a directory scan
+    for fileName in ("latest.plist","sa_%s_latest.plist" % name,"sa_global.plist"):
+      filePath = os.path.join(path,fileName)
+      if os.path.isfile(filePath):
+        return self.loadFromFile(filePath=filePath)
+
     plistFileList = glob.glob(os.path.join(path, "*.plist"))
     if len(plistFileList) == 0:
       self.logger("No plist files could be found at path: '%s', cannot continue!" % path,"error")
       return False
-    for file in plistFileList:
-      filePath = file
-      fileName = os.path.splitext(file)
-      if fileName == "sa_%s_latest.plist" % self.name or fileName == "latest.plist":
-        break
-      elif fileName == "sa_global.plist":
-        break
 
-    return self.loadFromFile(filePath=filePath)
+    ## Timestamped file names sort chronologically, use the newest
+    return self.loadFromFile(filePath=max(plistFileList))
               
   def loadFromFile(self,filePath):
     """ Loads our object from serveradmin """
@@ -690,6 +1564,7 @@ class saService(baseService):
        
     if len(plistDict) > 0:
       self.plist = plistDict
+      self.plistDidChange()
       self.isLoaded = True
 
     return True
@@ -697,33 +1572,34 @@ class saService(baseService):
   def valueForKeyPath(self,keyPath=""):
     """Returns value for key"""
     
-    try:
-      aliasValue = valueForKeyPath(keyPath)
-      return aliasValue
-    except:
-      self.logger("No alias registered for keyPath:%s" % keyPath,"debug")
-      pass
-    
-    name = self.name
-    displayName = self.displayName
-
-    currentValue = self.plist["%s Config" % displayName]
+    currentValue = self.plist["%s Config" % self.displayName]
 
     if not keyPath:
       return currentValue
 
-    keyArray = keyPath.split(".")
-    
-    
-    for key in keyArray:
-      try:
-        currentValue = currentValue[key]
-      except Exception, err:
+    try:
+      return self.accessorForKeyPath(keyPath).valueForObject(currentValue,indexLists=False)
+    except Exception, err:
+      self.logger("Keypath: %s does not exist!" % keyPath,"error")
+      self.logger("Exception: %s" % err,"debug")
+      return False
+
+  def valuesForKeyPaths(self,keyPaths):
+    """Returns a list of values, one for each keypath in keyPaths, as 
+    returned by valueForKeyPath(). Shared keypath prefixes are only 
+    traversed once"""
+
+    currentValue = self.plist["%s Config" % self.displayName]
+    accessors = [self.accessorForKeyPath(keyPath) for keyPath in keyPaths]
+
+    values = []
+    for keyPath,(value,err) in zip(keyPaths,valuesForAccessors(accessors,currentValue,indexLists=False)):
+      if err:
         self.logger("Keypath: %s does not exist!" % keyPath,"error")
         self.logger("Exception: %s" % err,"debug")
-        return False
-        
-    return currentValue
+        value = False
+      values.append(value)
+    return values
     
       
   def backupSettings(self):
@@ -784,9 +1660,7 @@ class saService(baseService):
       self.logger("backupSettings() Object contains no data","error")
 
     if not os.path.exists(backupFile) or self.overWriteExistingFiles:
-      try:
-        plistlib.writePlist(plistDict,backupFile)
-      except:
+      if not self.writeSnapshot(plistDict,backupFile):
         self.logger("Unknown error writing file:'%s'" % backupFile)
         return False
     else:
@@ -815,6 +1689,23 @@ class saService(baseService):
         return False
     
     return True
+
+  def backupToStore(self,store):
+    """Writes our settings into the blobStore store. Returns a dict mapping
+    our backup file name to the stored blob hash"""
+    if not self.isLoaded:
+      self.load()
+    if not self.plist or len(self.plist) == 0:
+      raise RuntimeError("backupToStore() Object contains no data")
+
+    startTime = time.time()
+    plistData = plistlib.writePlistToString(self.plist)
+    self.recordTiming("serialize",startTime,len(plistData))
+    startTime = time.time()
+    self.contentHash = store.putData(plistData)
+    self.recordTiming("write",startTime,len(plistData))
+    self.snapshotFile = store.pathForHash(self.contentHash)
+    return { "sa_%s.plist" % self.name : self.contentHash }
   
   def restoreSettings(self):
     """ Perform our server admin restore"""
@@ -830,10 +1721,90 @@ class saService(baseService):
     displayName = self.displayName
     serverAdminPath = self.serverAdminPath
   
+  def probeServiceStatus(self,name):
+    """Returns the state reported by 'serveradmin status' for the service
+    name (i.e. 'RUNNING'), or None if it could not be determined within 
+    self.statusProbeTimeout seconds"""
+
+    result = runCommand([self.serverAdminPath,"-x","status",name],
+                          timeout=self.statusProbeTimeout)
+    return self.stateFromResult(name,result)
+
+  def stateFromResult(self,name,result):
+    """Returns the state for the service name from the commandResult of a
+    'serveradmin status' probe, or None if it could not be determined"""
+
+    if result.timedOut:
+      self.logger("serveradmin: status probe for:'%s' timed out after %ss!" 
+                    % (name,self.statusProbeTimeout),"warning")
+      return None
+    if not result.stdout:
+      self.logger("serveradmin: could not determine status for:'%s'!" % name,"warning")
+      return None
+
+    ## Create a plist object from our output.
+    try:
+      plistObj = plistlib.readPlistFromString(result.stdout)
+    except:
+      self.logger("serveradmin: could not read status XML for:'%s'!" % name,"error")
+      return None
+    if "state" in plistObj:
+      return plistObj["state"]
+    return None
+
+  def probeNames(self):
+    """Returns the names of services which must be probed to determine 
+    whether they are running, 'info' is always considered running"""
+    return [name for name in sorted(self.servicesMap.keys()) if not name == "info"]
+
+  def queueStatusProbes(self,engine,states,names=None):
+    """Queues a 'serveradmin status' probe for each of our services (or 
+    each service in names) on the collectionEngine engine. As each probe 
+    completes its state is stored in the dictionary states, keyed by 
+    service name. Returns False if probes could not be queued"""
+
+    if not os.geteuid() == 0:
+      return False
+    if not os.path.isfile(self.serverAdminPath):
+      return False
+
+    if names is None:
+      names = self.probeNames()
+    for name in names:
+      engine.addCommand([self.serverAdminPath,"-x","status",name],
+              callback=lambda result,name=name: self._statusProbed(states,name,result),
+              timeout=self.statusProbeTimeout)
+    return True
+
+  def _statusProbed(self,states,name,result):
+    """collectionEngine callback for a queued status probe"""
+    states[name] = self.stateFromResult(name,result)
+
+  def runningServicesForStates(self,states):
+    """Returns a list of names of running services given the dictionary 
+    states of probed service states, keyed by service name"""
+
+    runningServices = ["info"]
+    for name in self.probeNames():
+      if states.get(name) == "RUNNING":
+        runningServices.append(name)
+    
+    ## If we have any file-sharing based services, make sure we backup shares
+    for name in ("afp","ftp","nfs","smb"):
+      if name in runningServices:
+        if not "sharing" in runningServices:
+          runningServices.append("sharing")
+        break
+
+    ## 'info' is always running, so look for any probed service
+    if runningServices == ["info"]:
+      self.logger("serveradmin: found no running services!","error")
+
+    return runningServices
+
   def getRunningServiceList(self=""):
     """ Function which returns a list of names of running services """
     
-    runningServices = []
     serverAdminPath = self.serverAdminPath
     
     self.logger("Determining running services for Server Admin", "detailed")
@@ -846,35 +1817,19 @@ class saService(baseService):
     if not os.path.isfile(serverAdminPath):
       self.logger("Could not find serveradmin at path:'%s', cannot backup Server Admin!" % serverAdminPath,"error")
       return False
-    
-    for name,displayName in self.servicesMap.iteritems():
-      if name == "info":
-        runningServices.append(name)
-        continue
-      saCMD = subprocess.Popen('"%s" -x status "%s"' % (serverAdminPath,name),shell=True,stdout=subprocess.PIPE,universal_newlines=True)
-      saCMD_STDOUT, saCMD_STDERR = saCMD.communicate()
-      if len(saCMD_STDOUT) == 0:
-        ##self.logger("backupSettings() '%s -x settings \"%s\"'  returned null string! " % (serverAdminPath,name),"error")
-        self.logger("serveradmin: could not determine status for:'%s'!" % name,"warning")
-        continue
+
+    ## Probe our services concurrently, results are returned in probe order
+    states = {}
+    probeNames = self.probeNames()
+    probeResults = runConcurrentJobs(self.probeServiceStatus,probeNames,
+                                      maxJobs=self.statusProbeJobs)
+    for name,(state,err) in zip(probeNames,probeResults):
+      if err:
+        self.logger("serveradmin: status probe for:'%s' failed: %s" % (name,err),"error")
       else:
-        ## Create a plist object from our output.
-        try:
-          plistObj = plistlib.readPlistFromString(saCMD_STDOUT)
-          if "state" in plistObj:
-            if plistObj["state"] == "RUNNING":
-              runningServices.append(name)
-        except:
-          self.logger("serveradmin: could not read status XML for:'%s'!" % name,"error")
-    
-    ## If we have any file-sharing based services, make sure we backup shares
-    if ("afp" or "ftp" or "nfs" or "smb") in runningServices:
-      runningServices.append("sharing")
-    
-    if len(runningServices) == 0:
-      self.logger("serveradmin: found no running services!","error")
+        states[name] = state
     
-    return runningServices
+    return self.runningServicesForStates(states)
 
 class xsanService(baseService):
   '''Our Xsan root object. This object is responsible for performing and 
@@ -886,16 +1841,45 @@ class xsanService(baseService):
                 ]
     
   isMetadataController = False
-  
-  def __init__(self,name="xsan",backupPath=""):
-    '''Our construct'''
-    self.isMetadataController = False
-    self.xsanConfigDir="/Library/Filesystems/xsan"
+
+  ## Patterns used to tokenize volume.cfg files
+  cfgSectionPattern = re.compile("^\[(.*?)\s*?\"(.*?)\"\]")
+  cfgValuePattern = re.compile("^([^\#].*?)\s{1,4}(.*)$")
+  cfgNodePattern = re.compile("^\"(.*?)\".*$")
+
+  ## Pattern used to parse 'cvlabel -ls' output
+  cvLabelPattern = re.compile("^(\/dev\/.*)\ \[(.*)\] acfs \"(.*)\""
+                    + ".*Controller\#: \'(.*)\' Serial\#: \'(.*)\' "
+                    + "Sectors: (.*)\. SectorSize: (.*?)\.")
+
+  lunIndexes = {}           ## LUN labels, keyed by "serial" and "deviceNode"
+  lunIndexesGeneration = -1 ## plistGeneration our lunIndexes were built for
+
+  cvlabelTimeout = 120            ## Seconds before 'cvlabel -ls' is abandoned
+  cvlabelResult = None            ## 'cvlabel -ls' result queued by queueCollectors()
+  linkUnchangedFiles = True       ## Hard link unchanged files from our latest snapshot
+  snapshotManifestName = ".xsan_manifest.plist"
+  snapshotStats = {}              ## Files linked and copied by our last snapshot
+
+  volumeTopologies = {}           ## Stripe group, node and disk geometry, by volume
+  volumeTopologiesGeneration = -1 ## plistGeneration our topologies were built for
+  metadataStripeGroups = ["MetadataAndJournal","Journal","Metadata"]
+  topologyAliases = ["size","dataLUNCount","metadataLUNCount","metadataSize"]
+  
+  def __init__(self,name="xsan",backupPath=""):
+    '''Our construct'''
+    self.isMetadataController = False
     self.servicesMap = { "xsan" : "Xsan" }
     baseService.__init__(self,name,backupPath)
     self.canPrune = True
     self.debug = False
     self.plist = {}
+    self.lunIndexes = {}
+    self.lunIndexesGeneration = -1
+    self.volumeTopologies = {}
+    self.volumeTopologiesGeneration = -1
+    self.snapshotStats = {}
+    self.cvlabelResult = None
 
   def loadFromPath(self,path):
     """ Loads our object from a specified path. If a file is provided, it will
@@ -955,6 +1939,9 @@ class xsanService(baseService):
             "%s. Error: %s" % (cvLabelFilePath,err),"error")
         loadError = True
 
+    self.plistDidChange()
+    self.checkLUNs()
+    self._buildVolumeTopologies()
     return not loadError
   
   def _loadXsanConfigFromFilePath(self,filePath):
@@ -1077,38 +2064,102 @@ class xsanService(baseService):
       
     self.logger("Loading information from cvlabel output at:%s" % filePath,"debug")
     
+    skippedLines = 0
     cvLabelFH = open(filePath,"r")
-    for row in cvLabelFH:
-      myLun = {}
-      reMatch = re.search("^(\/dev\/.*)\ \[(.*)\] acfs \"(.*)\""
-                    + ".*Controller\#: \'(.*)\' Serial\#: \'(.*)\' "
-                    + "Sectors: (.*)\. SectorSize: (.*?)\.",row)
-      myLun["deviceNode"] = reMatch.groups()[0]
-      myLun["deviceType"] = reMatch.groups()[1]
-      lunLabel = reMatch.groups()[2]
-      myLun["label"] = lunLabel      
-      myLun["controller"] = reMatch.groups()[3]
-      myLun["serial"] = reMatch.groups()[4]
-      myLun["sectors"] = int(reMatch.groups()[5])
-      myLun["sectorSize"] = int(reMatch.groups()[6])
-      myLun["size"] = myLun["sectors"] * myLun["sectorSize"]
-      if lunLabel in LUNlist:
-        self.logger("LUN with label: %s has already been defined" % lunLabel,"debug")
-        try:
-          for key,value in myLun:
+    try:
+      for myLun in self._parseCVLabelOutput(cvLabelFH):
+        if not myLun:
+          skippedLines += 1
+          continue
+        lunLabel = myLun["label"]
+        if lunLabel in LUNlist:
+          self.logger("LUN with label: %s has already been defined" % lunLabel,"debug")
+          for key,value in myLun.iteritems():
             if key in LUNlist[lunLabel] and not LUNlist[lunLabel][key] == value:
               self.logger("LUN with label: %s has already had key: %s set to value: %s, changing to %s" % (lunLabel,key,LUNlist[lunLabel][key],value),"warning")
             LUNlist[lunLabel][key] = value
-        except:
-          self.logger("Error readining myLun:%s" % myLun,"warning")
-          
-      else:
-        LUNlist[lunLabel] = myLun
+        else:
+          LUNlist[lunLabel] = myLun
+    finally:
+      cvLabelFH.close()
+
+    if skippedLines:
+      self.logger("_loadXsanCVLabelFromFilePath() Skipped %s unrecognized "
+                  "lines in file:%s" % (skippedLines,filePath),"detailed")
       
-    
     self.plist["LUNs"] = LUNlist
     return True
       
+  def _parseCVLabelOutput(self,fileHandle):
+    """Generator which reads 'cvlabel -ls' output lines from fileHandle and
+    yields a LUN dictionary for each labeled device, or None for any line 
+    which could not be parsed"""
+
+    cvLabelMatch = self.cvLabelPattern.match
+
+    for row in fileHandle:
+      reMatch = None
+      if row.startswith("/dev/"):
+        reMatch = cvLabelMatch(row)
+      if not reMatch:
+        yield None
+        continue
+      deviceNode,deviceType,lunLabel,controller,serial,sectors,sectorSize = reMatch.groups()
+      if not sectors.isdigit() or not sectorSize.isdigit():
+        yield None
+        continue
+      myLun = {}
+      myLun["deviceNode"] = deviceNode
+      myLun["deviceType"] = deviceType
+      myLun["label"] = lunLabel
+      myLun["controller"] = controller
+      myLun["serial"] = serial
+      myLun["sectors"] = int(sectors)
+      myLun["sectorSize"] = int(sectorSize)
+      myLun["size"] = myLun["sectors"] * myLun["sectorSize"]
+      yield myLun
+
+  def lunForLabel(self,label):
+    """Returns the LUN dictionary for label, or None if no such LUN was
+    found in our cvlabel output"""
+    if "LUNs" in self.plist:
+      return self.plist["LUNs"].get(label)
+    return None
+
+  def duplicateLUNs(self,key="serial"):
+    """Returns a dictionary of LUN labels, keyed by serial (or deviceNode, 
+    see _lunIndex()), for each value reported by more than one LUN"""
+    duplicates = {}
+    for value,labels in self._lunIndex(key).iteritems():
+      if len(labels) > 1:
+        duplicates[value] = labels
+    return duplicates
+
+  def checkLUNs(self):
+    """Logs a warning for each serial or device node reported by more than
+    one LUN label. Returns the number of duplicates found"""
+    duplicateCount = 0
+    for key in ("serial","deviceNode"):
+      for value,labels in sorted(self.duplicateLUNs(key).iteritems()):
+        self.logger("LUNs: %s report the same %s: %s" % (", ".join(labels),key,value),"warning")
+        duplicateCount += 1
+    return duplicateCount
+
+  def _lunIndex(self,key):
+    """Returns our index of LUN labels by key ("serial" or "deviceNode"),
+    rebuilding our indexes if our plist has changed since they were built"""
+
+    if not self.lunIndexesGeneration == self.plistGeneration:
+      self.lunIndexes = {"serial" : {}, "deviceNode" : {}}
+      if "LUNs" in self.plist:
+        for lunLabel in sorted(self.plist["LUNs"].keys()):
+          myLun = self.plist["LUNs"][lunLabel]
+          for indexKey,index in self.lunIndexes.iteritems():
+            if indexKey in myLun:
+              index.setdefault(myLun[indexKey],[]).append(lunLabel)
+      self.lunIndexesGeneration = self.plistGeneration
+    return self.lunIndexes[key]
+
   def _loadXsanVolumeConfigFromFilePath(self,filePath):
     """Loads data into our local plist var based upon the specified
     Xsan volume.cfg files found at filePath. This function will also read in 
@@ -1131,59 +2182,84 @@ class xsanService(baseService):
     myVolumeData["volumeName"] = volumeName
 
     ## Read the volume.cfg file
-    cvLabelFH = open(filePath,"r")
     currentSection = myVolumeData["global"]
-    for row in cvLabelFH:
-      myLun = {}
-      
-      ''' Do a search for new section header [StripeGroup "test"], if found
-      iterate currentSection ( == i.e.  myVolumeData["global"] 
-                                      or ["StripeGroup"]["test"])
-      '''
-      sectionMatch = re.search("^\[(.*?)\s*?\"(.*?)\"\]",row)
-      try:
-        sectionGroup = sectionMatch.groups()[0]
-        sectionName = sectionMatch.groups()[1]
-        if not sectionGroup in myVolumeData:
-          myVolumeData[sectionGroup] = {}
-        if not sectionName in myVolumeData[sectionGroup]:
-          myVolumeData[sectionGroup][sectionName] = {}
-        ## iterate currentSection, as mentioned
-        currentSection = myVolumeData[sectionGroup][sectionName]
-        continue
-      except:
-        pass
-      
-      ## Do a search for non-commented key value pairs   
-      try:
-        reMatch = re.search("^([^\#].*?)\s{1,4}(.*)$",row)
-        key = reMatch.groups()[0]
-        value = reMatch.groups()[1]
-        ## add them to currentSection
-        if key == "Node":
-          if not key in currentSection:
-            currentSection[key] = []
-          reMatch = re.search("^\"(.*?)\".*$",value)
-          nodeName = reMatch.groups()[0]
-          currentSection[key].append(nodeName)
+    skippedLines = 0
+    cfgFH = open(filePath,"r")
+    try:
+      for token in self._tokenizeXsanVolumeConfig(cfgFH):
+        tokenType = token[0]
+        if tokenType == "value":
+          currentSection[token[1]] = token[2]
+        elif tokenType == "node":
+          if not "Node" in currentSection:
+            currentSection["Node"] = []
+          if token[1] is None or not type(currentSection["Node"]) == type([]):
+            skippedLines += 1
+          else:
+            currentSection["Node"].append(token[1])
+        elif tokenType == "section":
+          ## New section header [StripeGroup "test"], iterate currentSection 
+          ## ( == i.e.  myVolumeData["global"] or ["StripeGroup"]["test"])
+          sectionGroup,sectionName = token[1],token[2]
+          if not sectionGroup in myVolumeData:
+            myVolumeData[sectionGroup] = {}
+          if not sectionName in myVolumeData[sectionGroup]:
+            myVolumeData[sectionGroup][sectionName] = {}
+          currentSection = myVolumeData[sectionGroup][sectionName]
         else:
-          currentSection[key] = value
-        
-            
-      except:
-        self.logger("_loadXsanVolumeConfigFromFilePath() Skipping line:\n%s" 
-                    % row ,"debug")
+          skippedLines += 1
+    finally:
+      cfgFH.close()
+
+    if skippedLines:
+      self.logger("_loadXsanVolumeConfigFromFilePath() Skipped %s comment or "
+                  "unrecognized lines in file:%s" % (skippedLines,filePath),"debug")
     
     if not volumeName in volumeList:
       volumeList[volumeName] = myVolumeData
     else:
-      self.logger("Volume with name: %s already defined, merging records","detailed")
+      self.logger("Volume with name: %s already defined, merging records" % volumeName,"detailed")
       myNewVolumeData = self.mergeTrees(myVolumeData,volumeList[volumeName])
       volumeList[volumeName] = myNewVolumeData
     
     return volumeList[volumeName]
       
  
+  def _tokenizeXsanVolumeConfig(self,fileHandle):
+    """Generator which reads volume.cfg lines from fileHandle and yields a 
+    tuple for each line:
+      ("section",sectionGroup,sectionName) for section headers
+      ("node",nodeName) for Node entries, nodeName is None if unquoted
+      ("value",key,value) for all other key value pairs
+      ("skip",line) for comments and unrecognized lines"""
+
+    sectionMatch = self.cfgSectionPattern.match
+    valueMatch = self.cfgValuePattern.match
+    nodeMatch = self.cfgNodePattern.match
+
+    for row in fileHandle:
+      firstChar = row[:1]
+      if firstChar == "[":
+        reMatch = sectionMatch(row)
+        if reMatch:
+          yield ("section",reMatch.group(1),reMatch.group(2))
+          continue
+      elif firstChar == "#" or not firstChar:
+        yield ("skip",row)
+        continue
+
+      reMatch = valueMatch(row)
+      if not reMatch:
+        yield ("skip",row)
+      elif reMatch.group(1) == "Node":
+        nodeName = nodeMatch(reMatch.group(2))
+        if nodeName:
+          yield ("node",nodeName.group(1))
+        else:
+          yield ("node",None)
+      else:
+        yield ("value",reMatch.group(1),reMatch.group(2))
+ 
   def _loadXsanVolumeAuxDataFromFilePath(self,filePath):
     """Loads data into our local plist var based upon the specified
     Xsan volume-auxdata.plist file found at filePath.
@@ -1230,140 +2306,200 @@ class xsanService(baseService):
     """Returns total volume size for passed volume name. We determine this by
     analyzing the volume configuration and aggregating any LUNs defined as nodes
     in non-metadata and journal stripe groups"""
-    ## calculate the size from the volume configuration
-    
-    self.logger("_calculateVolumeSize() calculating size for volume:'%s'"%volumeName)
-    
-    dataNodes = []
-    LUNs = {}
 
-    ## Get our stripegroup nodes.
-    try:
-      stripeGroups = self.valueForKeyPath("Volumes.%s.StripeGroup" % volumeName)
-      for stripeGroupName,stripeGroupData in stripeGroups.iteritems():
-        if (stripeGroupName == "MetadataAndJournal"
-          or stripeGroupName == "Journal"
-          or stripeGroupName == "Metadata"):
-            continue
-        if "Node" in stripeGroupData:
-          for node in stripeGroupData["Node"]:
-            self.logger("Found node:%s for stripegroup:%s" % (node,stripeGroupName))
-            dataNodes.append(node)
-            if not node in LUNs:
-              LUNs[node] = {'label':node}
-      
-      for node in dataNodes:
-        disks = self.valueForKeyPath("Volumes.%s.Disk" % volumeName)
-        if not node in disks:
-          self.logger("Could not find disktype for node:'%s'" % node,"error")
-        self.logger("Found disktype:'%s' for node:'%s'" % (disks[node]["Type"],node),"error")
-        myLun = LUNs[node]
-        diskType = disks[node]["Type"].strip("\"")
-        myLun["Type"] = diskType
-        diskType = self.valueForKeyPath("Volumes.%s.DiskType" % volumeName)
-        myLun["sectorSize"] = diskType[node]["SectorSize"]
-        myLun["sectors"] = diskType[node]["Sectors"]
-        myLun["size"] =  myLun["sectors"] * myLun["sectorSize"]
+    return self.volumeTopology(volumeName)["size"]
 
-    except Exception,err:
-      self.logger("Could not load LUN information for volume:'%s' Error:%s" % (volumeName,err),"error")
-      raise RuntimeError(self.lastError)
+  def volumeTopology(self,volumeName):
+    """Returns the topology of volumeName, as built by 
+    _buildVolumeTopologies(). Raises RuntimeError if the volume does not exist,
+    or if any of its nodes could not be resolved to a disk type geometry"""
 
-    volumeSize = 0
-    try:
-      for label,lun in LUNs.iteritems():
-        volumeSize += lun["size"]
-    except:
-      self.logger("Error calculating size for volume:'%s'" % volumeName,"error")
+    if not self.volumeTopologiesGeneration == self.plistGeneration:
+      self._buildVolumeTopologies()
+
+    if not volumeName in self.volumeTopologies:
+      raise RuntimeError("Volume: %s does not exist!" % volumeName)
+    topology = self.volumeTopologies[volumeName]
+    if topology["missingNodes"]:
+      self.logger("Could not load LUN information for volume:'%s' nodes:%s" 
+                    % (volumeName,", ".join(topology["missingNodes"])),"error")
       raise RuntimeError(self.lastError)
+    return topology
+
+  def _buildVolumeTopologies(self):
+    """Indexes each of our volumes' stripe groups, nodes and disk types, 
+    stored at self.volumeTopologies[volumeName] as a dictionary:
+      stripeGroups      { stripeGroupName : { "nodes" : [], "metadata" : bool } }
+      nodes             { node : { "stripeGroup", "diskType", "sectors", 
+                                   "sectorSize", "size" } }
+      diskTypes         { diskType : { "sectors", "sectorSize", "size" } }
+      dataNodes,metadataNodes,missingNodes  lists of node names
+      missingLUNs       list of node names with no LUN in our cvlabel output
+      size,dataLUNCount,metadataLUNCount,metadataSize  aggregate figures
+    Data figures exclude nodes in metadata and journal stripe groups. Our 
+    topologies are rebuilt whenever our plist changes"""
+
+    self.volumeTopologies = {}
+    self.volumeTopologiesGeneration = self.plistGeneration
+    if not "Volumes" in self.plist:
+      return
+    ## Nodes are only checked against our LUNs if cvlabel output was loaded
+    hasLUNs = bool(self.plist.get("LUNs"))
 
-    return volumeSize
+    for volumeName,volumeData in self.plist["Volumes"].iteritems():
+      if not type(volumeData) == type({}):
+        continue
+      topology = {"stripeGroups" : {}, "nodes" : {}, "diskTypes" : {},
+                  "dataNodes" : [], "metadataNodes" : [], "missingNodes" : [],
+                  "missingLUNs" : [], "size" : 0, "dataLUNCount" : 0, "metadataLUNCount" : 0, 
+                  "metadataSize" : 0}
+
+      ## Disk types to sector geometry
+      for diskTypeName,diskTypeData in volumeData.get("DiskType",{}).iteritems():
+        try:
+          sectors = int(diskTypeData["Sectors"])
+          sectorSize = int(diskTypeData["SectorSize"])
+        except (KeyError,TypeError,ValueError):
+          self.logger("Could not read geometry for disktype:'%s' volume:'%s'"
+                        % (diskTypeName,volumeName),"debug")
+          continue
+        topology["diskTypes"][diskTypeName] = {"sectors" : sectors,
+                                              "sectorSize" : sectorSize,
+                                              "size" : sectors * sectorSize}
+
+      ## Stripe groups to nodes, nodes to disk types
+      disks = volumeData.get("Disk",{})
+      for stripeGroupName in sorted(volumeData.get("StripeGroup",{}).keys()):
+        stripeGroupData = volumeData["StripeGroup"][stripeGroupName]
+        isMetadata = stripeGroupName in self.metadataStripeGroups
+        nodeList = stripeGroupData.get("Node",[])
+        topology["stripeGroups"][stripeGroupName] = {"nodes" : nodeList,
+                                                     "metadata" : isMetadata}
+        for node in nodeList:
+          if node in topology["nodes"]:
+            continue
+          if hasLUNs and self.lunForLabel(node) is None:
+            topology["missingLUNs"].append(node)
+          try:
+            diskType = disks[node]["Type"].strip("\"")
+            geometry = topology["diskTypes"][diskType]
+          except (KeyError,AttributeError):
+            self.logger("Could not find disktype for node:'%s' volume:'%s'"
+                          % (node,volumeName),"debug")
+            topology["missingNodes"].append(node)
+            continue
+          topology["nodes"][node] = {"stripeGroup" : stripeGroupName,
+                                     "diskType" : diskType,
+                                     "sectors" : geometry["sectors"],
+                                     "sectorSize" : geometry["sectorSize"],
+                                     "size" : geometry["size"]}
+          if isMetadata:
+            topology["metadataNodes"].append(node)
+            topology["metadataSize"] += geometry["size"]
+          else:
+            topology["dataNodes"].append(node)
+            topology["size"] += geometry["size"]
+
+      topology["dataLUNCount"] = len(topology["dataNodes"])
+      topology["metadataLUNCount"] = len(topology["metadataNodes"])
+      if topology["missingLUNs"]:
+        self.logger("No LUN was found for volume:'%s' nodes:%s"
+                      % (volumeName,", ".join(topology["missingLUNs"])),"warning")
+      self.volumeTopologies[volumeName] = topology
   
+  def compileKeyPath(self,keyPath):
+    """Returns a keyPathAccessor for keyPath, resolving our volume aliases:
+    'Volumes.<volume>.size', '.dataLUNCount', '.metadataLUNCount' and 
+    '.metadataSize' are read from the volume's topology,
+    'Volumes.<volume>.<key>' and 'Volumes.<volume>.cfg.<keyPath>' are read
+    from the volume's global config, or else from its auxData config"""
+
+    accessor = keyPathAccessor(keyPath)
+    keyArray = [key for key,intKey in accessor.keys]
+    if len(keyArray) < 3 or not keyArray[0] == "Volumes":
+      return accessor
+
+    volumeName = keyArray[1]
+    if len(keyArray) == 3 and keyArray[2] in self.topologyAliases:
+      accessor.aliasName = keyArray[2]
+      accessor.aliasArgument = volumeName
+    elif len(keyArray) == 3 or keyArray[2] == "cfg":
+      if len(keyArray) == 3:
+        configKeyPath = keyArray[2]
+      else:
+        configKeyPath = ".".join(keyArray[3:])
+      accessor.aliasName = "cfg"
+      accessor.aliasArgument = volumeName
+      accessor.aliasAccessors = [
+        keyPathAccessor("Volumes.%s.global.%s" % (volumeName,configKeyPath)),
+        keyPathAccessor("Volumes.%s.auxData.Config.%s" % (volumeName,configKeyPath))]
+    return accessor
+
   def valueForAliasKeyPath(self,keyPath=""):
     """Returns a value for keyPath based upon a specific keyPath alias
     This function primarily serves as an override method for valueForKeyPath
     where manipulation of stored data is replied (concatanation of fields,
     mathematics, etc..."""
-      
-    keyPathArray = keyPath.split(".")
-    if keyPathArray[0] == "Volumes":
-      if len(keyPathArray) == 3:
-        if keyPathArray[2] == "size":
-          volumeName = keyPathArray[1]
-          self.logger("valueForAliasKeyPath(): calculating size for volume:'%s'" % volumeName,"debug")    
-          return self._calculateVolumeSize(volumeName)
-            
-        try:
-          newKeyPath = "Volumes.%s.global.%s" % (keyPathArray[1],keyPathArray[2])
-          theValue = self.valueForKeyPath(newKeyPath)
-        except: 
-          newKeyPath = "Volumes.%s.auxData.Config.%s" % (keyPathArray[1],keyPathArray[2])
-          theValue = self.valueForKeyPath(newKeyPath)
 
-      else:
-        if keyPathArray[2] == "cfg":
-          try:
-            newKeyPath = "Volumes.%s.global.%s" % (keyPathArray[1],
-                                                  ".".join(keyPathArray[3:]))
-            theValue = self.valueForKeyPath(newKeyPath)
-          except:
-            newKeyPath = "Volumes.%s.auxData.Config.%s" % (keyPathArray[1],
-                                                  ".".join(keyPathArray[3:]))
-            theValue = self.valueForKeyPath(newKeyPath)
-
-                                                  
-      self.logger("valueForAliasKeyPath: returning keyPath: %s from keyPath: %s" % (newKeyPath,keyPath),"debug")    
-      return theValue
-    else:
-      raise RuntimeError("No alias for keypath: %s" % keyPath)
+    accessor = self.accessorForKeyPath(keyPath)
+    if accessor.aliasName in self.topologyAliases:
+      return self.volumeTopology(accessor.aliasArgument)[accessor.aliasName]
 
+    for aliasAccessor in accessor.aliasAccessors:
+      try:
+        return aliasAccessor.valueForObject(self.plist)
+      except Exception:
+        continue
+    raise RuntimeError("No alias for keypath: %s" % keyPath)
     
   def valueForKeyPath(self,keyPath):
     """Returns value for key"""
-    
-    try:
-      aliasValue = self.valueForAliasKeyPath(keyPath)
-      return aliasValue
-    except:
-      self.logger("No alias registered for keyPath:%s" % keyPath,"debug")
-      pass
-    
-    keyArray = keyPath.split(".")
-    myPlist = self.plist
-    
-    if len(keyArray) == 0:
-      return myPlist
-    
-    self.logger("valueForKeyPath() hit for keyPath: %s" % keyPath,"debug")
-        
-    dataTypeDict = myPlist
-    currentItem = dataTypeDict
-    
-    self.logger("valueForKeyPath() keyArray len: %s" % len(keyArray),"debug")
 
-    if len(keyArray) == 0:
-      return currentItem
-    
-    for key in keyArray:
-      ## If the current item is an array and our key is not an integer
-      ## then grab the first value
-      self.logger("valueForKeyPath: processing key element: '%s'" % key,"debug")
-      if type(currentItem) == type([]):
+    accessor = self.accessorForKeyPath(keyPath)
+    if accessor.aliasName:
+      try:
+        return self.valueForAliasKeyPath(keyPath)
+      except Exception:
+        pass
+
+    try:
+      return accessor.valueForObject(self.plist)
+    except Exception:
+      ## Todo: restructure this so that we toss an exception if key doesn't exist
+      raise RuntimeError("Keypath: %s does not exist!" % keyPath)
+
+  def valuesForKeyPaths(self,keyPaths):
+    """Returns a list of values, one for each keypath in keyPaths, as 
+    returned by valueForKeyPath(). Aliases are resolved to the accessors 
+    they try, in order, and each round of candidate accessors is resolved
+    in a single pass, sharing traversal of common prefixes"""
+
+    values = [None] * len(keyPaths)
+    candidates = {}
+    for index,keyPath in enumerate(keyPaths):
+      accessor = self.accessorForKeyPath(keyPath)
+      if accessor.aliasName in self.topologyAliases:
         try:
-          intKey = int(key)
-          currentItem = currentItem[intKey]
+          values[index] = self.volumeTopology(accessor.aliasArgument)[accessor.aliasName]
           continue
-        except:
-          currentItem = currentItem[0]
-        
-      try:
-        currentItem = currentItem[key]
-      except Exception, err:
-        ## Todo: restructure this so that we toss an exception if key doesn't exist
-        ##self.logger("Keypath: %s does not exist!" % keyPath,"error")
-        ##self.logger("Exception: %s" % err,"debug")
-        raise RuntimeError("Keypath: %s does not exist!" % keyPath)
-    return currentItem
+        except Exception:
+          candidates[index] = [accessor]
+      else:
+        candidates[index] = accessor.aliasAccessors + [accessor]
+
+    ## Round N resolves the Nth candidate of each unresolved keypath
+    candidateIndex = 0
+    while candidates:
+      pendingIndexes = sorted(candidates.keys())
+      accessors = [candidates[index][candidateIndex] for index in pendingIndexes]
+      for index,(value,err) in zip(pendingIndexes,valuesForAccessors(accessors,self.plist)):
+        if not err:
+          values[index] = value
+          del candidates[index]
+        elif len(candidates[index]) <= candidateIndex + 1:
+          raise RuntimeError("Keypath: %s does not exist!" % keyPaths[index])
+      candidateIndex += 1
+    return values
     
   def getRunningServiceList(self=""):
     if os.path.exists(self.xsanConfigDir):
@@ -1371,6 +2507,221 @@ class xsanService(baseService):
     else:
       return []  
 
+  def _backupItemList(self):
+    """Resolves self.backupPaths into a list of items to back up. Returns
+    a list of (backupItemPath,myDirString,myName,myRelPath) tuples, where
+    myDirString and myName denote the item's location relative to the root
+    of a backup"""
+
+    xsanConfigDir = self.xsanConfigDir
+    itemList = []
+
+    for backupItem in self.backupPaths:
+      self.logger(" - hit backupItem: '%s'" % backupItem,"debug")
+      
+      if backupItem[0:1] == "/":
+        backupItemList = [backupItem]
+      else:
+        backupItemList = glob.glob(os.path.join(xsanConfigDir,backupItem))
+      ## If it's a directory, make sure there's no trailing solodus
+      if backupItem[-1:] == "/":
+          backupItem = backupItem[:-1]
+      
+      for backupItemPath in backupItemList:
+        self.logger("   - file match: '%s'" % backupItemPath,"debug")
+        ## recreate our relative path
+        if backupItemPath[-1:] == "/":
+          backupItemPath = backupItemPath[:-1]
+          
+        myDirString,myName = os.path.split(backupItem)
+        myRelPath = os.path.join(myDirString,myName)
+        if myDirString[0:1] == "/":
+          myDirString = myDirString[1:]
+
+        itemList.append((backupItemPath,myDirString,myName,myRelPath))
+
+    return itemList
+
+  def cvlabelArgList(self):
+    """Returns the argument list used to list our LUN labels"""
+    return [os.path.join(self.xsanConfigDir,"bin/cvlabel"),"-ls"]
+
+  def queueCollectors(self,engine):
+    """Queues 'cvlabel -ls' on the collectionEngine engine, its output is 
+    used by our next backup rather than running cvlabel again"""
+    engine.addCommand(self.cvlabelArgList(),callback=self._cvlabelCollected,
+                        timeout=self.cvlabelTimeout)
+
+  def _cvlabelCollected(self,result):
+    """collectionEngine callback for a queued 'cvlabel -ls'"""
+    self.cvlabelResult = result
+
+  def _cvlabelOutput(self):
+    """Returns the output of 'cvlabel -ls', as collected by 
+    queueCollectors() if available"""
+    argList = self.cvlabelArgList()
+    
+    self.logger("Backing up '%s -ls' output" % argList[0])
+    
+    cvlabelResult = self.cvlabelResult
+    self.cvlabelResult = None
+    if not cvlabelResult:
+      cvlabelResult = runCommand(argList,timeout=self.cvlabelTimeout)
+    if cvlabelResult.timedOut:
+      self.logger("cvlabel timed out after %ss!" % self.cvlabelTimeout,"error")
+      return ""
+    return cvlabelResult.stdout
+
+  def _snapshotItem(self,sourcePath,targetPath,relPath,previousDir,previousManifest,manifest):
+    """Copies the file or directory at sourcePath to targetPath. Any file 
+    which is unchanged since our previous snapshot at previousDir is hard 
+    linked from it instead of being copied. Files are considered unchanged
+    if their size, mtime and inode match those recorded in previousManifest.
+    The source stat of each file is recorded in manifest, keyed by relPath"""
+
+    if not os.path.isdir(sourcePath):
+      self._snapshotFile(sourcePath,targetPath,relPath,previousDir,previousManifest,manifest)
+      return
+
+    copiedDirs = []
+    for dirPath,dirNames,fileNames in os.walk(sourcePath,followlinks=True):
+      dirRelPath = os.path.relpath(dirPath,sourcePath)
+      targetDirPath = os.path.normpath(os.path.join(targetPath,dirRelPath))
+      if not os.path.isdir(targetDirPath):
+        os.makedirs(targetDirPath)
+      for fileName in fileNames:
+        self._snapshotFile(os.path.join(dirPath,fileName),
+                            os.path.join(targetDirPath,fileName),
+                            os.path.normpath(os.path.join(relPath,dirRelPath,fileName)),
+                            previousDir,previousManifest,manifest)
+      copiedDirs.append((dirPath,targetDirPath))
+
+    ## Copy directory attributes last, as populating them changes their mtime
+    for dirPath,targetDirPath in reversed(copiedDirs):
+      shutil.copystat(dirPath,targetDirPath)
+
+  def _snapshotFile(self,sourcePath,targetPath,relPath,previousDir,previousManifest,manifest):
+    """Hard links targetPath to relPath in previousDir if the file at 
+    sourcePath is unchanged, otherwise copies sourcePath to targetPath.
+    See _snapshotItem()"""
+
+    sourceStat = os.stat(sourcePath)
+    sourceInfo = [sourceStat.st_size,sourceStat.st_mtime,sourceStat.st_ino]
+    manifest[relPath] = sourceInfo
+    previousPath = os.path.join(previousDir,relPath)
+
+    isUnchanged = False
+    if previousDir and relPath in previousManifest:
+      isUnchanged = previousManifest[relPath] == sourceInfo
+    elif previousDir and os.path.isfile(previousPath):
+      ## No manifest entry, compare against the copy preserved by copy2()
+      previousStat = os.stat(previousPath)
+      isUnchanged = (previousStat.st_size == sourceStat.st_size
+                    and int(previousStat.st_mtime) == int(sourceStat.st_mtime))
+
+    if isUnchanged and os.path.isfile(previousPath):
+      try:
+        if os.path.lexists(targetPath):
+          os.remove(targetPath)
+        os.link(previousPath,targetPath)
+        self.snapshotStats["linkedFiles"] += 1
+        return
+      except Exception,err:
+        self.logger("Could not link to previous snapshot: %s, copying. Error: %s"
+                      % (previousPath,err),"warning")
+
+    ## Never write through targetPath, which may be linked to an older snapshot
+    if os.path.lexists(targetPath):
+      os.remove(targetPath)
+    shutil.copy2(sourcePath,targetPath)
+    self.snapshotStats["copiedFiles"] += 1
+    self.snapshotStats["copiedBytes"] += sourceStat.st_size
+
+  def _linkUnchangedData(self,data,previousPath,filePath):
+    """Hard links filePath to previousPath if the file at previousPath
+    contains data. Returns True if filePath was linked"""
+
+    if not previousPath or not os.path.isfile(previousPath):
+      return False
+    if not os.path.getsize(previousPath) == len(data):
+      return False
+    previousFH = open(previousPath,"r")
+    try:
+      if not previousFH.read() == data:
+        return False
+    finally:
+      previousFH.close()
+    try:
+      if os.path.lexists(filePath):
+        os.remove(filePath)
+      os.link(previousPath,filePath)
+    except Exception,err:
+      self.logger("Could not link to previous snapshot: %s, writing new copy. Error: %s"
+                    % (previousPath,err),"warning")
+      return False
+    self.snapshotStats["linkedFiles"] += 1
+    return True
+
+  def _readSnapshotManifest(self,snapshotDir):
+    """Returns the manifest stored in snapshotDir, a dictionary of source
+    [size,mtime,inode], keyed by snapshot relative path"""
+
+    manifestPath = os.path.join(snapshotDir,self.snapshotManifestName)
+    if not os.path.isfile(manifestPath):
+      return {}
+    try:
+      return dict(plistlib.readPlist(manifestPath))
+    except Exception,err:
+      self.logger("Could not read snapshot manifest: %s Error: %s" % (manifestPath,err),"warning")
+      return {}
+
+  def _writeSnapshotManifest(self,snapshotDir,manifest):
+    """Writes manifest into snapshotDir, see _readSnapshotManifest()"""
+
+    manifestPath = os.path.join(snapshotDir,self.snapshotManifestName)
+    try:
+      plistlib.writePlist(manifest,manifestPath)
+    except Exception,err:
+      self.logger("Could not write snapshot manifest: %s Error: %s" % (manifestPath,err),"warning")
+
+  def backupToStore(self,store):
+    """Writes our config files and cvlabel output into the blobStore store.
+    Returns a dict mapping relative file paths to stored blob hashes"""
+
+    if not os.path.exists(self.xsanConfigDir):
+      raise RuntimeError("Cannot perform backup: Xsan is not installed!")
+
+    storedFiles = {}
+    startTime = time.time()
+    for backupItemPath,myDirString,myName,myRelPath in self._backupItemList():
+      itemRelPath = os.path.join(myDirString,myName)
+      if not os.path.exists(backupItemPath):
+        self.logger("No file found at '%s'" % backupItemPath,"warning")
+        continue
+      if os.path.isdir(backupItemPath):
+        for dirPath,dirNames,fileNames in os.walk(backupItemPath):
+          for fileName in fileNames:
+            filePath = os.path.join(dirPath,fileName)
+            relPath = os.path.join(itemRelPath,os.path.relpath(filePath,backupItemPath))
+            storedFiles[relPath] = store.putFile(filePath)
+      else:
+        storedFiles[itemRelPath] = store.putFile(backupItemPath)
+    self.recordTiming("write",startTime)
+
+    startTime = time.time()
+    cvlabelOutput = self._cvlabelOutput()
+    self.recordTiming("collect",startTime,len(cvlabelOutput))
+    if cvlabelOutput:
+      if type(cvlabelOutput) == types.UnicodeType:
+        cvlabelOutput = cvlabelOutput.encode("utf-8")
+      startTime = time.time()
+      storedFiles["cvlabel_output.txt"] = store.putData(cvlabelOutput)
+      self.recordTiming("write",startTime,len(cvlabelOutput))
+    else:
+      self.logger("cvlabel produced no output!","error")
+
+    return storedFiles
+
   def backupSettings(self):
     '''Function which performs our backup'''
 
@@ -1425,97 +2776,97 @@ class xsanService(baseService):
         self.logger("backupSettings() failed creating directory:'%s',"
                       "cannot continue!" % backupTargetDir,"error")
         return False
+    self.contentHash = ""
+    self.snapshotFile = backupTargetDir
+    self.snapshotReused = False
+    self.snapshotStats = {"linkedFiles" : 0, "copiedFiles" : 0, "copiedBytes" : 0}
+
+    ## Determine our previous snapshot, unchanged files are linked from it
+    useManifest = self.useTimeStamps and self.linkUnchangedFiles
+    previousDir = ""
+    previousManifest = {}
+    manifest = {}
+    if useManifest:
+      latestDirPath = os.path.join(backupPath,"%s_latest" % baseName)
+      if os.path.isdir(latestDirPath):
+        previousDir = os.path.realpath(latestDirPath)
+      if previousDir == os.path.realpath(backupTargetDir):
+        previousDir = ""
+      if previousDir:
+        previousManifest = self._readSnapshotManifest(previousDir)
     
     ## We have passed sanity checks. 
     self.logger("Backing up %s to '%s'" % (name,backupTargetDir))
     
     ## Iterate through all of our backupPaths and copy them over
-    for backupItem in self.backupPaths:
-      self.logger(" - hit backupItem: '%s'" % backupItem,"debug")
-      
-      if backupItem[0:1] == "/":
-        backupItemList = [backupItem]
-      else:
-        backupItemList = glob.glob(os.path.join(xsanConfigDir,backupItem))
-      ##self.logger(" * matched arrays: '%s'" % backupItemList,"debug")
-      ## If it's a directory, make sure there's no trailing solodus
-      if backupItem[-1:] == "/":
-          backupItem = backupItem[:-1]
-      
+    startTime = time.time()
+    for backupItemPath,myDirString,myName,myRelPath in self._backupItemList():
+      targetItemDir = os.path.join(backupTargetDir,myDirString)
+      targetItemPath = os.path.join(targetItemDir,myName)
+  
+      if not os.path.exists(targetItemDir):
+        try:
+          self.logger("Creating folder: %s" % targetItemDir,"debug")
+          os.makedirs(targetItemDir)
+        except:
+          self.logger("Failed creating directory:'%s',"
+                        "cannot continue!" % targetItemDir,"error")
+          return False
+
+      self.logger("backupTargetDir:%s, myDirString:%s, myName:%s" % (backupTargetDir,myDirString,myName),"debug2")
       
-      for backupItemPath in backupItemList:
-        self.logger("   - file match: '%s'" % backupItemPath,"debug")
-        ## recreate our relative path
-        if backupItemPath[-1:] == "/":
-          backupItemPath = backupItemPath[:-1]
-          
-        itemPathArray = os.path.split(backupItem)
-        
-        if len(itemPathArray) == 1:
-          myDirString = ""
-          myName = itemPathArray[0]
-          myRelPath = myName
-        else:
-          myDirString = itemPathArray[0]
-          myName = itemPathArray[1]
-          
-          if myDirString[0:1] == "/":
-            myRelPath = os.path.join(myDirString,myName)
-            myDirString = myDirString[1:]
+      if os.path.exists(backupItemPath):
+        self.logger("Backing up %s" % myRelPath,"detailed")
+        try:
+          itemRelPath = os.path.join(myDirString,myName)
+          if useManifest:
+            self._snapshotItem(backupItemPath,targetItemPath,itemRelPath,
+                                previousDir,previousManifest,manifest)
+          elif os.path.isdir(backupItemPath):
+            shutil.copytree(backupItemPath,targetItemPath)
           else:
-            myRelPath = os.path.join(myDirString,myName)
-
+            if os.path.lexists(targetItemPath):
+              os.remove(targetItemPath)
+            shutil.copy2(backupItemPath,targetItemPath)
+          self.logger(" - Finished","detailed")
 
-        targetItemDir = os.path.join(backupTargetDir,myDirString)
-        targetItemPath = os.path.join(targetItemDir,myName)
-    
-        if not os.path.exists(targetItemDir):
-          try:
-            self.logger("Creating folder: %s" % targetItemDir,"debug")
-            os.makedirs(targetItemDir)
-          except:
-            self.logger("Failed creating directory:'%s',"
-                          "cannot continue!" % targetItemDir,"error")
-            return False
-
-        self.logger("backupTargetDir:%s, myDirString:%s, myName:%s" % (backupTargetDir,myDirString,myName),"debug2")
-        
-        if os.path.exists(backupItemPath):
-          self.logger("Backing up %s" % myRelPath,"detailed")
-          try:
-            if os.path.isdir(backupItemPath):
-              shutil.copytree(backupItemPath,targetItemPath)
-            else:
-              shutil.copy2(backupItemPath,targetItemPath)
-            self.logger(" - Finished","detailed")
-
-          except Exception, err:
-            self.logger("An error occurred copying '%s' to '%s'. Error: %s" % (backupItemPath,targetItemPath,err),"error")
-            errorOccured = True
-          
-        else:
-          self.logger("No file found at '%s'" % backupItemPath,"warning")
+        except Exception, err:
+          self.logger("An error occurred copying '%s' to '%s'. Error: %s" % (backupItemPath,targetItemPath,err),"error")
           errorOccured = True
+        
+      else:
+        self.logger("No file found at '%s'" % backupItemPath,"warning")
+        errorOccured = True
 
-          
-          
+    self.recordTiming("write",startTime,self.snapshotStats["copiedBytes"])
 
     ## Perform our ad-hoc backups, get a cvlabel -l output
-    cvlabelPath = os.path.join(self.xsanConfigDir,"bin/cvlabel")
-    cvlabelCMDString = "%s -ls" % cvlabelPath
-    
-    self.logger("Backing up '%s' output" % cvlabelCMDString)
-    
-    cvlabelCMD = subprocess.Popen(cvlabelCMDString,shell=True,stdout=subprocess.PIPE,universal_newlines=True)
-    cvlabelCMD_STDOUT, cvlabelCMD_STDERR = cvlabelCMD.communicate()
+    startTime = time.time()
+    cvlabelCMD_STDOUT = self._cvlabelOutput()
+    self.recordTiming("collect",startTime,len(cvlabelCMD_STDOUT))
     
     cvlabelDidWrite = False
     if cvlabelCMD_STDOUT:
       try:
         cvlabelFilePath = os.path.join(backupTargetDir,"cvlabel_output.txt")
-        cvlabelFH = codecs.open(cvlabelFilePath,"w","utf-8")
-        cvlabelFH.write(cvlabelCMD_STDOUT)
-        cvlabelFH.close()
+        if type(cvlabelCMD_STDOUT) == types.UnicodeType:
+          cvlabelData = cvlabelCMD_STDOUT.encode("utf-8")
+        else:
+          cvlabelData = cvlabelCMD_STDOUT
+        previousCVLabelPath = ""
+        if previousDir:
+          previousCVLabelPath = os.path.join(previousDir,"cvlabel_output.txt")
+        startTime = time.time()
+        if not self._linkUnchangedData(cvlabelData,previousCVLabelPath,cvlabelFilePath):
+          ## Our output may be linked to an older snapshot's, replace it
+          if os.path.lexists(cvlabelFilePath):
+            os.remove(cvlabelFilePath)
+          cvlabelFH = open(cvlabelFilePath,"w")
+          cvlabelFH.write(cvlabelData)
+          cvlabelFH.close()
+          self.snapshotStats["copiedFiles"] += 1
+          self.snapshotStats["copiedBytes"] += len(cvlabelData)
+          self.recordTiming("write",startTime,len(cvlabelData))
         cvlabelDidWrite = True
       except Exception, err:
         self.logger("An error occured writing cvlabel output! Error:%s" % err,"debug")
@@ -1523,6 +2874,13 @@ class xsanService(baseService):
     else:
       self.logger("cvlabel produced no output!","error")
       errorOccured = True
+
+    if useManifest:
+      self._writeSnapshotManifest(backupTargetDir,manifest)
+    if previousDir:
+      self.logger("Snapshot linked %s unchanged files, copied %s files (%s bytes)"
+                    % (self.snapshotStats["linkedFiles"],self.snapshotStats["copiedFiles"],
+                    self.snapshotStats["copiedBytes"]),"detailed")
     
     ## Create a symlink for our latest file
     if self.useTimeStamps:
@@ -1575,6 +2933,24 @@ class systemProfilerService(baseService):
                         "SPSoftwareDataType"
                         ]
   
+  collectorJobs = 4        ## Number of concurrent system_profiler collectors
+  collectorTimeout = 120   ## Seconds before a data type collector is abandoned
+  dataTypeTimeouts = {"SPAirPortDataType" : 30}  ## Per data type overrides
+
+  useCache = True          ## Reuse cached data types which have not expired
+  cachePath = ""           ## Path to our data type cache, see getCachePath()
+  cacheVersion = 2         ## Format version of our data type cache
+  cacheTTL = 0             ## Seconds a data type is cached for, 0 to disable
+  dataTypeTTLs = {"SPHardwareDataType" : 86400,  ## Per data type overrides
+                  "SPMemoryDataType" : 86400,
+                  "SPPCIDataType" : 86400,
+                  "SPSASDataType" : 86400,
+                  "SPNetworkDataType" : 900}
+  cacheHits = []           ## Data types loaded from our cache by our last load()
+
+  dataTypeIndex = {}            ## Data type dictionaries in our plist, by _dataType
+  dataTypeIndexGeneration = -1  ## plistGeneration our dataTypeIndex was built for
+  collection = {}               ## State of our in-progress collection
   
   isMetadataController = False
   
@@ -1585,6 +2961,11 @@ class systemProfilerService(baseService):
     baseService.__init__(self,name,backupPath)
     self.plist = []
     self.canPrune = True
+    self.cachePath = ""
+    self.cacheHits = []
+    self.dataTypeIndex = {}
+    self.dataTypeIndexGeneration = -1
+    self.collection = {}
 
   def loadFromPath(self,path):
     """ Loads our object from a specified path. If a file is provided, it will
@@ -1601,19 +2982,22 @@ class systemProfilerService(baseService):
     if os.path.isfile(path):
       return self.loadFromFile(filePath=path)
     
+    ## Look for our latest file directly before resorting to a directory scan
+    baseName = self.baseName
+    if not baseName:
+      baseName = name
+    for fileName in ("%s_latest.plist" % baseName,"latest.plist"):
+      filePath = os.path.join(path,fileName)
+      if os.path.isfile(filePath):
+        return self.loadFromFile(filePath=filePath)
+
     plistFileList = glob.glob(os.path.join(path, "*.plist"))
     if len(plistFileList) == 0:
       self.logger("No plist files could be found at path: '%s', cannot continue!" % path,"error")
       return False
-    for file in plistFileList:
-      filePath = file
-      fileName = os.path.splitext(file)
-      if fileName == "%s_latest.plist" % self.name or fileName == "latest.plist":
-        break
-      elif fileName == "sa_global.plist":
-        break
 
-    return self.loadFromFile(filePath=filePath)
+    ## Timestamped file names sort chronologically, use the newest
+    return self.loadFromFile(filePath=max(plistFileList))
     
   def loadFromFile(self,filePath):
     """ Loads our object from serveradmin """
@@ -1637,60 +3021,326 @@ class systemProfilerService(baseService):
        
     if len(plist) > 0:
       self.plist = plist
+      self.plistDidChange()
       self.isLoaded = True
 
     return True
 
-  def valueForKeyPath(self,keyPath):
-    """Returns value for key"""
-    
+  def load(self):
+    """Loads our object by running system_profiler for each of our 
+    systemProfilerDataTypes. Up to self.collectorJobs data types are 
+    collected concurrently, our plist retains systemProfilerDataTypes order.
+    Data types cached within their TTL (see ttlForDataType()) are reused
+    rather than collected, and are noted in self.cacheHits"""
+
+    pendingDataTypes = self.prepareCollection()
+    results = runConcurrentJobs(self.collectDataType,pendingDataTypes,
+                                  maxJobs=self.collectorJobs)
+    for dataType,(plistObj,err) in zip(pendingDataTypes,results):
+      if err:
+        self.logger("system_profiler: failed collecting data type: '%s' Error: %s"
+                      % (dataType,err),"error")
+      else:
+        self.collectedDataType(dataType,plistObj)
+    return self.finishCollection()
+
+  def prepareCollection(self):
+    """Begins a collection of our data types, loading those which are
+    cached within their TTL. Returns the list of data types which must be
+    collected, results are passed to collectedDataType() and the collection
+    completed by finishCollection()"""
+
+    pendingDataTypes = []
+    self.cacheHits = []
+    self.collection = {"cache" : {}, "time" : time.time(), "dataTypes" : {},
+                        "bytes" : {}}
+
+    ## Determine which of our data types can be read from our cache
+    if self.useCache and not self.getCachePath():
+      self.logger("Not caching data types: no backup path is set (i.e. --layout=store)","detailed")
+    elif self.useCache:
+      self.collection["cache"] = self.readCache()
+    cache = self.collection["cache"]
+    now = self.collection["time"]
+    for dataType in self.systemProfilerDataTypes:
+      cacheEntry = cache.get(dataType)
+      ttl = self.ttlForDataType(dataType)
+      if cacheEntry and 0 <= now - cacheEntry["time"] < ttl:
+        self.logger(" - Using cached data type: '%s'" % dataType,"detailed")
+        self.collection["dataTypes"][dataType] = cacheEntry["plist"]
+        self.cacheHits.append(dataType)
+      else:
+        pendingDataTypes.append(dataType)
+
+    return pendingDataTypes
+
+  def collectedDataType(self,dataType,plistObj):
+    """Records plistObj as the collected dictionary for dataType in our
+    current collection, see prepareCollection()"""
+
+    if not plistObj:
+      return
+    self.collection["dataTypes"][dataType] = plistObj
+    if self.ttlForDataType(dataType) > 0:
+      self.collection["cache"][dataType] = {"time" : self.collection["time"],
+                                              "plist" : plistObj}
+
+  def finishCollection(self):
+    """Completes our current collection, our plist is assembled in 
+    systemProfilerDataTypes order and our cache updated"""
+
+    profilerPlistObj = []
+    dataTypePlists = self.collection["dataTypes"]
+    for dataType in self.systemProfilerDataTypes:
+      if dataType in dataTypePlists:
+        profilerPlistObj.append(dataTypePlists[dataType])
+
+    if self.useCache and len(self.cacheHits) < len(self.systemProfilerDataTypes):
+      self.writeCache(self.collection["cache"])
+    self.recordTiming("collect",self.collection["time"],
+                        sum(self.collection["bytes"].values()))
+    self.collection = {}
+          
+    self.plist = profilerPlistObj
+    self.plistDidChange()
+    self.isLoaded = True
+    return True
+
+  def queueCollectors(self,engine):
+    """Begins a collection and queues a system_profiler command on the
+    collectionEngine engine for each data type which must be collected.
+    finishCollection() should be called once engine has run"""
+
+    for dataType in self.prepareCollection():
+      self.logger(" - Queueing data type: '%s'" % dataType,"detailed")
+      engine.addCommand(self.argListForDataType(dataType),
+                          callback=self._collectorFinished,
+                          timeout=self.timeoutForDataType(dataType),
+                          spoolSize=commandSpoolSize)
+
+  def _collectorFinished(self,result):
+    """collectionEngine callback for a queued data type collector"""
+    dataType = result.argList[-1]
     try:
-      aliasValue = valueForKeyPath(keyPath)
-      return aliasValue
-    except:
-      self.logger("No alias registered for keyPath:%s" % keyPath,"debug")
-      pass
-    
-    keyArray = keyPath.split(".")
-    myPlist = self.plist
-    
-    if len(keyArray) == 0:
-      return myPlist
-    
-    self.logger("valueForKeyPath() hit for keyPath: %s" % keyPath,"debug")
-    
-    dataTypeName = keyArray.pop(0)
+      plistObj = self.dataTypeFromResult(dataType,result)
+    except Exception,err:
+      self.logger("system_profiler: failed collecting data type: '%s' Error: %s"
+                    % (dataType,err),"error")
+      return
+    self.collectedDataType(dataType,plistObj)
+
+  def itemsForDataType(self,dataType):
+    """Returns the _items array for dataType from our loaded profile, or 
+    None if dataType was not collected"""
+
+    if not self.dataTypeIndexGeneration == self.plistGeneration:
+      self._buildDataTypeIndex()
+    if not dataType in self.dataTypeIndex:
+      return None
+    return self.dataTypeIndex[dataType].get("_items")
+
+  def _buildDataTypeIndex(self):
+    """Indexes the data type dictionaries in our plist by their _dataType.
+    Any dictionary lacking a _dataType is indexed by its position in 
+    systemProfilerDataTypes, provided that no data types are missing"""
+
+    self.dataTypeIndex = {}
+    self.dataTypeIndexGeneration = self.plistGeneration
+    if not isinstance(self.plist,list):
+      return
+
+    isComplete = len(self.plist) == len(self.systemProfilerDataTypes)
+    for position,dataTypeDict in enumerate(self.plist):
+      ## plistlib returns dict subclasses
+      if not isinstance(dataTypeDict,dict):
+        continue
+      if "_dataType" in dataTypeDict:
+        dataType = dataTypeDict["_dataType"]
+      elif isComplete:
+        dataType = self.systemProfilerDataTypes[position]
+      else:
+        self.logger("Could not determine data type of profile entry: %s" % position,"debug")
+        continue
+      if not dataType in self.dataTypeIndex:
+        self.dataTypeIndex[dataType] = dataTypeDict
+
+  def ttlForDataType(self,dataType):
+    """Returns the number of seconds collected dataType output is cached for"""
+    return self.dataTypeTTLs.get(dataType,self.cacheTTL)
+
+  def getCachePath(self):
+    """Returns the path to our data type cache file, stored alongside our 
+    backups. Returns an empty string if we have no backupPath"""
+    if self.cachePath:
+      return self.cachePath
+    if self.backupPath:
+      return os.path.join(self.backupPath,".%s_cache" % self.baseName)
+    return ""
+
+  def readCache(self):
+    """Reads our data type cache from disk. Returns a dictionary, keyed by
+    data type, of collection times and data type dictionaries"""
+
+    cachePath = self.getCachePath()
+    if not cachePath or not os.path.isfile(cachePath):
+      return {}
     try:
-      dataTypeIndex = int(self.systemProfilerDataTypes.index(dataTypeName))
-    except:
+      cacheData = plistlib.readPlist(cachePath)
+    except Exception,err:
+      self.logger("Could not read data type cache at: %s Error: %s" % (cachePath,err),"warning")
+      return {}
+
+    if not isinstance(cacheData,dict) or not cacheData.get("version") == self.cacheVersion \
+        or not isinstance(cacheData.get("dataTypes"),dict):
+      self.logger("Ignoring data type cache at: %s, unknown format" % cachePath,"warning")
+      return {}
+
+    dataTypes = {}
+    for dataType,cacheEntry in cacheData["dataTypes"].iteritems():
+      if not isinstance(cacheEntry,dict) \
+          or not isinstance(cacheEntry.get("time"),(int,long,float)) \
+          or not isinstance(cacheEntry.get("plist"),dict):
+        self.logger("Ignoring malformed cache entry for data type: %s" % dataType,"warning")
+        continue
+      dataTypes[dataType] = cacheEntry
+    return dataTypes
+
+  def writeCache(self,dataTypes):
+    """Writes dataTypes, as returned by readCache(), to our data type cache.
+    Entries for data types which are no longer cached are discarded"""
+
+    cachePath = self.getCachePath()
+    if not cachePath or not os.path.isdir(os.path.dirname(cachePath)):
+      return False
+
+    cachedDataTypes = {}
+    for dataType,cacheEntry in dataTypes.iteritems():
+      if dataType in self.systemProfilerDataTypes and self.ttlForDataType(dataType) > 0:
+        cachedDataTypes[dataType] = cacheEntry
+
+    try:
+      cacheFD,tempPath = tempfile.mkstemp(prefix=".%s_cache." % self.baseName,
+                                            dir=os.path.dirname(cachePath))
+      cacheFH = os.fdopen(cacheFD,"w")
+      try:
+        plistlib.writePlist({"version" : self.cacheVersion, "dataTypes" : cachedDataTypes},cacheFH)
+      finally:
+        cacheFH.close()
+      os.rename(tempPath,cachePath)
+    except Exception,err:
+      self.logger("Could not write data type cache at: %s Error: %s" % (cachePath,err),"warning")
+      return False
+    return True
+
+  def timeoutForDataType(self,dataType):
+    """Returns the number of seconds dataType may be collected for"""
+    return self.dataTypeTimeouts.get(dataType,self.collectorTimeout)
+
+  def argListForDataType(self,dataType):
+    """Returns the system_profiler argument list used to collect dataType"""
+    return [self.systemProfilerCMDPath,"-xml",dataType]
+
+  def collectDataType(self,dataType):
+    """Runs system_profiler for dataType, returns the resulting data type
+    dictionary, or None if no data was returned or the command timed out"""
+
+    self.logger(" - Processing data type: '%s'" % dataType,"detailed")
+    argList = self.argListForDataType(dataType)
+    self.logger("    - Running Command:'%s' " % " ".join(argList),"debug")
+
+    result = runCommand(argList,timeout=self.timeoutForDataType(dataType),
+                          spoolSize=commandSpoolSize)
+    return self.dataTypeFromResult(dataType,result)
+
+  def dataTypeFromResult(self,dataType,result):
+    """Returns the data type dictionary from the system_profiler 
+    commandResult result, or None if no data was returned or the command 
+    timed out. Any spooled output of result is removed"""
+
+    ## Note our output size, data types are collected on separate threads
+    if "bytes" in self.collection:
+      self.collection["bytes"][dataType] = result.stdoutBytes
+    if result.timedOut:
+      self.logger("system_profiler: data type: '%s' timed out after %ss, skipping!"
+                    % (dataType,self.timeoutForDataType(dataType)),"warning")
+      result.cleanup()
+      return None
+    if not result.stdoutBytes:
+      result.cleanup()
+      return None
+
+    ## Create a plist object from our output.
+    try:
+      plistObj = plistlib.readPlist(result.openStdout())
+    finally:
+      result.cleanup()
+    if not plistObj:
+      return None
+    return plistObj[0]
+
+  def backupToStore(self,store):
+    """Writes our system profile into the blobStore store. Returns a dict
+    mapping our backup file name to the stored blob hash"""
+    if not self.isLoaded:
+      self.load()
+
+    startTime = time.time()
+    plistData = plistlib.writePlistToString(self.plist)
+    self.recordTiming("serialize",startTime,len(plistData))
+    startTime = time.time()
+    self.contentHash = store.putData(plistData)
+    self.recordTiming("write",startTime,len(plistData))
+    self.snapshotFile = store.pathForHash(self.contentHash)
+    return { "%s.plist" % self.baseName : self.contentHash }
+
+  def valueForKeyPath(self,keyPath):
+    """Returns value for key. The first element of keyPath is the system
+    profiler datatype (i.e. SPHardwareDataType)"""
+
+    accessor = self.accessorForKeyPath(keyPath)
+    
+    dataTypeName = keyPath.split(".",1)[0]
+    dataTypeDict = self.itemsForDataType(dataTypeName)
+    if dataTypeDict is None:
       self.logger("Datatype: %s does not exist!" % dataTypeName,"error")
       return False
         
-    dataTypeDict = myPlist[dataTypeIndex]["_items"]
-    currentItem = dataTypeDict
-    
-    if len(keyArray) == 0:
-      return currentItem
-    
-    for key in keyArray:
-      ## If the current item is an array and our key is not an integer
-      ## then grab the first value
-      self.logger("valueForKeyPath: processing key element: '%s'" % key,"debug")
-      if type(currentItem) == type([]):
-        try:
-          intKey = int(key)
-          currentItem = currentItem[intKey]
+    try:
+      return accessor.valueForObject(dataTypeDict,startIndex=1)
+    except Exception, err:
+      self.logger("Keypath: %s does not exist!" % keyPath,"error")
+      self.logger("Exception: %s" % err,"debug")
+      return False
+
+  def valuesForKeyPaths(self,keyPaths):
+    """Returns a list of values, one for each keypath in keyPaths, as 
+    returned by valueForKeyPath(). Keypaths are grouped by datatype and 
+    shared keypath prefixes are only traversed once"""
+
+    values = [False] * len(keyPaths)
+    dataTypeIndexes = {}
+    dataTypeOrder = []
+    for index,keyPath in enumerate(keyPaths):
+      dataTypeName = keyPath.split(".",1)[0]
+      if not dataTypeName in dataTypeIndexes:
+        dataTypeIndexes[dataTypeName] = []
+        dataTypeOrder.append(dataTypeName)
+      dataTypeIndexes[dataTypeName].append(index)
+
+    for dataTypeName in dataTypeOrder:
+      indexes = dataTypeIndexes[dataTypeName]
+      dataTypeDict = self.itemsForDataType(dataTypeName)
+      if dataTypeDict is None:
+        self.logger("Datatype: %s does not exist!" % dataTypeName,"error")
+        continue
+      accessors = [self.accessorForKeyPath(keyPaths[index]) for index in indexes]
+      for index,(value,err) in zip(indexes,valuesForAccessors(accessors,dataTypeDict,startIndex=1)):
+        if err:
+          self.logger("Keypath: %s does not exist!" % keyPaths[index],"error")
+          self.logger("Exception: %s" % err,"debug")
           continue
-        except:
-          currentItem = currentItem[0]
-        
-      try:
-        currentItem = currentItem[key]
-      except Exception, err:
-        self.logger("Keypath: %s does not exist!" % keyPath,"error")
-        self.logger("Exception: %s" % err,"debug")
-        return False
-    return currentItem
+        values[index] = value
+    return values
 
   def backupSettings(self):
     '''Function which performs our backup'''
@@ -1735,34 +3385,13 @@ class systemProfilerService(baseService):
     ## We have passed sanity checks. 
     self.logger("Backing up %s to '%s'" % (name,backupTargetPath))
     
+    if not self.isLoaded:
+      self.load()
     profilerPlistObj = self.plist
-    ## Perform our ad-hoc backups, get a cvlabel -l output
-    systemProfilerPath = self.systemProfilerCMDPath
-    
-    ## Iterate through all of our backupPaths and copy them over
-    for dataType in self.systemProfilerDataTypes:
-      self.logger(" - Processing data type: '%s'" % dataType,"detailed")
-    
-      systemProfilerCMDString = "%s -xml %s" % (systemProfilerPath,dataType)
-      
-      self.logger("    - Running Command:'%s' " % systemProfilerCMDString,"debug")
-      
-      systemProfilerCMD = subprocess.Popen(systemProfilerCMDString,shell=True,stdout=subprocess.PIPE,universal_newlines=True)
-      systemProfilerCMD_STDOUT, systemProfilerCMD_STDERR = systemProfilerCMD.communicate()
-      
-      if systemProfilerCMD_STDOUT:
-        ## Create a plist object from our output.
-        plistObj = plistlib.readPlistFromString(systemProfilerCMD_STDOUT)
-        profilerPlistObj.append(plistObj[0])
-        
-          
-    self.plist = profilerPlistObj
     
     self.logger("Saving plist to:'%s'" % backupTargetPath,"detailed")
-    try:
-      plistlib.writePlist(profilerPlistObj,backupTargetPath)
-    except Exception, err:
-      self.logger("Cannot save plist to '%s':%s" % (backupTargetPath,err),"error")
+    if not self.writeSnapshot(profilerPlistObj,backupTargetPath):
+      self.logger("Cannot save plist to '%s':%s" % (backupTargetPath,self.lastError),"error")
     
     ## Check for our 'latest.plist' file
     if self.useTimeStamps:
@@ -1803,21 +3432,53 @@ class backupController(baseService):
   failedServices = []
   backedUpServices = []
   runningServices = []
+  runningServicesLoaded = False   ## Whether runningServices has been probed
   
   hostname = ""
   restoreFromBackup = False
   backupPath = ""
   singleFileOutput = False
-  useSubDirs = True  
+  useSubDirs = True
+  pruneBackups = False
+  jobs = 1              ## Max number of services to back up concurrently
+  engine = "threads"    ## Collection engine: "threads" or "events" (see collectionEngine)
+  engineJobs = 32       ## Max commands in flight with the "events" engine
+  odArchive = None      ## odService whose archive the "events" engine creates
+  deadline = 0          ## Seconds allowed for "events" collection, 0 for no limit
+  layout = "directory"  ## Output layout: "directory" or "store" (see blobStore)
+  storePath = ""        ## Path to our blobStore, defaults to <backupPath>/store
+  store = None          ## Our blobStore object when using the "store" layout
+  sqlConn = None        ## Our connection to .backupHistoryDB, see connectToSQL()
+  sqlReadOnly = False   ## Only read .backupHistoryDB, used for other hosts' backups
+  memoizeKeyPaths = False ## Whether valueForKeyPath() results are stored
+  keyPathValues = {}    ## Stored valueForKeyPath() results, keyed by keyPath
+  keyPathValuesGeneration = 0 ## Our plistGeneration when keyPathValues were stored
+  aliasKeyPaths = ["runningServices","profile.SPHardwareDataType.processorSummary"]
+  historySchemaVersion = 3  ## Schema version of .backupHistoryDB, see migrateSQL()
   debug = False
-  
+
   def __init__(self,backupPath=""):
     '''Our contsructor, accepts a path'''
-    
+
     self.backedUpServices = []
     self.runningServices = []
+    self.runningServicesLoaded = False
     self.registeredServices = {}
     self.hostname = ""
+    self.jobs = 1
+    self.engine = "threads"
+    self.engineJobs = 32
+    self.odArchive = None
+    self.deadline = 0
+    self.layout = "directory"
+    self.storePath = ""
+    self.store = None
+    self.storeEntries = {}
+    self.sqlConn = None
+    self.sqlReadOnly = False
+    self.memoizeKeyPaths = False
+    self.keyPathValues = {}
+    self.keyPathValuesGeneration = 0
     self.debug = False
     self.plist = {}
     
@@ -1838,6 +3499,7 @@ class backupController(baseService):
           ## Create an entry for our service containing an instance of our class
           self.logger("Registering service %s to class %s " % (service,serviceClass.__name__),"debug")
           self.registeredServices[service] = serviceClass(name=service)
+          self.registeredServices[service].controller = self
           if not self.debug:
             self.registeredServices[service].echoLogs = False
         else:
@@ -1874,49 +3536,410 @@ class backupController(baseService):
           
     return 
     
-  def getRunningServiceList(self):
-    '''Returns a list of running services'''
+  def getRunningServiceList(self,refresh=False,serviceStates=None):
+    '''Returns a list of running services. Services are only probed once per
+    run, subsequent calls return the stored list unless refresh is True.
+    serviceStates may provide states already probed for our saServices, see
+    collectWithEngine()'''
+    if self.runningServicesLoaded and not refresh:
+      return self.runningServices
+
     ## Iterate through our registered services
+    startTime = time.time()
     testedClasses = []
     runningServiceList = []
     for serviceName,serviceObj in self.registeredServices.iteritems():
       if serviceObj.__class__ in testedClasses:
         continue
       testedClasses.append(serviceObj.__class__)
-      myServices = serviceObj.getRunningServiceList()
+      if serviceStates is not None and serviceObj.__class__.__name__ == "saService":
+        myServices = serviceObj.runningServicesForStates(serviceStates)
+      else:
+        myServices = serviceObj.getRunningServiceList()
       if myServices:
         runningServiceList.extend(myServices)
     
     self.runningServices = runningServiceList
+    self.runningServicesLoaded = True
+    self.recordTiming("runningServices",startTime)
     return runningServiceList
 
   def connectToSQL(self):
-    """Open a connection to sqlite db and save the connection at self.sqlConn"""
-    sqlConn = ""
+    """Open a connection to sqlite db and save the connection at self.sqlConn.
+    The connection is reused for the remainder of the run, see closeSQL().
+    If self.sqlReadOnly is set, an existing db is opened for queries only,
+    otherwise the db is created or migrated as needed"""
+
+    if self.sqlConn:
+      return self.sqlConn
+
     if not self.backupPath:
       self.logger("Backup path not set, cannot create SQL connection!","error")
       return False
       
     dbPath = os.path.join(self.backupPath,".backupHistoryDB")
-    if dbPath and not os.path.exists(dbPath):
-      if os.path.exists(os.path.dirname(dbPath)):
+    if not os.path.exists(dbPath):
+      if self.sqlReadOnly:
+        raise RuntimeError("No backup history found at path: %s" % dbPath)
+      if not os.path.isdir(os.path.dirname(dbPath)):
+        self.logger("Could not create sqlite db at path: %s, directory does not exist!" % dbPath,"error")
+        raise RuntimeError("Directory does not exist: %s" % os.path.dirname(dbPath))
+    try:
+      sqlConn = sqlite3.connect(dbPath)
+    except Exception,err:
+      self.logger("An error occured opening sqlite db at path: %s  Error:%s" % (dbPath,err),"error")
+      raise
+
+    ## Another host's history is only ever read: it is not migrated, and 
+    ## its journal mode is left alone
+    if self.sqlReadOnly:
+      try:
+        sqlConn.execute("PRAGMA query_only = ON")
+      except Exception,err:
+        self.logger("Could not set sqlite db at: %s to query only, Error:%s" % (dbPath,err),"debug")
+      self.sqlConn = sqlConn
+      return sqlConn
+
+    ## Use write-ahead logging, so readers don't block on our writes. WAL 
+    ## relies on shared memory, so it is not used on network filesystems
+    if isLocalFilesystem(self.backupPath):
+      journalMode = "WAL"
+    else:
+      self.logger("Backup path: %s is not on a local filesystem, not using WAL journaling" 
+                    % self.backupPath,"detailed")
+      journalMode = "DELETE"
+    try:
+      sqlConn.execute("PRAGMA journal_mode=%s" % journalMode)
+    except Exception,err:
+      self.logger("Could not set %s journaling for sqlite db at: %s Error:%s" 
+                    % (journalMode,dbPath,err),"warning")
+
+    ## Create our tables, or bring an older database up to date
+    try:
+      self.migrateSQL(sqlConn)
+    except Exception,err:
+      self.logger("Could not update schema of sqlite db at: %s Error:%s" % (dbPath,err),"error")
+      sqlConn.close()
+      raise
+
+    self.sqlConn = sqlConn
+    return sqlConn
+
+  def migrateSQL(self,sqlConn):
+    """Creates our backup history tables, or migrates an existing database
+    to the current schema (self.historySchemaVersion). Our schema version is
+    tracked using sqlite's user_version pragma, databases which predate it
+    report version 0. Each version's changes are applied in turn, all in a
+    single transaction"""
+
+    myCursor = sqlConn.cursor()
+    myCursor.execute("PRAGMA user_version")
+    schemaVersion = myCursor.fetchone()[0]
+    if schemaVersion >= self.historySchemaVersion:
+      myCursor.close()
+      return schemaVersion
+
+    myCursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    existingTables = [myRow[0] for myRow in myCursor.fetchall()]
+
+    self.logger("Updating backup history schema from version %s to %s" 
+                  % (schemaVersion,self.historySchemaVersion),"detailed")
+
+    ## Handle our own transaction, pysqlite would otherwise commit before DDL
+    isolationLevel = sqlConn.isolation_level
+    sqlConn.isolation_level = None
+    try:
+      myCursor.execute("BEGIN")
+
+      ## Version 2: typed backupHistory and serviceSnapshots, serviceResults
+      if schemaVersion < 2:
+        myCursor.execute("CREATE TABLE backupHistory_new("
+                          "backupID INTEGER PRIMARY KEY,"
+                          "backupStatus INTEGER NOT NULL,"
+                          "backupTimeStamp TEXT NOT NULL,"
+                          "backedUpServices TEXT,"
+                          "runningServices TEXT)")
+        if "backupHistory" in existingTables:
+          ## backupID is our rowid, whether or not the table declares it, and is
+          ## kept so that rows referencing it (i.e. serviceResults) stay valid
+          myCursor.execute("INSERT INTO backupHistory_new(backupID,backupStatus,backupTimeStamp,"
+                            "backedUpServices,runningServices) SELECT rowid,"
+                            " CASE WHEN backupStatus IN (1,'1','True') THEN 1 ELSE 0 END,"
+                            " COALESCE(backupTimeStamp,''),backedUpServices,runningServices"
+                            " FROM backupHistory ORDER BY rowid")
+          myCursor.execute("DROP TABLE backupHistory")
+        myCursor.execute("ALTER TABLE backupHistory_new RENAME TO backupHistory")
+
+        myCursor.execute("CREATE TABLE serviceSnapshots_new("
+                          "serviceName TEXT NOT NULL,"
+                          "backupTimeStamp TEXT NOT NULL,"
+                          "contentHash TEXT,"
+                          "filePath TEXT NOT NULL,"
+                          "snapshotTime REAL)")
+        if "serviceSnapshots" in existingTables:
+          myCursor.execute("PRAGMA table_info(serviceSnapshots)")
+          if "snapshotTime" in [myRow[1] for myRow in myCursor.fetchall()]:
+            snapshotTimeColumn = "snapshotTime"
+          else:
+            snapshotTimeColumn = "NULL"
+          myCursor.execute("INSERT INTO serviceSnapshots_new SELECT serviceName,"
+                            "COALESCE(backupTimeStamp,''),contentHash,filePath,%s"
+                            " FROM serviceSnapshots ORDER BY rowid" % snapshotTimeColumn)
+          myCursor.execute("DROP TABLE serviceSnapshots")
+        myCursor.execute("ALTER TABLE serviceSnapshots_new RENAME TO serviceSnapshots")
+
+        myCursor.execute("CREATE TABLE IF NOT EXISTS serviceResults("
+                          "backupID INTEGER NOT NULL REFERENCES backupHistory(backupID),"
+                          "serviceName TEXT NOT NULL,"
+                          "backupTimeStamp TEXT NOT NULL,"
+                          "status INTEGER NOT NULL,"
+                          "duration REAL,"
+                          "bytes INTEGER,"
+                          "contentHash TEXT)")
+
+        myCursor.execute("CREATE INDEX IF NOT EXISTS backupHistoryByTime"
+                          " ON backupHistory(backupStatus,backupTimeStamp)")
+        myCursor.execute("CREATE INDEX IF NOT EXISTS serviceSnapshotsByService"
+                          " ON serviceSnapshots(serviceName,backupTimeStamp)")
+        myCursor.execute("CREATE INDEX IF NOT EXISTS serviceResultsByService"
+                          " ON serviceResults(serviceName,backupTimeStamp)")
+        myCursor.execute("CREATE INDEX IF NOT EXISTS serviceResultsByBackup"
+                          " ON serviceResults(backupID)")
+
+      ## Version 3: phaseTimings
+      if schemaVersion < 3:
+        myCursor.execute("CREATE TABLE IF NOT EXISTS phaseTimings("
+                          "backupID INTEGER NOT NULL REFERENCES backupHistory(backupID),"
+                          "phase TEXT NOT NULL,"
+                          "seconds REAL,"
+                          "bytes INTEGER)")
+
+        myCursor.execute("CREATE INDEX IF NOT EXISTS phaseTimingsByBackup"
+                          " ON phaseTimings(backupID)")
+
+      myCursor.execute("PRAGMA user_version = %d" % self.historySchemaVersion)
+      myCursor.execute("COMMIT")
+    except:
+      myCursor.execute("ROLLBACK")
+      raise
+    finally:
+      sqlConn.isolation_level = isolationLevel
+      myCursor.close()
+
+    return self.historySchemaVersion
+
+  def closeSQL(self):
+    """Closes our sqlite connection, if open"""
+
+    if self.sqlConn:
+      try:
+        self.sqlConn.close()
+      except Exception,err:
+        self.logger("An error occured closing sqlite db: %s" % err,"warning")
+    self.sqlConn = None
+
+  def snapshotBytes(self,snapshotPath):
+    """Returns the size in bytes of the file at snapshotPath, or the total
+    size of all files within it if snapshotPath is a directory"""
+
+    if not snapshotPath or not os.path.exists(snapshotPath):
+      return 0
+    if not os.path.isdir(snapshotPath):
+      return os.path.getsize(snapshotPath)
+
+    totalBytes = 0
+    for dirPath,dirNames,fileNames in os.walk(snapshotPath):
+      for fileName in fileNames:
+        filePath = os.path.join(dirPath,fileName)
+        if not os.path.islink(filePath):
+          totalBytes += os.path.getsize(filePath)
+    return totalBytes
+
+  def loadPreviousSnapshots(self,serviceList):
+    """Looks up the most recent snapshot recorded in our backup history for
+    each service object in serviceList and stores its content hash and path
+    at serviceObj.previousSnapshot"""
+
+    try:
+      sqlConn = self.connectToSQL()
+      myCursor = sqlConn.cursor()
+      for serviceObj in serviceList:
+        myCursor.execute("SELECT contentHash,filePath FROM serviceSnapshots WHERE"
+                          " serviceName = ? ORDER BY backupTimeStamp DESC, rowid DESC LIMIT 1",
+                          (serviceObj.name,))
+        myRow = myCursor.fetchone()
+        if myRow:
+          serviceObj.previousSnapshot = {"contentHash" : myRow[0],
+                                  "path" : os.path.join(self.backupPath,myRow[1])}
+        else:
+          serviceObj.previousSnapshot = {}
+      myCursor.close()
+    except Exception,err:
+      self.logger("Could not load previous snapshots from backup history: %s" % err,"warning")
+      return False
+
+    return True
+
+  def snapshotForService(self,serviceName,timeStamp=""):
+    """Returns the path of the most recent snapshot recorded in our catalog
+    for serviceName. If timeStamp is provided, returns the most recent 
+    snapshot taken at or before timeStamp. Returns an empty string if no
+    snapshot is cataloged"""
+
+    query = "SELECT filePath FROM serviceSnapshots WHERE serviceName = ?"
+    queryArgs = [serviceName]
+    if timeStamp:
+      query += " AND backupTimeStamp <= ?"
+      queryArgs.append(timeStamp)
+    query += " ORDER BY backupTimeStamp DESC, rowid DESC LIMIT 1"
+
+    sqlConn = self.connectToSQL()
+    myCursor = sqlConn.cursor()
+    myCursor.execute(query,queryArgs)
+    myRow = myCursor.fetchone()
+    myCursor.close()
+
+    if not myRow:
+      return ""
+    return os.path.join(self.backupPath,myRow[0])
+
+  def seedSnapshotCatalog(self,myCursor,theService):
+    """Adds any of theService's snapshots found on disk, but not yet present
+    in our catalog, to the serviceSnapshots table. This is used to adopt
+    snapshots taken before the catalog existed. Returns the number of
+    snapshots added"""
+
+    serviceName = theService.name
+    dirPath = theService.backupPath
+    baseName = theService.baseName
+    if not baseName:
+      baseName = serviceName
+    if not dirPath or not os.path.isdir(dirPath):
+      return 0
+
+    myCursor.execute("SELECT filePath FROM serviceSnapshots WHERE serviceName = ?",(serviceName,))
+    catalogedPaths = set([myRow[0] for myRow in myCursor.fetchall()])
+
+    latestStubName = "%s_latest" % baseName
+    newRows = []
+    for fileName in os.listdir(dirPath):
+      if not fnmatch.fnmatchcase(fileName,"%s_*" % baseName):
+        continue
+      if fileName[0:len(latestStubName)] == latestStubName:
+        continue
+      filePath = os.path.join(dirPath,fileName)
+      snapshotPath = os.path.relpath(filePath,self.backupPath)
+      if snapshotPath in catalogedPaths:
+        continue
+      snapshotTime = timeForSnapshot(filePath,baseName)
+      if snapshotTime is None:
+        continue
+      backupTimeStamp = time.strftime("%Y%m%d_%H%M",time.localtime(snapshotTime))
+      newRows.append((serviceName,backupTimeStamp,"",snapshotPath,snapshotTime))
+
+    if newRows:
+      self.logger("   - Adding %s existing snapshots for service: %s to catalog" 
+                    % (len(newRows),serviceName),"detailed")
+      myCursor.executemany("INSERT INTO serviceSnapshots(serviceName,backupTimeStamp,"
+                            "contentHash,filePath,snapshotTime) VALUES (?,?,?,?,?)",newRows)
+    return len(newRows)
+
+  def pruneSnapshots(self,serviceList):
+    """Prunes backups for each service object in serviceList using the
+    snapshot catalog in our backup history rather than by scanning the
+    service's backup directory. Snapshots are ordered by their backup 
+    timestamp. Services with no cataloged snapshots fall back to
+    baseService.prune()"""
+
+    pruneOptions = self.pruneOptions
+    try:
+      expiredTime = time.time() - (int(pruneOptions["maxAge"]) * 86400)
+      minCopies = int(pruneOptions["minCopies"])
+      maxCopies = int(pruneOptions["maxCopies"])
+      if maxCopies > 0 and maxCopies < minCopies:
+        maxCopies = 0
+    except Exception,err:
+      self.logger("Could not prune backups, invalid prune options: %s" % err,"error")
+      return False
+
+    try:
+      sqlConn = self.connectToSQL()
+    except Exception,err:
+      self.logger("Could not open snapshot catalog, pruning from disk: %s" % err,"warning")
+      sqlConn = None
+
+    for theService in serviceList:
+      serviceName = theService.name
+      if not theService.canPrune:
+        self.logger("   - Service: %s doesn't support pruning!" % serviceName,"detailed")
+        continue
+      self.logger("   - Pruning Backups for service: %s" % serviceName,"detailed")
+
+      snapshotRows = []
+      if sqlConn:
         try:
-          sqlConn = sqlite3.connect(dbPath)
           myCursor = sqlConn.cursor()
-          myCursor.execute("CREATE TABLE backupHistory(backupStatus,backupTimeStamp,backedUpServices,runningServices)")
-          sqlConn.commit()
+          if not theService.previousSnapshot:
+            self.seedSnapshotCatalog(myCursor,theService)
+          myCursor.execute("SELECT rowid,snapshotTime,filePath FROM serviceSnapshots"
+                            " WHERE serviceName = ? ORDER BY backupTimeStamp,rowid",
+                            (serviceName,))
+          snapshotRows = myCursor.fetchall()
           myCursor.close()
         except Exception,err:
-          self.logger("An error occured creating sqlite db at path: %s  Error:%s" % (dbPath,err),"error")
-          raise
-    else:
+          self.logger("Could not read snapshot catalog for service: %s Error: %s" 
+                        % (serviceName,err),"warning")
+          snapshotRows = []
+
+      if not snapshotRows:
+        theService.setPruneOptions(pruneOptions)
+        ## Temporarily enable logging on the service
+        echoLogs = theService.echoLogs
+        theService.echoLogs = True
+        theService.prune()
+        theService.echoLogs = echoLogs
+        continue
+
+      ## A snapshot never counts as older than one cataloged before it
+      snapshotTimes = []
+      for rowID,snapshotTime,snapshotPath in snapshotRows:
+        if snapshotTime is None:
+          snapshotTime = 0
+        if snapshotTimes and snapshotTime < snapshotTimes[-1]:
+          snapshotTime = snapshotTimes[-1]
+        snapshotTimes.append(snapshotTime)
+
+      numToRemove = pruneCountForSnapshots(snapshotTimes,expiredTime,minCopies,maxCopies)
+      if numToRemove <= 0:
+        self.logger("     No files qualify for pruning!","detailed")
+        continue
+
+      ## Only remove files which no retained snapshot refers to
+      retainedPaths = set([myRow[2] for myRow in snapshotRows[numToRemove:]])
+      removePaths = []
+      for rowID,snapshotTime,snapshotPath in snapshotRows[:numToRemove]:
+        if not snapshotPath in retainedPaths and not snapshotPath in removePaths \
+        and os.path.lexists(os.path.join(self.backupPath,snapshotPath)):
+          removePaths.append(snapshotPath)
+
+      self.logger("     Pruning %s of %s files!" % (len(removePaths),len(snapshotRows)))
+      failedPaths = self.removeBackupFiles(self.backupPath,removePaths)
+
       try:
-        sqlConn = sqlite3.connect(dbPath)
-      except Exception, err:
-        self.logger("An error occured opening sqlitedb at: %s Error:%s" % (dbPath,err))
-        raise
-        
-    return sqlConn
+        myCursor = sqlConn.cursor()
+        myCursor.executemany("DELETE FROM serviceSnapshots WHERE rowid = ?",
+                              [(myRow[0],) for myRow in snapshotRows[:numToRemove]
+                                if not myRow[2] in failedPaths])
+        sqlConn.commit()
+        myCursor.close()
+      except Exception,err:
+        self.logger("Could not update snapshot catalog for service: %s Error: %s" 
+                      % (serviceName,err),"error")
+
+      if not failedPaths:
+        self.logger("     Successfully pruned expired files!","detailed")
+
+    return True
 
   def valueForAliasKeyPath(self,keyPath=""):
     """Returns a value for keyPath based upon a specific keyPath alias
@@ -1949,43 +3972,111 @@ class backupController(baseService):
     a registered service (self.registeredServices). 
     Example: valueForKeyPath("afp.guestAccess")
     queries settings for service "afp" and attribute "guestAccess" 
-    returns True or False
+    returns True or False. If self.memoizeKeyPaths is set, results are 
+    stored at self.keyPathValues and returned for subsequent queries until
+    our plist, or that of any of our services, changes.
     """
-    
-    try:
-      aliasValue = self.valueForAliasKeyPath(keyPath)
-      return aliasValue
-    except:
-      self.logger("No alias registered for keyPath:%s" % keyPath,"debug")
-      pass
-    
+
+    if self.memoizeKeyPaths:
+      if not self.keyPathValuesGeneration == self.plistGeneration:
+        self.keyPathValues = {}
+        self.keyPathValuesGeneration = self.plistGeneration
+      try:
+        return self.keyPathValues[keyPath]
+      except KeyError:
+        value = self._valueForKeyPath(keyPath)
+        self.keyPathValues[keyPath] = value
+        return value
+
+    return self._valueForKeyPath(keyPath)
+
+  def valuesForKeyPaths(self,keyPaths):
+    """Returns a list of values, one for each keypath in keyPaths, as 
+    returned by valueForKeyPath(). Keypaths are grouped by service, and each
+    service resolves its keypaths in a single pass"""
+
+    if self.memoizeKeyPaths and not self.keyPathValuesGeneration == self.plistGeneration:
+      self.keyPathValues = {}
+      self.keyPathValuesGeneration = self.plistGeneration
+
+    values = [None] * len(keyPaths)
+    serviceIndexes = {}
+    serviceOrder = []
+    for index,keyPath in enumerate(keyPaths):
+      if self.memoizeKeyPaths and keyPath in self.keyPathValues:
+        values[index] = self.keyPathValues[keyPath]
+        continue
+      accessor = self.accessorForKeyPath(keyPath)
+      if accessor.aliasName or len(accessor.keys) < 2 \
+      or not accessor.serviceName in self.registeredServices:
+        values[index] = self.valueForKeyPath(keyPath)
+        continue
+      if not accessor.serviceName in serviceIndexes:
+        serviceIndexes[accessor.serviceName] = []
+        serviceOrder.append(accessor.serviceName)
+      serviceIndexes[accessor.serviceName].append(index)
+
+    for serviceName in serviceOrder:
+      indexes = serviceIndexes[serviceName]
+      serviceKeyPaths = [self.accessorForKeyPath(keyPaths[index]).serviceKeyPath for index in indexes]
+      serviceValues = self.registeredServices[serviceName].valuesForKeyPaths(serviceKeyPaths)
+      for index,value in zip(indexes,serviceValues):
+        values[index] = value
+        if self.memoizeKeyPaths:
+          self.keyPathValues[keyPaths[index]] = value
+    return values
+
+  def compileKeyPath(self,keyPath):
+    """Returns a keyPathAccessor for keyPath, noting any alias and the
+    service which the keyPath is dispatched to"""
+
+    accessor = keyPathAccessor(keyPath)
+    if keyPath in self.aliasKeyPaths:
+      accessor.aliasName = keyPath
     keyPathArray = keyPath.split(".")
-    if len(keyPathArray) == 1:
-      key = keyPathArray[0]
-      if key in self.info:
-        return self.info[key]
-      if key == "sabackup":
-        return self.info
+    accessor.serviceName = keyPathArray[0]
+    accessor.serviceKeyPath = ".".join(keyPathArray[1:])
+    return accessor
+
+  def _valueForKeyPath(self,keyPath):
+    """Resolves keyPath for valueForKeyPath()"""
+
+    accessor = self.accessorForKeyPath(keyPath)
+    if accessor.aliasName:
+      try:
+        return self.valueForAliasKeyPath(keyPath)
+      except:
+        pass
     
-    serviceName = keyPathArray.pop(0)
+    if len(accessor.keys) == 1:
+      if keyPath in self.info:
+        return self.info[keyPath]
+      if keyPath == "sabackup":
+        return self.info
     
+    serviceName = accessor.serviceName
     if serviceName in self.registeredServices:
-      serviceObj = self.registeredServices[serviceName]
-      return serviceObj.valueForKeyPath(".".join(keyPathArray))
+      return self.registeredServices[serviceName].valueForKeyPath(accessor.serviceKeyPath)
     else:
       raise RuntimeError("Service: %s is not registered!" % serviceName,"error")
-      return 
 
   def loadFromPath(self, backupPath):
     return self.loadFromBackup(backupPath)
   
-  def loadFromBackup(self, backupPath):
-    """Loads service objects from on-disk backups"""
+  def loadFromBackup(self, backupPath, timeStamp=""):
+    """Loads service objects from on-disk backups. Snapshots are looked up
+    in our snapshot catalog when available, in which case timeStamp may be
+    provided to load the most recent snapshots taken at or before it"""
     
     if backupPath:
       backupBasePath = backupPath
     else:
       backupBasePath = self.backupPath
+
+    ## Only consult our catalog if it describes this backup directory
+    useCatalog = self.backupPath \
+      and os.path.realpath(backupBasePath) == os.path.realpath(self.backupPath) \
+      and os.path.exists(os.path.join(backupBasePath,".backupHistoryDB"))
     
     serverAdminLatestFilePath = os.path.join(backupBasePath,"sa_global.plist")
     
@@ -2010,6 +4101,19 @@ class backupController(baseService):
         serviceBackupPath = os.path.join(backupBasePath,"serveradmin",serviceName)
       else:
         serviceBackupPath = os.path.join(backupBasePath,serviceName)
+
+      snapshotPath = ""
+      if useCatalog:
+        try:
+          snapshotPath = self.snapshotForService(serviceName,timeStamp=timeStamp)
+        except Exception,err:
+          self.logger("Could not look up snapshot for service: %s in catalog: %s" 
+                        % (serviceName,err),"warning")
+      if snapshotPath and os.path.exists(snapshotPath):
+        serviceBackupPath = snapshotPath
+      elif timeStamp:
+        self.logger("No snapshot for service: %s found at or before: %s, loading latest" 
+                      % (serviceName,timeStamp),"warning")
       
       self.logger("Loading Service Name: %s from path: %s" % (serviceName,serviceBackupPath))
       if theService.loadFromPath(serviceBackupPath):
@@ -2018,6 +4122,201 @@ class backupController(baseService):
         self.logger(" - Service failed to load: %s" % theService.lastError)
     return True
 
+  def collectWithEngine(self,backupJobs):
+    """Runs the external commands needed by the services in backupJobs, a
+    list of (serviceName,serviceObj) tuples, on a single collectionEngine:
+    batched serveradmin settings, system_profiler data types, cvlabel, the
+    OD archive of self.odArchive (if set) and, if not yet known, our 
+    running service probes. Up to self.engineJobs commands are in flight 
+    at once, and collection is abandoned after self.deadline seconds. 
+    Services which could not be collected are left unloaded and are loaded
+    by their own backup. Returns False if our deadline passed"""
+
+    engine = collectionEngine(maxInFlight=self.engineJobs,timeout=self.deadline)
+
+    pendingSAServices = []
+    profileServices = []
+    for serviceName,theService in backupJobs:
+      className = theService.__class__.__name__
+      if className == "saService" and not theService.isLoaded:
+        pendingSAServices.append(theService)
+      elif className == "systemProfilerService" and not theService.isLoaded:
+        theService.queueCollectors(engine)
+        profileServices.append(theService)
+      elif className == "xsanService" and os.path.exists(theService.cvlabelArgList()[0]):
+        theService.queueCollectors(engine)
+    if pendingSAServices:
+      batchLoader = pendingSAServices[0]
+      batchLoader.queueSettingsFetch(engine,pendingSAServices,
+                                      batchSize=batchLoader.settingsBatchSize)
+    if self.odArchive:
+      self.odArchive.queueArchive(engine)
+
+    ## Probe our running services alongside our collectors
+    serviceStates = None
+    statusProber = None
+    if not self.runningServicesLoaded:
+      for serviceName,serviceObj in self.registeredServices.iteritems():
+        if serviceObj.__class__.__name__ == "saService":
+          serviceStates = {}
+          statusProber = serviceObj
+          if not serviceObj.queueStatusProbes(engine,serviceStates):
+            serviceStates = None
+          break
+
+    self.logger("   - Collecting %s commands with up to %s in flight" 
+                  % (len(engine.pendingJobs),self.engineJobs),"detailed")
+    startTime = time.time()
+    didFinish = engine.run()
+    self.recordTiming("engine.collect",startTime,engine.bytesRead)
+    self.logger("   - Collection finished in %.2fs" % (time.time() - startTime),"detailed")
+    if not didFinish:
+      self.logger("Collection deadline of %ss passed, remaining commands were abandoned!" 
+                    % self.deadline,"error")
+    for result,err in engine.errors:
+      self.logger("Failed processing output of: '%s' Error: %s" 
+                    % (" ".join(result.argList),err),"error")
+
+    for theService in profileServices:
+      theService.finishCollection()
+    if serviceStates is not None:
+      ## Probes abandoned at our deadline are retried without one, rather
+      ## than counting their services as not running
+      unprobedNames = []
+      if not didFinish:
+        unprobedNames = [name for name in statusProber.probeNames() 
+                          if serviceStates.get(name) is None]
+      for name in unprobedNames:
+        self.logger("Status of service: %s was not probed before our deadline, "
+                      "probing again" % name,"warning")
+      if unprobedNames:
+        probeEngine = collectionEngine(maxInFlight=self.engineJobs)
+        statusProber.queueStatusProbes(probeEngine,serviceStates,names=unprobedNames)
+        probeEngine.run()
+      self.getRunningServiceList(refresh=True,serviceStates=serviceStates)
+
+    return didFinish
+
+  def allTimings(self):
+    """Returns our timings combined with those of our registered services.
+    Service phases are keyed as '<serviceName>.<phase>' (i.e. 'afp.collect')"""
+
+    timings = {}
+    for phase,timing in self.timings.iteritems():
+      timings[phase] = dict(timing)
+    for serviceName,serviceObj in self.registeredServices.iteritems():
+      for phase,timing in serviceObj.timings.iteritems():
+        timings["%s.%s" % (serviceName,phase)] = dict(timing)
+    return timings
+
+  def writeTimings(self,backupID):
+    """Records allTimings() to the phaseTimings table of our backup history
+    for the backup identified by backupID"""
+
+    timingRows = []
+    for phase,timing in sorted(self.allTimings().iteritems()):
+      timingRows.append((backupID,phase,timing["seconds"],timing["bytes"]))
+    try:
+      sqlConn = self.connectToSQL()
+      myCursor = sqlConn.cursor()
+      myCursor.executemany("INSERT INTO phaseTimings(backupID,phase,seconds,bytes)"
+                            " VALUES (?,?,?,?)",timingRows)
+      sqlConn.commit()
+      myCursor.close()
+    except Exception,err:
+      self.logger("Error writing timings to SQL: %s" % err,"error")
+      return False
+    return True
+
+  def backupService(self,serviceJob):
+    """Backs up a single prepared service. Accepts a
+    (serviceName,serviceObj) tuple and returns True if the backup succeeded.
+    The time taken is recorded at serviceObj.backupDuration. This may be
+    called from a worker thread, see backupSettings()"""
+
+    serviceName,theService = serviceJob
+
+    startTime = time.time()
+    try:
+      return self._backupService(serviceName,theService)
+    finally:
+      theService.backupDuration = time.time() - startTime
+
+  def _backupService(self,serviceName,theService):
+    """Performs the backup for backupService()"""
+
+    if self.store:
+      self.logger("Backing up Service Name: %s" % serviceName)
+      try:
+        self.storeEntries[serviceName] = theService.backupToStore(self.store)
+      except Exception,err:
+        theService.lastError = "%s" % err
+        syslog.syslog(syslog.LOG_ERR,"sabackup: - %s configuration backup failed!" % serviceName)
+        self.logger("     Backup failed! Error:'%s'" % err,"error")
+        return False
+      syslog.syslog(syslog.LOG_NOTICE,"sabackup: - %s configuration successfully backed up!" % serviceName)
+      self.logger("     Successfully backed up!")
+      return True
+
+    self.logger("Backing up Service Name: %s" % serviceName)
+    self.logger("   - Backing up service: '%s' to '%s'" % (serviceName,theService.backupPath),"detailed")
+    syslog.syslog(syslog.LOG_NOTICE,"sabackup: Backing up configuration for service: '%s' to '%s'" % (serviceName,theService.backupPath))
+
+    if not theService.backupSettings():
+      syslog.syslog(syslog.LOG_ERR,"sabackup: - %s configuration backup failed!" % serviceName)
+      self.logger("     Backup failed! Error:'%s'" % theService.lastError,"error")
+      return False
+
+    syslog.syslog(syslog.LOG_NOTICE,"sabackup: - %s configuration successfully backed up!" % serviceName)
+    self.logger("     Successfully backed up!")
+
+    return True
+
+  def writeStoreManifest(self,serverAdminPlist,failedServices=[],runFailed=False):
+    """Writes the manifest for this run to self.store, then prunes old
+    manifests and garbage collects unreferenced blobs if pruning is enabled.
+    If runFailed is set the manifest is marked failed and nothing is pruned"""
+
+    store = self.store
+    manifestName = self.timeStamp
+    if not manifestName:
+      manifestName = datetime.datetime.today().strftime("%Y%m%d_%H%M")
+
+    failedNames = [serviceObj.name for serviceObj in failedServices]
+    services = {}
+    for serviceName,storedFiles in self.storeEntries.iteritems():
+      if not serviceName in failedNames:
+        services[serviceName] = storedFiles
+
+    manifest = {}
+    manifest["timeStamp"] = manifestName
+    manifest["hostname"] = store.hostname
+    manifest["backupStatus"] = len(failedServices) == 0 and not runFailed
+    manifest["services"] = services
+    try:
+      manifest["sa_global.plist"] = store.putData(plistlib.writePlistToString(serverAdminPlist))
+      store.writeManifest(manifestName,manifest)
+    except Exception,err:
+      self.logger("Could not write store manifest: %s Error: %s" % (manifestName,err),"error")
+      return False
+    finally:
+      ## Our blobs are now referenced (or abandoned), allow collection
+      store.unlock()
+    self.logger("   - Wrote store manifest: %s" % manifestName,"detailed")
+
+    if self.pruneBackups and not runFailed:
+      self.logger("   - Pruning store manifests!","detailed")
+      startTime = time.time()
+      pruneOptions = self.pruneOptions
+      prunedCount = store.pruneManifests(maxAge=pruneOptions["maxAge"],
+                                          minCopies=pruneOptions["minCopies"],
+                                          maxCopies=pruneOptions["maxCopies"])
+      removedCount,removedBytes = store.collectGarbage()
+      self.recordTiming("prune",startTime,removedBytes)
+      self.logger("     Pruned %s manifests, removed %s unreferenced blobs (%s bytes)" 
+                    % (prunedCount,removedCount,removedBytes),"detailed")
+    return True
+
   def backupSettings(self):
     """Our main function to perform a backup"""
     
@@ -2066,16 +4365,16 @@ class backupController(baseService):
     serverAdminPlist["sabackup"] = sabackupDict
     
     
-    ## iterate through our services and back them up.
+    ## iterate through our services and prepare them for backup.
     myServices = {}
     failedServices = []
+    backupJobs = []
     
     for serviceName in self.services:
       if serviceName == "running" or serviceName == "all" or serviceName == "backup":
         continue
       
       theService = self.registeredServices[serviceName]
-      self.logger("Backing up Service Name: %s" % serviceName)
       
       if not singleFileOutput:
         if useSubDirs:
@@ -2100,7 +4399,15 @@ class backupController(baseService):
           self.logger("Could not create directory: %s" % backupBasePath,"error")
           return 2
 
-        ## Create our service specific folder, if it doesn't exist
+        ## Store based backups don't use per-service directories
+        if self.layout == "store":
+          myServices[serviceName] = theService
+          backupJobs.append((serviceName,theService))
+          del theService
+          continue
+
+        ## Create our service specific folder, if it doesn't exist. This is
+        ## done up front so that concurrent jobs never race on shared parents
         if not os.path.exists(serviceBackupPath):
           try:
             os.makedirs(serviceBackupPath)
@@ -2108,44 +4415,12 @@ class backupController(baseService):
             print "Could not create directory:'%s'" % err
             return 2
         
-      
-        self.logger("   - Backing up service: '%s' to '%s'" % (serviceName,serviceBackupPath),"detailed")   
         theService.setBackupPath(serviceBackupPath)
         myServices[serviceName] = theService
-        syslog.syslog(syslog.LOG_NOTICE,"sabackup: Backing up configuration for service: '%s' to '%s'" % (serviceName,serviceBackupPath))
         theService.useTimeStamps = useTimeStamps
         theService.overWriteExistingFiles = self.overWriteExistingFiles
         theService.timeStamp = self.timeStamp
-        if theService.backupSettings():
-          syslog.syslog(syslog.LOG_NOTICE,"sabackup: - %s configuration successfully backed up!" % serviceName)
-          self.logger("     Successfully backed up!")
-          if pruneBackups:
-            if theService.canPrune:
-              self.logger("   - Pruning Backups!","detailed")
-              theService.setPruneOptions(pruneOptions)
-              ## Temporarily enable logging on the service
-              echoLogs = theService.echoLogs
-              theService.echoLogs = True
-              theService.prune()
-              theService.echoLogs = echoLogs
-            else:
-              self.logger("     Service doesn't support pruning!","detailed")
-        else:
-          syslog.syslog(syslog.LOG_ERR,"sabackup: - %s configuration backup failed!" % serviceName)
-          failedServices.append(theService)      
-          self.logger("     Backup failed! Error:'%s'" % theService.lastError,"error")
-      
-        ## Aggregate our saServices into one plist
-        if theService.__class__.__name__ == "saService":
-          key = "%s Config" % theService.displayName
-          if not len(theService.plist) > 0:
-            self.logger("Plist for service:%s is empty!" % theService.displayName,"detailed")
-            continue
-          else:
-            if key in theService.plist:
-              serverAdminPlist[key] = theService.plist[key]
-            else:
-              self.logger("Key: %s does not exist in plist for service: %s" % (key,theService.displayName),"detailed")
+        backupJobs.append((serviceName,theService))
       else:
         ## Todo: fix it so that single-file backups operate more cleanly
         ## This may need a member var supportsSingleFileOutput = True|False
@@ -2158,18 +4433,89 @@ class backupController(baseService):
       ## unset our object
       del theService
 
-    ## Write out our global dicts
-    self.logger("   - Updating latest serveradmin file at path %s" % serverAdminLatestFilePath,"detailed")
-    try:
-      plistlib.writePlist(serverAdminPlist,serverAdminLatestFilePath)
-    except IOError, strerror:
-      self.logger("Could not write plist file to '%s'! Error:'%s'" % (serverAdminLatestFilePath,strerror),"error")
-    except:
-      self.logger("An unknown error occured writing plist to '%s'" % serverAdminLatestFilePath,"error")
+    ## Open our object store, or look up our previous snapshots so that 
+    ## unchanged settings can be linked
+    self.store = None
+    self.storeEntries = {}
+    if self.layout == "store":
+      storePath = self.storePath
+      if not storePath:
+        storePath = os.path.join(backupBasePath,"store")
+      store = blobStore(path=storePath,hostname=hostname)
+      if not store.create():
+        self.logger("Could not create object store at: %s" % storePath,"error")
+        return 2
+      ## Hold off garbage collection until our manifest is written
+      try:
+        store.lock()
+      except Exception,err:
+        self.logger("Could not lock object store at: %s Error: %s" % (storePath,err),"error")
+        return 2
+      self.store = store
+    else:
+      self.loadPreviousSnapshots([theService for serviceName,theService in backupJobs])
+
+    ## Fetch settings for all of our saServices in as few serveradmin calls
+    ## as possible, anything not loaded here is loaded by the service itself.
+    ## The "events" engine also collects our other services' commands
+    pendingSAServices = []
+    for serviceName,theService in backupJobs:
+      if theService.__class__.__name__ == "saService" and not theService.isLoaded:
+        pendingSAServices.append(theService)
+    if self.engine == "events":
+      self.collectWithEngine(backupJobs)
+    elif len(pendingSAServices) > 1:
+      self.logger("   - Fetching serveradmin settings for %s services" 
+                    % len(pendingSAServices),"detailed")
+      startTime = time.time()
+      batchLoader = pendingSAServices[0]
+      batchLoader.loadServices(pendingSAServices,
+                                batchSize=batchLoader.settingsBatchSize,
+                                maxJobs=self.jobs)
+      self.recordTiming("serveradmin.collect",startTime)
+
+    ## Perform our backups, running up to self.jobs services at once
+    if self.jobs > 1 and len(backupJobs) > 1:
+      self.logger("   - Backing up %s services using %s concurrent jobs" 
+                    % (len(backupJobs),self.jobs),"detailed")
+    jobResults = runConcurrentJobs(self.backupService,backupJobs,maxJobs=self.jobs)
+    
+    ## Process our results in service order, so that failedServices and
+    ## sa_global.plist are deterministic regardless of completion order
+    for (serviceName,theService),(didBackup,err) in zip(backupJobs,jobResults):
+      if err:
+        self.logger("   - Backup of service: %s raised an error: %s" % (serviceName,err),"error")
+      if not didBackup:
+        failedServices.append(theService)
+        
+      ## Note any system_profiler data types which were read from cache
+      if theService.__class__.__name__ == "systemProfilerService":
+        sabackupDict["profileCacheHits"] = theService.cacheHits
+
+      ## Aggregate our saServices into one plist
+      if theService.__class__.__name__ == "saService":
+        key = "%s Config" % theService.displayName
+        if not len(theService.plist) > 0:
+          self.logger("Plist for service:%s is empty!" % theService.displayName,"detailed")
+          continue
+        else:
+          if key in theService.plist:
+            serverAdminPlist[key] = theService.plist[key]
+          else:
+            self.logger("Key: %s does not exist in plist for service: %s" % (key,theService.displayName),"detailed")
+
+    ## An OD archive queued on our engine which failed fails the whole run,
+    ## as it would have without the engine: record it and do not prune
+    odArchiveFailed = self.odArchive and self.odArchive.archiveResult is False
+    if odArchiveFailed:
+      self.logger("OD Archive could not be created, backup will be marked failed!","error")
+
+    if self.store:
+      self.writeStoreManifest(serverAdminPlist,failedServices,odArchiveFailed)
 
     self.failedServices = failedServices
       
-    if len(failedServices) > 0:
+    if len(failedServices) > 0 or odArchiveFailed:
       backupSuccess = False
     else: 
       backupSuccess = True
@@ -2178,15 +4524,66 @@ class backupController(baseService):
     backedUpServices = ",".join(self.services)
     runningServices = ",".join(self.getRunningServiceList())
     sqlTuple = (backupSuccess,backupTimeStamp,backedUpServices,runningServices)
+    snapshotTime = time.time()
+    backupID = None
     try:
       self.logger("   - Updating SQL database.")
       sqlConn = self.connectToSQL()
       myCursor = sqlConn.cursor()
-      myCursor.execute("INSERT INTO backupHistory values (?,?,?,?)",sqlTuple)
+      myCursor.execute("INSERT INTO backupHistory(backupStatus,backupTimeStamp,"
+                        "backedUpServices,runningServices) VALUES (?,?,?,?)",sqlTuple)
+      backupID = myCursor.lastrowid
+      for serviceName,theService in backupJobs:
+        didBackup = not theService in failedServices
+        if self.store:
+          backupBytes = 0
+          for blobHash in self.storeEntries.get(serviceName,{}).itervalues():
+            if self.store.hasBlob(blobHash):
+              backupBytes += os.path.getsize(self.store.pathForHash(blobHash))
+        elif didBackup:
+          backupBytes = self.snapshotBytes(theService.snapshotFile)
+        else:
+          backupBytes = 0
+        myCursor.execute("INSERT INTO serviceResults(backupID,serviceName,backupTimeStamp,"
+                          "status,duration,bytes,contentHash) VALUES (?,?,?,?,?,?,?)",
+                          (backupID,serviceName,backupTimeStamp,didBackup,
+                            theService.backupDuration,backupBytes,theService.contentHash))
+        if not didBackup or not theService.snapshotFile:
+          continue
+        snapshotPath = os.path.relpath(theService.snapshotFile,backupBasePath)
+        myCursor.execute("INSERT INTO serviceSnapshots(serviceName,backupTimeStamp,"
+                          "contentHash,filePath,snapshotTime) VALUES (?,?,?,?,?)",
+                          (serviceName,backupTimeStamp,theService.contentHash,
+                            snapshotPath,snapshotTime))
       sqlConn.commit()
       myCursor.close()
     except Exception, err:
       self.logger("Error writing SQL: %s" % err,"error")
+    self.recordTiming("sqlite",snapshotTime)
+
+    ## Prune once all services are collected, using our snapshot catalog
+    if pruneBackups and not self.store and not odArchiveFailed:
+      startTime = time.time()
+      self.pruneSnapshots([theService for serviceName,theService in backupJobs 
+                            if not theService in failedServices])
+      self.recordTiming("prune",startTime)
+
+    ## Write out our global dicts, now that our timings are known
+    sabackupDict["timings"] = self.allTimings()
+    self.logger("   - Updating latest serveradmin file at path %s" % serverAdminLatestFilePath,"detailed")
+    startTime = time.time()
+    try:
+      plistlib.writePlist(serverAdminPlist,serverAdminLatestFilePath)
+      self.recordTiming("globalPlist",startTime,os.path.getsize(serverAdminLatestFilePath))
+    except IOError, strerror:
+      self.logger("Could not write plist file to '%s'! Error:'%s'" % (serverAdminLatestFilePath,strerror),"error")
+    except:
+      self.logger("An unknown error occured writing plist to '%s'" % serverAdminLatestFilePath,"error")
+
+    if not backupID is None:
+      self.writeTimings(backupID)
+
+    self.closeSQL()
       
     return backupSuccess
     
@@ -2206,10 +4603,23 @@ class backupSummary(backupController):
   serviceData = {}  ## dict keyed by service name
   servers = []      ## array of server hostnames
   backupPath = ""   ## Path to our backup directory to scan
+  jobs = 1          ## Max number of images to process concurrently
+  hdiutilPath = "/usr/bin/hdiutil"  ## hdiutil used to mount backup images
+  imageExtensions = [".sparseimage"]  ## Extensions of backup disk images
+  useCache = True   ## Whether to use our on-disk cache of parsed backups
+  cachePath = ""    ## Path to our cache, defaults to <backupPath>/.summaryCache
+  cacheVersion = 2  ## Format version of our cache file
+  loadedSources = {}  ## Fingerprint and hostname of each loaded source, by path
+  xsanVolumesSignature = None ## Client data our merged Xsan volumes were built from
   
   def __init__(self,backupPath=""):
     self.clientData = {}
     self.serviceData = {}
+    self.jobs = 1
+    self.useCache = True
+    self.cachePath = ""
+    self.loadedSources = {}
+    self.xsanVolumesSignature = None
     self.echoLogs = True
     self.debug = False
     self.backupController = ""
@@ -2221,56 +4631,346 @@ class backupSummary(backupController):
   
   def load(self,backupPath=""):
     '''Method which loads all backups found in the specified backup
-    directory designated by backupPath'''
+    directory designated by backupPath. Backups may be stored on disk
+    images, which are mounted, or in plain backup directories, which are
+    read in place. Up to self.jobs sources are read at a time'''
   
     ## Make sure we have a good backup directory
     if backupPath and not self.setBackupPath(backupPath):
       self.logger("Could not load, failed to set backup directory:"
         + "'%s'" % backupPath,"error")
       return False
-    elif not backupPath and self.backupPath:
+    elif backupPath:
+      backupPath = self.backupPath
+    elif self.backupPath:
       backupPath = self.backupPath
     else:
       self.logger("Could not load, no backup directory specified!","error")
       return False
     
-    ## Scan the directory, get a list of .sparseimage files
+    ## Scan the directory for disk images and backup directories
     ## todo: need to flush this out to support .dmg files
-    ## todo: need to flush this out to support directory-based backups as well
-    
-    dmgList = glob.glob(os.path.join(backupPath, "*.sparseimage"))
-    
-    ## Iterate through each diskImage and analyze
+    sourceList = self.findBackupSources(backupPath)
+
+    ## Unchanged sources are served from our cache without being read
+    summaryCache = {}
+    if self.useCache:
+      summaryCache = self.readCache()
+    backupSets = {}
+    fingerprints = {}
+    pendingList = []
+    for sourcePath in sourceList:
+      fingerprints[sourcePath] = self.fingerprintForSource(sourcePath)
+      cacheEntry = summaryCache.get(sourcePath)
+      if cacheEntry and cacheEntry["fingerprint"] == repr(fingerprints[sourcePath]):
+        try:
+          backupSets[sourcePath] = self.backupSetFromCache(cacheEntry["backupSet"])
+          self.logger("Loaded backups for source:%s from cache" % sourcePath,"detailed")
+          continue
+        except Exception,err:
+          self.logger("Could not load cached backups for source: %s Error: %s" % (sourcePath,err),"warning")
+      pendingList.append(sourcePath)
+    
+    ## Read each source concurrently, backup sets are registered here,
+    ## in source order, so results don't depend on completion order
+    if self.jobs > 1 and len(pendingList) > 1:
+      self.logger("Processing %s backup sources using %s concurrent jobs" 
+                    % (len(pendingList),self.jobs),"detailed")
+    jobResults = runConcurrentJobs(self.readBackupSource,pendingList,maxJobs=self.jobs)
+    for sourcePath,(backupSet,err) in zip(pendingList,jobResults):
+      if err:
+        self.logger("Failed loading backups from source: %s Error: %s" % (sourcePath,err),"error")
+        continue
+      backupSets[sourcePath] = backupSet
+      ## Mounting may touch the image, so fingerprint it once we're done
+      fingerprints[sourcePath] = self.fingerprintForSource(sourcePath)
+
     loadCount = 0
-    for dmgFile in dmgList:
+    for sourcePath in sourceList:
+      backupSet = backupSets.get(sourcePath)
+      if backupSet and self.registerBackupSet(backupSet):
+        self.loadedSources[sourcePath] = {"fingerprint" : fingerprints[sourcePath],
+                                        "hostname" : backupSet["hostname"]}
+        loadCount += 1
     
-      self.logger("Processing backups on image:%s" % dmgFile)
-      ## Mount the disk image
+    self.logger("Successfully loaded %s backup(s), %s from cache" 
+                  % (loadCount,len(sourceList) - len(pendingList)))
 
-      theDiskImage = diskImage(path=os.path.join(backupPath,dmgFile))
-      
-      self.logger(" - mounting disk image","detailed")
-      theDiskImage.mount()
-      
-      ## load the backup set
-      self.logger(" - loading backup set","detailed")
-      try:
-        if self.loadBackupSet(backupPath=theDiskImage.mountpoint):
-          loadCount += 1
-      except Exception,err:
-        self.logger("Failed loading backups from image: %s Error: %s" % (dmgFile,err),"error")
-        raise
-      
-      ## unmount the image
-      self.logger(" - unmounting disk image","detailed")
-      theDiskImage.unmount()
-    
-    self.logger("Successfully loaded %s backup(s)" % loadCount)
+    if self.useCache:
+      self.writeCache()
     
     return loadCount > 0
-          
+
+  def isBackupImage(self,path):
+    '''Returns True if path is a backup disk image'''
+    return os.path.splitext(path)[1] in self.imageExtensions
+
+  def isBackupDirectory(self,path):
+    '''Returns True if path is a plain (unmounted) sabackup output directory'''
+    return os.path.isfile(os.path.join(path,"sa_global.plist")) \
+      and os.path.isfile(os.path.join(path,".backupHistoryDB"))
+
+  def findBackupSources(self,backupPath):
+    '''Recursively searches backupPath for backup disk images and backup 
+    directories. We do not descend into images, backup directories, hidden
+    directories or symlinks. Returns a sorted list of paths'''
+
+    if self.isBackupDirectory(backupPath):
+      return [backupPath]
+
+    sourceList = []
+    pendingDirs = [backupPath]
+    while pendingDirs:
+      dirPath = pendingDirs.pop()
+      try:
+        if scandir:
+          dirEntries = [(entry.name,entry.path,entry.is_dir(follow_symlinks=False))
+                          for entry in scandir(dirPath)]
+        else:
+          dirEntries = []
+          for entryName in os.listdir(dirPath):
+            entryPath = os.path.join(dirPath,entryName)
+            dirEntries.append((entryName,entryPath,
+                  os.path.isdir(entryPath) and not os.path.islink(entryPath)))
+      except OSError,err:
+        self.logger("Could not read directory: %s Error: %s" % (dirPath,err),"warning")
+        continue
+
+      for entryName,entryPath,isDir in dirEntries:
+        if entryName[0:1] == ".":
+          continue
+        if self.isBackupImage(entryName):
+          sourceList.append(entryPath)
+        elif not isDir:
+          continue
+        elif self.isBackupDirectory(entryPath):
+          sourceList.append(entryPath)
+        else:
+          pendingDirs.append(entryPath)
+
+    return sorted(sourceList)
+
+  def readBackupSource(self,sourcePath):
+    '''Reads the backup set at sourcePath, which may be a disk image or a 
+    backup directory. This may be called from a worker thread, see load()'''
+
+    if self.isBackupImage(sourcePath):
+      return self.readBackupImage(sourcePath)
+
+    self.logger("Processing backups in directory:%s" % sourcePath)
+    return self.readBackupSet(backupPath=sourcePath)
+
+  def fingerprintForSource(self,sourcePath):
+    '''Returns a fingerprint for the backup source at sourcePath, which
+    changes whenever the source is modified. Image files are fingerprinted
+    by size and mtime. Directories (i.e. sparse bundles or backup 
+    directories) are fingerprinted by their sa_global.plist and history DB 
+    files, which are rewritten on every backup'''
+
+    fingerprint = [os.path.abspath(sourcePath)]
+    if os.path.isdir(sourcePath):
+      statPaths = []
+      for fileName in ("sa_global.plist",".backupHistoryDB",".backupHistoryDB-wal"):
+        statPaths.append(os.path.join(sourcePath,fileName))
+    else:
+      statPaths = [sourcePath]
+    for statPath in statPaths:
+      try:
+        statInfo = os.stat(statPath)
+        fingerprint.append((statInfo.st_size,statInfo.st_mtime))
+      except OSError:
+        fingerprint.append(None)
+    return tuple(fingerprint)
+
+  def getCachePath(self):
+    '''Returns the path to our summary cache file'''
+    if self.cachePath:
+      return self.cachePath
+    return os.path.join(self.backupPath,".summaryCache")
+
+  def readCache(self):
+    '''Reads our summary cache from disk. Returns a dictionary, keyed by 
+    source path, of cached backup sets and the repr() of their fingerprints.
+    Entries which are not well formed are ignored'''
+
+    cachePath = self.getCachePath()
+    if not os.path.isfile(cachePath):
+      return {}
+    try:
+      cacheData = plistlib.readPlist(cachePath)
+    except Exception,err:
+      self.logger("Could not read summary cache at: %s Error: %s" % (cachePath,err),"warning")
+      return {}
+
+    if not isinstance(cacheData,dict) or not cacheData.get("version") == self.cacheVersion \
+        or not isinstance(cacheData.get("sources"),dict):
+      self.logger("Ignoring summary cache at: %s, unknown format" % cachePath,"warning")
+      return {}
+
+    sources = {}
+    for sourcePath,cacheEntry in cacheData["sources"].iteritems():
+      try:
+        backupSet = cacheEntry["backupSet"]
+        isValid = isinstance(cacheEntry["fingerprint"],basestring) \
+                    and isinstance(backupSet["hostname"],basestring) \
+                    and isinstance(backupSet["info"],dict) \
+                    and isinstance(backupSet["serveradmin"],dict) \
+                    and isinstance(backupSet["backedUpServices"],list) \
+                    and isinstance(backupSet["runningServices"],list) \
+                    and isinstance(backupSet["services"],dict) \
+                    and isinstance(backupSet["keyPathValues"],dict)
+      except (KeyError,TypeError):
+        isValid = False
+      if not isValid:
+        self.logger("Ignoring malformed summary cache entry for source: %s" % sourcePath,"warning")
+        continue
+      sources[sourcePath] = cacheEntry
+    return sources
+
+  def writeCache(self):
+    '''Writes the backup sets for all loaded sources, including any values
+    stored by their controllers' valueForKeyPath(), to our summary cache. 
+    The cache is a plist, sources whose data cannot be represented in a 
+    plist are not cached'''
+
+    sources = {}
+    for sourcePath,sourceInfo in self.loadedSources.iteritems():
+      hostname = sourceInfo["hostname"]
+      if not hostname in self.clientData:
+        continue
+      cacheEntry = {"fingerprint" : repr(sourceInfo["fingerprint"]),
+                    "backupSet" : self.backupSetForCache(self.clientData[hostname])}
+      try:
+        plistlib.writePlistToString(cacheEntry)
+      except Exception,err:
+        self.logger("Not caching source: %s Error: %s" % (sourcePath,err),"detailed")
+        continue
+      sources[sourcePath] = cacheEntry
+
+    cachePath = self.getCachePath()
+    try:
+      cacheFD,tempPath = tempfile.mkstemp(prefix=".summaryCache.",
+                                            dir=os.path.dirname(cachePath))
+      cacheFH = os.fdopen(cacheFD,"w")
+      try:
+        plistlib.writePlist({"version" : self.cacheVersion, "sources" : sources},cacheFH)
+      finally:
+        cacheFH.close()
+      os.rename(tempPath,cachePath)
+    except Exception,err:
+      self.logger("Could not write summary cache at: %s Error: %s" % (cachePath,err),"warning")
+      return False
+    return True
+
+  def backupSetForCache(self,clientDict):
+    '''Returns a copy of clientDict made of plain data, suitable for our
+    summary cache. See backupSetFromCache()'''
+
+    clientController = clientDict["controller"]
+    services = {}
+    for serviceName in clientController.services:
+      theService = clientController.registeredServices[serviceName]
+      if theService.isLoaded:
+        services[serviceName] = {"plist" : theService.plist,
+                                  "loadedServices" : theService.loadedServices}
+    ## Missing values can't be stored in a plist, they are simply looked up
+    ## again when needed
+    keyPathValues = {}
+    for keyPath,value in clientController.keyPathValues.iteritems():
+      if not value is None:
+        keyPathValues[keyPath] = value
+    return {"hostname" : clientController.info.get("hostname"),
+            "info" : clientController.info,
+            "serveradmin" : clientDict["serveradmin"],
+            "backedUpServices" : clientDict["backedUpServices"],
+            "runningServices" : clientDict["runningServices"],
+            "services" : services,
+            "keyPathValues" : keyPathValues}
+
+  def backupSetFromCache(self,cachedSet):
+    '''Rebuilds a backup set, as returned by readBackupSet(), from data
+    stored by backupSetForCache()'''
+
+    clientController = self.clientControllerForPath("")
+    clientController.info = cachedSet["info"]
+    clientController.backedUpServices = cachedSet["backedUpServices"]
+    clientController.runningServices = cachedSet["runningServices"]
+    clientController.runningServicesLoaded = True
+    clientController.setServices(cachedSet["runningServices"])
+    for serviceName,serviceData in cachedSet["services"].iteritems():
+      if not serviceName in clientController.registeredServices:
+        continue
+      theService = clientController.registeredServices[serviceName]
+      theService.plist = serviceData["plist"]
+      theService.plistDidChange()
+      theService.loadedServices = serviceData["loadedServices"]
+      theService.isLoaded = True
+    clientController.keyPathValues = cachedSet["keyPathValues"]
+    clientController.keyPathValuesGeneration = clientController.plistGeneration
+
+    clientDict = {}
+    clientDict["serveradmin"] = cachedSet["serveradmin"]
+    clientDict["backedUpServices"] = cachedSet["backedUpServices"]
+    clientDict["runningServices"] = cachedSet["runningServices"]
+    clientDict["controller"] = clientController
+
+    return {"hostname" : cachedSet["hostname"],
+            "runningServices" : cachedSet["runningServices"],
+            "clientDict" : clientDict}
+
+  def clientControllerForPath(self,backupPath):
+    '''Returns a new backupController for the backup at backupPath, with 
+    our registered services registered'''
+
+    clientController = backupController(backupPath=backupPath)
+    clientController.memoizeKeyPaths = True
+    clientController.sqlReadOnly = True
+    try:
+      for key,value in self.registeredServices.iteritems():
+        ##self.logger("Registering clientController with service: %s with class: %s" % (key,value.__class__.__name__),"debug")
+        clientController.registerService(key,value.__class__)
+    except Exception,err:
+      self.logger("Fatal error registering services with clientController! Error:%s" % (err),"error")
+    return clientController
+
+  def readBackupImage(self,dmgFile):
+    '''Mounts the disk image at dmgFile, reads the backup set it contains
+    and unmounts it. The image is always unmounted, even if reading fails. 
+    Returns the backup set, see readBackupSet(). This may be called from a
+    worker thread, see load()'''
+
+    self.logger("Processing backups on image:%s" % dmgFile)
+    theDiskImage = diskImage(path=dmgFile)
+    theDiskImage.hdiutil = self.hdiutilPath
+
+    self.logger(" - mounting disk image: %s" % dmgFile,"detailed")
+    if not theDiskImage.mount():
+      raise RuntimeError("Could not mount disk image: %s" % theDiskImage.lastError)
+
+    try:
+      self.logger(" - loading backup set: %s" % dmgFile,"detailed")
+      backupSet = self.readBackupSet(backupPath=theDiskImage.mountpoint)
+    finally:
+      self.logger(" - unmounting disk image: %s" % dmgFile,"detailed")
+      if not theDiskImage.unmount():
+        self.logger("Could not unmount disk image: %s Error: %s" 
+                      % (dmgFile,theDiskImage.lastError),"error")
+
+    return backupSet
+
   def loadBackupSet(self,backupPath):
     '''Reads in a single backup instance and loads appropriate member vars'''
+
+    backupSet = self.readBackupSet(backupPath)
+    if not backupSet:
+      return False
+    return self.registerBackupSet(backupSet)
+          
+  def readBackupSet(self,backupPath):
+    '''Reads in a single backup instance. Returns a dictionary containing
+    the backup's hostname, runningServices and clientDict, for use with
+    registerBackupSet(). This does not modify our member vars, so it may
+    be called from a worker thread'''
     
     ## Normalize the path
     backupPath = os.path.abspath(os.path.abspath(os.path.expanduser(backupPath)))
@@ -2286,19 +4986,16 @@ class backupSummary(backupController):
     ## Read in the backupHistoryDB
     try:
       ## Get running services list
-      clientController = backupController(backupPath=backupPath)
-      try:
-        for key,value in self.registeredServices.iteritems():
-          ##self.logger("Registering clientController with service: %s with class: %s" % (key,value.__class__.__name__),"debug")
-          clientController.registerService(key,value.__class__)
-      except Exception,err:
-        self.logger("Fatal error registering services with clientController! Error:%s" % (err),"error")
+      clientController = self.clientControllerForPath(backupPath)
 
       sqlConn = clientController.connectToSQL()
       myCursor = sqlConn.cursor()
       
-      ## Search for an existing record with the exact filename, if we fail, search for a subset
-      myCursor.execute("SELECT * FROM backupHistory WHERE backupStatus = 1 ORDER BY backupTimeStamp DESC LIMIT 1")
+      ## Find our most recent successful backup. The history is not migrated,
+      ## so older databases may store backupStatus as text
+      myCursor.execute("SELECT backupStatus,backupTimeStamp,backedUpServices,runningServices"
+                        " FROM backupHistory WHERE backupStatus IN (1,'1','True')"
+                        " ORDER BY backupTimeStamp DESC LIMIT 1")
       myRow = myCursor.fetchone()
       myCursor.close()
       
@@ -2310,8 +5007,10 @@ class backupSummary(backupController):
       
       clientController.backedUpServices = backedUpServices
       clientController.runningServices = runningServices
+      clientController.runningServicesLoaded = True
 
     except Exception,err:
+      clientController.closeSQL()
       raise RuntimeError("Could not load data from backupHistoryDB: %s" % err,"error")
 
     ## read in generic information from sa_global.plist
@@ -2324,15 +5023,33 @@ class backupSummary(backupController):
       clientController.info = saBackupPlist
       clientDict["serveradmin"] = saGlobalPlist   
     except Exception,err:
+      clientController.closeSQL()
       raise RuntimeError("Error reading basic sabackup info from sa_global.plist: %s" % err)
   
     clientController.setServices(runningServices)
-    clientController.loadFromBackup(backupPath)
+    try:
+      clientController.loadFromBackup(backupPath)
+    finally:
+      ## Our history DB must be closed before the image is unmounted
+      clientController.closeSQL()
     
     clientDict["backedUpServices"] = backedUpServices
     clientDict["runningServices"] = runningServices
     clientDict["controller"] = clientController
   
+    return {"hostname" : hostname,
+            "runningServices" : runningServices,
+            "clientDict" : clientDict}
+
+  def registerBackupSet(self,backupSet):
+    '''Registers a backup set read by readBackupSet() in our clientData
+    and serviceData'''
+
+    hostname = backupSet["hostname"]
+    runningServices = backupSet["runningServices"]
+    clientDict = backupSet["clientDict"]
+    clientController = clientDict["controller"]
+
     for serviceName in runningServices:
       if not serviceName in self.serviceData:
         self.serviceData[serviceName] = {}
@@ -2346,61 +5063,92 @@ class backupSummary(backupController):
     return True
     
   def valuesForKeysForIdentifier(self,keys,identifier):
-    """Returns a dictionary of requested keys, wrapped in an array"""
+    """Returns a list of dictionaries, one per row selected by identifier,
+    containing the values for each of keys. See columnsForKeysForIdentifier()"""
     
-    ## Determine our identifier. First check to see if it matches a registered
+    if type(keys) == type(""):
+      keys = [keys]
+
+    rowNames,columns = self.columnsForKeysForIdentifier(keys,identifier)
+
     data = []
-    
+    for rowIndex in range(len(rowNames)):
+      rowData = {}
+      for key in keys:
+        rowData[key] = columns[key][rowIndex]
+      data.append(rowData)
+    return data
+
+  def columnsForKeysForIdentifier(self,keys,identifier):
+    """Returns values for each of keys, for each row selected by identifier,
+    as columns. identifier may be "servers" (one row per server, by 
+    hostname), "xsanVolumes" (one row per Xsan volume, merged across all 
+    clients) or a hostname. Each row's keys are resolved in a single 
+    pass. Returns a tuple (rowNames,columns), where columns is a dictionary,
+    keyed by key, of value lists ordered as rowNames"""
+
     if type(keys) == type(""):
       keys = [keys]
+
+    rowNames = []
+    rowValues = []
     
     if identifier == "servers":
-      target = "servers"
-      for clientName,clientDict in self.clientData.iteritems():
-        controller = clientDict["controller"]
+      for clientName in sorted(self.clientData.keys()):
+        controller = self.clientData[clientName]["controller"]
         if controller.valueForKeyPath("isServer"):
-          clientData = {}
-          for key in keys:
-            clientData[key] = controller.valueForKeyPath(key)
-          data.append(clientData)
-      return data
+          rowNames.append(clientName)
+          rowValues.append(controller.valuesForKeyPaths(keys))
   
-    if identifier == "xsanVolumes":
+    elif identifier == "xsanVolumes":
       xsanService = self.registeredServices['xsan']
-      if not "Volumes" in xsanService.plist:
-        xsanService.plist["Volumes"] = {}
-      xsanVolumes = xsanService.plist["Volumes"]
-      
-      ## Build our Xsan volume data
-      for clientName,clientController in self.serviceData['xsan'].iteritems():
-        for volumeName,volumeDict in clientController.valueForKeyPath("xsan.Volumes").iteritems():
-          
-          if volumeName in xsanVolumes:
-            xsanVolumes[volumeName] = xsanService.mergeTrees(xsanVolumes[volumeName],volumeDict)
-          else:
-            xsanVolumes[volumeName] = volumeDict;
-          
-      ## Iterate through our volumes and output the appropriate keys
-      data = []
-      for volumeName,volumeDict in xsanVolumes.iteritems():
-        clientData = {}
-        for key in keys:
-          keyPath = "Volumes.%s.%s" %(volumeName,key)
-          self.logger("valuesForKeysForIdentifier() querying "
-                 "key:'%s'" % (keyPath))
-          clientData[key] = xsanService.valueForKeyPath(keyPath)
-        data.append(clientData)
-      return data
+      xsanVolumes = self.mergedXsanVolumes()
+      for volumeName in sorted(xsanVolumes.keys()):
+        self.logger("columnsForKeysForIdentifier() querying keys for "
+               "volume:'%s'" % (volumeName),"debug")
+        rowNames.append(volumeName)
+        rowValues.append(xsanService.valuesForKeyPaths(
+                          ["Volumes.%s.%s" % (volumeName,key) for key in keys]))
 
     ## Check for a client specific identifier
-    for registeredHostname in self.clientData.keys():
-      if identifier == registeredHostname:
-        controller = self.clientData[registeredHostname]["controller"]
-        clientData = {}
-        for key in keys:
-          clientData[key] = controller.valueForKeyPath(key)
-        data.append(clientData)
-      return data
+    elif identifier in self.clientData:
+      controller = self.clientData[identifier]["controller"]
+      rowNames.append(identifier)
+      rowValues.append(controller.valuesForKeyPaths(keys))
+
+    columns = {}
+    for keyIndex,key in enumerate(keys):
+      columns[key] = [values[keyIndex] for values in rowValues]
+    return rowNames,columns
+
+  def mergedXsanVolumes(self):
+    """Returns Xsan volume data merged across all of our Xsan clients. The 
+    merged view is stored at our xsan service's plist["Volumes"], and is 
+    only rebuilt when a client's data changes"""
+
+    xsanService = self.registeredServices['xsan']
+    xsanClients = self.serviceData.get('xsan',{})
+
+    signature = []
+    for clientName in sorted(xsanClients.keys()):
+      signature.append((clientName,xsanClients[clientName].plistGeneration))
+    if signature == self.xsanVolumesSignature and "Volumes" in xsanService.plist:
+      return xsanService.plist["Volumes"]
+
+    ## Merge copies, so that client data is never modified
+    xsanVolumes = {}
+    for clientName,generation in signature:
+      clientController = xsanClients[clientName]
+      for volumeName,volumeDict in clientController.valueForKeyPath("xsan.Volumes").iteritems():
+        if volumeName in xsanVolumes:
+          xsanVolumes[volumeName] = xsanService.mergeTrees(xsanVolumes[volumeName],copy.deepcopy(volumeDict))
+        else:
+          xsanVolumes[volumeName] = copy.deepcopy(volumeDict)
+
+    xsanService.plist["Volumes"] = xsanVolumes
+    xsanService.plistDidChange()
+    self.xsanVolumesSignature = signature
+    return xsanVolumes
 
 
   def buildDictFromPagesTableHeader(self,tableHeaders):
@@ -2423,7 +5171,13 @@ class backupSummary(backupController):
     """Loader method which outputs a pages file based upon the defined 
     template"""
     
-    return self.outputPagesFile_APS(filePath=filePath,templateFilePath=templateFilePath)
+    result = self.outputPagesFile_APS(filePath=filePath,templateFilePath=templateFilePath)
+
+    ## Store the values our report looked up for future runs
+    if self.useCache and self.loadedSources:
+      self.writeCache()
+
+    return result
     
       
   def outputPagesFile_APS(self,filePath,templateFilePath=""):
@@ -3068,6 +5822,9 @@ class odService:
   odPath = ""		## Path to the OD Archive
   odPassword = ""	## Password for OD Archive sparseimage
   serveradmin = "/usr/sbin/serveradmin"    
+  statusTimeout = 30       ## Seconds before 'serveradmin status' is abandoned
+  archiveTimeout = 3600    ## Seconds before an archive is abandoned
+  archiveResult = None     ## True or False once a queued archive completes
  
   lastMSG = ""
   lastError = ""
@@ -3075,6 +5832,7 @@ class odService:
 
   def __init__(self, odPath, odPassword):
     print "Running OD Service init"
+    self.archiveResult = None
     if odPath:
       self.odPath = odPath
     if odPassword:
@@ -3096,8 +5854,9 @@ class odService:
         print "%s:%s:%s" % (self.name,log["logLevel"], log["logMSG"])
 
 
-  def createArchive(self,odPath,odPassword):
-    """
+  def archiveCommand(self,odPath,odPassword):
+    """Returns (argList,stdinData) for the serveradmin command which creates
+    an archive in odPath
     Here's what needs to get passed to serveradmin
     /usr/sbin/serveradmin command
     dirserv:backupArchiveParams:archivePassword = $archive_password
@@ -3110,34 +5869,78 @@ class odService:
                   Timestamp.year,
                   Timestamp.month,
                   Timestamp.day)
+    return ([self.serveradmin,"command"],
+      "dirserv:backupArchiveParams:archivePassword = %s\ndirserv:backupArchiveParams:archivePath = %s\ndirserv:command = backupArchive" % (odPassword,fileName))
+
+  def archiveFinished(self,archiveCommand):
+    """Logs the outcome of the archive commandResult archiveCommand, 
+    returns True if the archive was created"""
+    if archiveCommand.timedOut:
+      self.logger("Failed to create OD Archive: timed out after %ss" % self.archiveTimeout)
+      return False
+    elif not archiveCommand.returncode == 0:
+      self.logger("Failed to create OD Archive: Error:%s" % (archiveCommand.stderr))
+      return False
+    else:
+      self.logger("Successfully created OD Archive: %s" % (archiveCommand.stdout))
+      return True
+
+  def createArchive(self,odPath,odPassword):
+    """Creates an OD archive in odPath if OD is running"""
     
     ## Make sure that OD is a running service
-    odStatus = subprocess.Popen('serveradmin -x status dirserv', shell=True, stdout=subprocess.PIPE, universal_newlines=True)
-    odStatus_STDOUT, odStatus_STDERR = odStatus.communicate()
-    if len(odStatus_STDOUT) == 0:
+    odStatus = runCommand([self.serveradmin,"-x","status","dirserv"],timeout=self.statusTimeout)
+    if len(odStatus.stdout) == 0:
       self.logger("serveradmin: could not determine status for Open Directory!")
       return 2
     else:
       ## Create a plist object from our output.
       try:
-        plistObj = plistlib.readPlistFromString(odStatus_STDOUT)
+        plistObj = plistlib.readPlistFromString(odStatus.stdout)
         if "state" in plistObj:
           if plistObj["state"] == "RUNNING":
       ## If it's running, create the archive
-            archiveCommand = subprocess.Popen('serveradmin command', shell=True, stdin=subprocess.PIPE)
-            archiveCommand.communicate("dirserv:backupArchiveParams:archivePassword = %s\ndirserv:backupArchiveParams:archivePath = %s\ndirserv:command = backupArchive" % (odPassword,fileName))
-            archiveCommand_STDOUT, archiveCommand_STDERR = archiveCommand.communicate()
-
-            if not archiveCommand.returncode == 0:
-              self.logger("Failed to create OD Archive: Error:%s" % (archiveCommand_STDERR))
-              return False
-            else:
-              self.logger("Successfully created OD Archive: %s" % (archiveCommand_STDOUT))
-              return True
+            argList,stdinData = self.archiveCommand(odPath,odPassword)
+            archiveCommand = runCommand(argList,timeout=self.archiveTimeout,stdinData=stdinData)
+            return self.archiveFinished(archiveCommand)
           else:
             print "OD archive was specified, but OD services are not running"
       except:
         self.logger("serveradmin: could not read status XML for Open Directory")
+
+  def queueArchive(self,engine):
+    """Queues creation of an archive in self.odPath on the collectionEngine
+    engine: OD's status is checked and, if it is running, the archive is 
+    created. self.archiveResult is set to True or False once complete"""
+
+    self.archiveResult = None
+    engine.addCommand([self.serveradmin,"-x","status","dirserv"],
+            callback=lambda result: self._archiveStatusChecked(engine,result),
+            timeout=self.statusTimeout)
+
+  def _archiveStatusChecked(self,engine,result):
+    """collectionEngine callback for the status check of queueArchive()"""
+    self.archiveResult = False
+    if len(result.stdout) == 0:
+      self.logger("serveradmin: could not determine status for Open Directory!")
+      return
+    try:
+      plistObj = plistlib.readPlistFromString(result.stdout)
+    except:
+      self.logger("serveradmin: could not read status XML for Open Directory")
+      return
+    if not plistObj.get("state") == "RUNNING":
+      print "OD archive was specified, but OD services are not running"
+      return
+
+    self.archiveResult = None
+    argList,stdinData = self.archiveCommand(self.odPath,self.odPassword)
+    engine.addCommand(argList,callback=self._archiveCreated,
+                        timeout=self.archiveTimeout,stdinData=stdinData)
+
+  def _archiveCreated(self,result):
+    """collectionEngine callback for the archive command of queueArchive()"""
+    self.archiveResult = self.archiveFinished(result)
     
 
 class diskImage:
@@ -3149,16 +5952,23 @@ class diskImage:
   volname = ""
   mountpoint = ""
   hdiutil = ""
+  hdiutilPath = "/usr/bin/hdiutil"  ## Default hdiutil, override for testing
+  commandTimeout = 600   ## Seconds before an hdiutil command is abandoned
       
   lastMSG = ""
   lastError = ""
   log = []
+  debug = False
   
   def __init__(self, path = ""):
+    self.log = []
+    self.lastMSG = ""
+    self.lastError = ""
+    self.mountpoint = ""
     if path:
       self.path = path
     ## make sure we have hdiutil
-    hdiutil = "/usr/bin/hdiutil"
+    hdiutil = self.hdiutilPath
     if os.path.isfile(hdiutil):
       self.hdiutil = hdiutil
     else:
@@ -3188,10 +5998,9 @@ class diskImage:
     """ Mounts specified disk image """
     if not path and self.path:
       path = self.path
-    if path and os.path.isfile(path):
-      hdiutilCMD = ""
-    else:
-      self.logger("Could not mount disk image at path:'%s', file not found!","error")
+    if not path or not os.path.exists(path):
+      self.logger("Could not mount disk image at path:'%s', file not found!" % path,"error")
+      return False
     
     ## make sure we have hdiutil
     hdiutil = self.hdiutil
@@ -3200,13 +6009,13 @@ class diskImage:
       return False
     
     ## print "Running Command: '%s' attach '%s' -puppetstrings" % (hdiutil,path)
-    hdiutilCMD = subprocess.Popen("'%s' attach '%s' -puppetstrings -plist" % (hdiutil,path),shell=True,stdout=subprocess.PIPE,universal_newlines=True)
-    hdiutilCMD_STDOUT, hdiutilCMD_STDERR = hdiutilCMD.communicate()
+    hdiutilCMD = runCommand([hdiutil,"attach",path,"-puppetstrings","-plist"],
+                              timeout=self.commandTimeout)
     
     if hdiutilCMD.returncode == 0:
       ## Here if hdiutil attach succeeded, attempt to read mountpoint from xml
       try: 
-        plistObj = plistlib.readPlistFromString(hdiutilCMD_STDOUT)
+        plistObj = plistlib.readPlistFromString(hdiutilCMD.stdout)
         sysEntities = plistObj["system-entities"]
         for entity in sysEntities:
           if "mount-point" in entity:
@@ -3225,7 +6034,7 @@ class diskImage:
       return True
 
     else:
-      self.logger("Failed to mount disk image:'%s' hdiutil exitcode:%s Error:%s" % (path,hdiutilCMD.returncode,hdiutilCMD_STDERR),"error")
+      self.logger("Failed to mount disk image:'%s' hdiutil exitcode:%s Error:%s" % (path,hdiutilCMD.returncode,hdiutilCMD.stderr),"error")
       return False
           
   def unmount(self, mountpoint = ""):
@@ -3244,11 +6053,10 @@ class diskImage:
     
     
     ## print "Running Command: '%s' create -type '%s'  -size '%s' -fs '%s' -volname '%s' '%s' -puppetstrings" % (hdiutil,type,size,fs,volname,path)
-    hdiutilCMD = subprocess.Popen("'%s' detach '%s'" % (hdiutil,mountpoint),shell=True,stdout=subprocess.PIPE,universal_newlines=True)
-    hdiutilCMD_STDOUT, hdiutilCMD_STDERR = hdiutilCMD.communicate()
+    hdiutilCMD = runCommand([hdiutil,"detach",mountpoint],timeout=self.commandTimeout)
     
     if not hdiutilCMD.returncode == 0:
-      self.logger("Failed to unmount disk image:'%s' hdiutil exitcode:%s Error:%s" % (mountpoint,hdiutilCMD.returncode,hdiutilCMD_STDERR),"error")
+      self.logger("Failed to unmount disk image:'%s' hdiutil exitcode:%s Error:%s" % (mountpoint,hdiutilCMD.returncode,hdiutilCMD.stderr),"error")
       return False
     else:
       self.logger("Unmounted Disk Image at path:'%s'" % mountpoint)
@@ -3295,26 +6103,316 @@ class diskImage:
       return False
     
     ## print "Running Command: '%s' create -type '%s'  -size '%s' -fs '%s' -volname '%s' '%s' -puppetstrings" % (hdiutil,type,size,fs,volname,path)
-    hdiutilCMD = subprocess.Popen("'%s' create -type '%s'  -size '%s' -fs '%s' -volname '%s' '%s' -puppetstrings" % (hdiutil,type,size,fs,volname,path),shell=True,stdout=subprocess.PIPE,universal_newlines=True)
-    hdiutilCMD_STDOUT, hdiutilCMD_STDERR = hdiutilCMD.communicate()
-    
-    
+    hdiutilCMD = runCommand([hdiutil,"create","-type",type,"-size",size,"-fs",fs,
+                              "-volname",volname,path,"-puppetstrings"],
+                              timeout=self.commandTimeout)
     
     if not hdiutilCMD.returncode == 0:
-      self.logger("Failed to create disk image:'%s' hdiutil exitcode:%s Error:%s" % (path,hdiutilCMD.returncode,hdiutilCMD_STDERR),"error")
+      self.logger("Failed to create disk image:'%s' hdiutil exitcode:%s Error:%s" % (path,hdiutilCMD.returncode,hdiutilCMD.stderr),"error")
       return False
     else:
       self.logger("Created Disk Image at path:'%s'" % path)
       return True
 
 
+class blobStore:
+  """Our content-addressed object store. Blobs are stored once, keyed by the
+  SHA-1 of their content, at objects/<ab>/<hash>. Each backup run writes a 
+  manifest to manifests/<hostname>/<timeStamp>.plist which maps service 
+  file paths to blob hashes. A store may be shared between snapshots and
+  between hosts, unreferenced blobs are removed by collectGarbage(). Runs
+  writing to the store hold a shared lock on the store's lock file until 
+  their manifest is written, garbage collection requires an exclusive lock"""
+  path = ""          ## Full path to the root of the store
+  hostname = ""      ## Hostname used to namespace our manifests
+  lockHandle = None  ## Open handle to our lock file while we hold a lock
+
+  lastMSG = ""
+  lastError = ""
+  log = []
+  debug = False
+
+  def __init__(self, path = "", hostname = ""):
+    self.log = []
+    self.lockHandle = None
+    if path:
+      self.path = os.path.abspath(os.path.expanduser(path))
+    if not hostname:
+      hostname = platform.uname()[1]
+    self.hostname = hostname
+
+  def logger(self, logMSG, logLevel="normal"):
+    """(very) Basic Logging Function, we'll probably migrate to msg module"""
+    if logLevel == "error" or logLevel == "normal" or self.debug:
+      self.lastMSG = logMSG
+    if logLevel == "error":
+      self.lastError = logMSG
+    self.log.append({"logLevel" : logLevel, "logMSG" : logMSG})
+
+  def objectsPath(self):
+    return os.path.join(self.path,"objects")
+
+  def manifestsPath(self,hostname=""):
+    if not hostname:
+      hostname = self.hostname
+    return os.path.join(self.path,"manifests",hostname)
+
+  def create(self):
+    """Creates our directory structure if it does not yet exist"""
+    for dirPath in (self.objectsPath(),self.manifestsPath()):
+      if not os.path.isdir(dirPath):
+        try:
+          os.makedirs(dirPath)
+        except OSError:
+          if not os.path.isdir(dirPath):
+            self.logger("Could not create store directory: %s" % dirPath,"error")
+            return False
+    return True
+
+  def lock(self,exclusive=False,blocking=True):
+    """Acquires a shared (or exclusive) lock on our store. Returns False if
+    blocking is False and the lock is held elsewhere"""
+    if self.lockHandle:
+      self.unlock()
+    lockHandle = open(os.path.join(self.path,"lock"),"a")
+    lockFlags = fcntl.LOCK_SH
+    if exclusive:
+      lockFlags = fcntl.LOCK_EX
+    if not blocking:
+      lockFlags |= fcntl.LOCK_NB
+    try:
+      fcntl.flock(lockHandle.fileno(),lockFlags)
+    except IOError,err:
+      lockHandle.close()
+      if err.errno in (errno.EAGAIN,errno.EACCES,errno.EWOULDBLOCK):
+        return False
+      raise
+    self.lockHandle = lockHandle
+    return True
+
+  def unlock(self):
+    """Releases any lock we hold on our store"""
+    if not self.lockHandle:
+      return
+    try:
+      fcntl.flock(self.lockHandle.fileno(),fcntl.LOCK_UN)
+    finally:
+      self.lockHandle.close()
+      self.lockHandle = None
+
+  def pathForHash(self,blobHash):
+    """Returns the path at which the blob with blobHash is stored"""
+    return os.path.join(self.objectsPath(),blobHash[0:2],blobHash)
+
+  def hasBlob(self,blobHash):
+    return os.path.isfile(self.pathForHash(blobHash))
+
+  def _storeFromFile(self,blobHash,tempPath):
+    """Moves a completed temp file into place for blobHash"""
+    blobPath = self.pathForHash(blobHash)
+    if os.path.exists(blobPath):
+      os.remove(tempPath)
+      return blobHash
+    blobDir = os.path.dirname(blobPath)
+    if not os.path.isdir(blobDir):
+      try:
+        os.mkdir(blobDir)
+      except OSError:
+        if not os.path.isdir(blobDir):
+          raise
+    os.rename(tempPath,blobPath)
+    return blobHash
+
+  def putData(self,data):
+    """Stores data, returns its hash. Existing blobs are not rewritten"""
+    blobHash = hashlib.sha1(data).hexdigest()
+    if self.hasBlob(blobHash):
+      return blobHash
+    fileDescriptor,tempPath = tempfile.mkstemp(prefix=".tmp_",dir=self.objectsPath())
+    fileHandle = os.fdopen(fileDescriptor,"wb")
+    try:
+      fileHandle.write(data)
+    finally:
+      fileHandle.close()
+    return self._storeFromFile(blobHash,tempPath)
+
+  def putFile(self,filePath):
+    """Stores the contents of the file at filePath, returns its hash"""
+    fileDescriptor,tempPath = tempfile.mkstemp(prefix=".tmp_",dir=self.objectsPath())
+    tempHandle = os.fdopen(fileDescriptor,"wb")
+    sha1 = hashlib.sha1()
+    try:
+      fileHandle = open(filePath,"rb")
+      try:
+        while True:
+          data = fileHandle.read(65536)
+          if not data:
+            break
+          sha1.update(data)
+          tempHandle.write(data)
+      finally:
+        fileHandle.close()
+    finally:
+      tempHandle.close()
+    return self._storeFromFile(sha1.hexdigest(),tempPath)
+
+  def getData(self,blobHash):
+    """Returns the data stored for blobHash"""
+    fileHandle = open(self.pathForHash(blobHash),"rb")
+    try:
+      return fileHandle.read()
+    finally:
+      fileHandle.close()
+
+  def writeManifest(self,name,manifest):
+    """Writes manifest (a dict) as our manifest with the provided name"""
+    manifestPath = os.path.join(self.manifestsPath(),"%s.plist" % name)
+    tempPath = "%s.tmp" % manifestPath
+    plistlib.writePlist(manifest,tempPath)
+    os.rename(tempPath,manifestPath)
+    self.logger("Wrote manifest: %s" % manifestPath,"detailed")
+    return manifestPath
+
+  def readManifest(self,name,hostname=""):
+    """Returns the manifest dict with the provided name"""
+    return plistlib.readPlist(os.path.join(self.manifestsPath(hostname),"%s.plist" % name))
+
+  def manifestNames(self,hostname=""):
+    """Returns a sorted list of manifest names (timestamps) for hostname"""
+    names = []
+    manifestsPath = self.manifestsPath(hostname)
+    if not os.path.isdir(manifestsPath):
+      return names
+    for fileName in os.listdir(manifestsPath):
+      if fileName.endswith(".plist"):
+        names.append(fileName[:-len(".plist")])
+    names.sort()
+    return names
+
+  def hashesForManifest(self,manifest):
+    """Returns a list of all blob hashes referenced by manifest"""
+    hashes = []
+    for serviceName,fileDict in manifest.get("services",{}).iteritems():
+      hashes.extend(fileDict.values())
+    if "sa_global.plist" in manifest:
+      hashes.append(manifest["sa_global.plist"])
+    return hashes
+
+  def pruneManifests(self,maxAge=30,minCopies=1,maxCopies=0):
+    """Removes our host's manifests older than maxAge days, always retaining
+    minCopies and at most maxCopies (0 for unlimited) manifests. Blobs are 
+    not touched, see collectGarbage(). Returns the number removed"""
+
+    maxAge = int(maxAge)
+    minCopies = int(minCopies)
+    maxCopies = int(maxCopies)
+
+    names = self.manifestNames()
+    expiredTime = time.time() - (maxAge * 86400)
+    ## Manifest names are timestamps, so names are sorted oldest first. A
+    ## manifest never counts as older than one which precedes it.
+    manifestTimes = []
+    for name in names:
+      manifestTime = os.path.getmtime(os.path.join(self.manifestsPath(),"%s.plist" % name))
+      if manifestTimes and manifestTime < manifestTimes[-1]:
+        manifestTime = manifestTimes[-1]
+      manifestTimes.append(manifestTime)
+
+    numToRemove = pruneCountForSnapshots(manifestTimes,expiredTime,minCopies,maxCopies)
+
+    removedCount = 0
+    for name in names[:numToRemove]:
+      try:
+        os.remove(os.path.join(self.manifestsPath(),"%s.plist" % name))
+        self.logger("Pruned manifest: %s" % name,"detailed")
+        removedCount += 1
+      except Exception,err:
+        self.logger("Could not prune manifest: %s Error: %s" % (name,err),"error")
+    return removedCount
+
+  def collectGarbage(self):
+    """Mark and sweep: marks every blob referenced by any host's manifest,
+    then removes unmarked blobs (and stale temp files) from the object
+    directory. Collection is skipped while any other run holds a lock on
+    the store, as its blobs are not yet referenced by a manifest. Returns a
+    tuple of (blobs removed, bytes freed)"""
+
+    if not self.lock(exclusive=True,blocking=False):
+      self.logger("Store is in use by another backup, skipping garbage collection","normal")
+      return (0,0)
+    try:
+      return self._markAndSweep()
+    finally:
+      self.unlock()
+
+  def _markAndSweep(self):
+    """Performs garbage collection for collectGarbage()"""
+
+    ## Mark
+    markedHashes = set()
+    manifestsRoot = os.path.join(self.path,"manifests")
+    if os.path.isdir(manifestsRoot):
+      for hostname in os.listdir(manifestsRoot):
+        for name in self.manifestNames(hostname):
+          try:
+            manifest = self.readManifest(name,hostname)
+          except Exception,err:
+            ## Never sweep on partial information
+            self.logger("Could not read manifest: %s/%s, skipping garbage "
+                          "collection! Error: %s" % (hostname,name,err),"error")
+            return (0,0)
+          markedHashes.update(self.hashesForManifest(manifest))
+
+    ## Sweep
+    removedCount = 0
+    removedBytes = 0
+    objectsPath = self.objectsPath()
+    if not os.path.isdir(objectsPath):
+      return (0,0)
+    for dirName in os.listdir(objectsPath):
+      dirPath = os.path.join(objectsPath,dirName)
+      if not os.path.isdir(dirPath):
+        continue
+      for blobHash in os.listdir(dirPath):
+        if blobHash in markedHashes:
+          continue
+        blobPath = os.path.join(dirPath,blobHash)
+        try:
+          blobSize = os.path.getsize(blobPath)
+          os.remove(blobPath)
+          removedCount += 1
+          removedBytes += blobSize
+        except Exception,err:
+          self.logger("Could not remove blob: %s Error: %s" % (blobHash,err),"error")
+    for fileName in os.listdir(objectsPath):
+      if fileName.startswith(".tmp_"):
+        tempPath = os.path.join(objectsPath,fileName)
+        ## Leave temp files alone which may belong to an in-progress write
+        if os.path.getmtime(tempPath) < time.time() - 3600:
+          os.remove(tempPath)
+
+    self.logger("Garbage collection removed %s blobs (%s bytes)" % (removedCount,removedBytes),"detailed")
+    return (removedCount,removedBytes)
+
 ######################### END CLASSES ###############################
 
 
 ######################### MAIN SCRIPT START #############################
 
+def printTimings(timings):
+  """Prints the phases in timings, as returned by 
+  backupController.allTimings(), slowest first"""
+
+  print "*  Timings:"
+  phases = sorted(timings.keys(),key=lambda phase: timings[phase]["seconds"],reverse=True)
+  for phase in phases:
+    print "   %-32s %10.3fs %14s bytes" % (phase,timings[phase]["seconds"],
+                                            timings[phase]["bytes"])
+
 def main():
   
+  preflightStartTime = time.time()
+
   ## Register our services
   myController = backupController()
   myController.registerService(saService().servicesMap.keys(),saService)
@@ -3342,6 +6440,16 @@ def main():
   overWriteExistingFiles = False
   pruneBackups = False
   pruneOptions = {"maxAge" : 30, "minCopies" : 1, "maxCopies" : 0}
+  jobs = 1
+  engine = "threads"
+  deadline = 0
+  showTimings = False
+  profileDir = ""
+  layout = "directory"
+  storePath = ""
+  profilerJobs = None
+  profilerTimeout = None
+  profilerTTLs = {}
 
   ## parse our passed parameters
   try:
@@ -3349,7 +6457,8 @@ def main():
       "outputfile=","service=","services=","target=","appendField=",
       "usedmg","nodmg","nosubdirs","usetimestamps","notimestamps",
       "help","version","force","prune","maxage=","mincopies=","maxcopies=",
-      "plist=","odarchive","odpassword="])
+      "plist=","odarchive","odpassword=","jobs=","layout=","storepath=",
+      "engine=","deadline=","timings","profile="])
   except getopt.GetoptError:
     print "Syntax Error!"
     helpMessage()
@@ -3403,6 +6512,20 @@ def main():
       pruneOptions["minCopies"] = opt[1]
     elif opt[0] == "--maxcopies":
       pruneOptions["maxCopies"] = opt[1]
+    elif opt[0] == "--jobs":
+      jobs = opt[1]
+    elif opt[0] == "--layout":
+      layout = opt[1]
+    elif opt[0] == "--engine":
+      engine = opt[1]
+    elif opt[0] == "--deadline":
+      deadline = opt[1]
+    elif opt[0] == "--timings":
+      showTimings = True
+    elif opt[0] == "--profile":
+      profileDir = opt[1]
+    elif opt[0] == "--storepath":
+      storePath = opt[1]
     elif opt[0] == "--plist":
       configFilePath = opt[1]
       if not os.path.isfile(configFilePath):
@@ -3411,7 +6534,7 @@ def main():
         return False
   
       ## Convert our plist to xml (in case it's binary)
-      subprocess.call("/usr/bin/plutil -convert xml1 '%s'" % configFilePath,shell=True,universal_newlines=True)
+      runCommand(["/usr/bin/plutil","-convert","xml1",configFilePath],timeout=60)
   
       ## Create our plist parser
       myPlist = plistlib.readPlist(configFilePath)
@@ -3441,6 +6564,26 @@ def main():
         pruneOptions["minCopies"] = myPlist["mincopies"]
       if "maxcopies" in myPlist:
         pruneOptions["maxCopies"] = myPlist["maxcopies"]
+      if "jobs" in myPlist:
+        jobs = myPlist["jobs"]
+      if "layout" in myPlist:
+        layout = myPlist["layout"]
+      if "engine" in myPlist:
+        engine = myPlist["engine"]
+      if "deadline" in myPlist:
+        deadline = myPlist["deadline"]
+      if "timings" in myPlist:
+        showTimings = myPlist["timings"]
+      if "profile" in myPlist:
+        profileDir = myPlist["profile"]
+      if "storepath" in myPlist:
+        storePath = myPlist["storepath"]
+      if "profilerjobs" in myPlist:
+        profilerJobs = myPlist["profilerjobs"]
+      if "profilertimeout" in myPlist:
+        profilerTimeout = myPlist["profilertimeout"]
+      if "profilerttls" in myPlist:
+        profilerTTLs = myPlist["profilerttls"]
       break
 #    elif opt[0] == "--restore":
 #      print "--restore is unimplemented!"
@@ -3473,6 +6616,57 @@ def main():
     helpMessage()
     return 2
   
+  try:
+    jobs = int(jobs)
+    if jobs < 1:
+      raise ValueError
+  except:
+    print "Syntax Error: --jobs must be a positive integer!"
+    return 2
+
+  if not layout in ("directory","store"):
+    print "Syntax Error: --layout must be either 'directory' or 'store'!"
+    return 2
+
+  if not engine in ("threads","events"):
+    print "Syntax Error: --engine must be either 'threads' or 'events'!"
+    return 2
+
+  try:
+    deadline = float(deadline)
+    if deadline < 0:
+      raise ValueError
+  except:
+    print "Syntax Error: --deadline must be a number of seconds!"
+    return 2
+
+  try:
+    if profilerJobs is not None:
+      profilerJobs = int(profilerJobs)
+      if profilerJobs < 1:
+        raise ValueError
+  except:
+    print "Syntax Error: profilerjobs must be a positive integer!"
+    return 2
+
+  try:
+    if profilerTimeout is not None:
+      profilerTimeout = float(profilerTimeout)
+      if profilerTimeout <= 0:
+        raise ValueError
+  except:
+    print "Syntax Error: profilertimeout must be a positive number of seconds!"
+    return 2
+
+  try:
+    for dataType in profilerTTLs.keys():
+      profilerTTLs[dataType] = int(profilerTTLs[dataType])
+      if profilerTTLs[dataType] < 0:
+        raise ValueError
+  except:
+    print "Syntax Error: profilerttls must map data types to a number of seconds!"
+    return 2
+
   if pruneBackups:
     if not useSubDirs:
       print "Warning: Backup pruning requires directory based backups, it is" \
@@ -3572,13 +6766,19 @@ def main():
     
     if not os.path.exists(saDMGpath):
       print "   - No disk image found at path '%s', creating!" % saDMGpath
-      if not saDMG.createDMG(type=type,volname=volname,path=saDMGpath):
+      startTime = time.time()
+      didCreate = saDMG.createDMG(type=type,volname=volname,path=saDMGpath)
+      myController.recordTiming("diskImage.create",startTime)
+      if not didCreate:
         print "ERROR: Disk image creation failed, cannot complete backup!!"
         return 3
       else:
         print "    - Image Created!"
 
-    if not saDMG.mount():
+    startTime = time.time()
+    didMount = saDMG.mount()
+    myController.recordTiming("diskImage.mount",startTime)
+    if not didMount:
       print "ERROR: Failed to mount disk image, cannot complete backup!!" 
       return 3
     else:
@@ -3605,12 +6805,17 @@ def main():
       odDMG = odService(outputDir,odPassword)
     except:
       print "ERROR: An error occurred while creating OD Archive"
-    print "   - Running OD Archive"
-    if not odDMG.createArchive(outputDir,odPassword):
-      print "ERROR: An error occured creating OD Archive, cannot continue!"
-      return 3
+    if engine == "events":
+      ## Our archive is created alongside our other collectors
+      print "   - Queueing OD Archive"
+      myController.odArchive = odDMG
     else:
-      print "     - OD Archive created"
+      print "   - Running OD Archive"
+      if not odDMG.createArchive(outputDir,odPassword):
+        print "ERROR: An error occured creating OD Archive, cannot continue!"
+        return 3
+      else:
+        print "     - OD Archive created"
 
 
   ## Gather basic information
@@ -3662,6 +6867,7 @@ def main():
   elif "running" in serviceList:
     serviceList.extend(myController.getRunningServiceList())
   
+  myController.recordTiming("preflight",preflightStartTime)
   print "*  Preflight Finished."
   print "*  Running backups!"
 
@@ -3684,13 +6890,43 @@ def main():
   ## Pruning
   myController.setPruneOptions(pruneOptions)
   myController.pruneBackups = pruneBackups
+  myController.jobs = jobs
+  myController.engine = engine
+  myController.deadline = deadline
+  if "profile" in myController.registeredServices:
+    profileService = myController.registeredServices["profile"]
+    if profilerJobs is not None:
+      profileService.collectorJobs = profilerJobs
+    if profilerTimeout is not None:
+      profileService.collectorTimeout = profilerTimeout
+    if profilerTTLs:
+      dataTypeTTLs = dict(profileService.dataTypeTTLs)
+      dataTypeTTLs.update(profilerTTLs)
+      profileService.dataTypeTTLs = dataTypeTTLs
+  myController.layout = layout
+  myController.storePath = storePath
   
   
   myController.setServices(serviceList)
   myController.setBackupPath(backupTarget)
   
   
-  backupStatus = myController.backupSettings()
+  if profileDir:
+    backupStatus = runProfiled(profileDir,"backup",myController.backupSettings)
+  else:
+    backupStatus = myController.backupSettings()
+
+  ## Create our queued OD archive now if our collection never ran
+  odArchiveFailed = False
+  if myController.odArchive:
+    if myController.odArchive.archiveResult is None:
+      print "   - Running OD Archive"
+      myController.odArchive.archiveResult = myController.odArchive.createArchive(outputDir,odPassword)
+    if myController.odArchive.archiveResult:
+      print "     - OD Archive created"
+    else:
+      print "ERROR: An error occured creating OD Archive!"
+      odArchiveFailed = True
   
 
   print "*  serveradmin backups complete"    
@@ -3736,13 +6972,22 @@ def main():
   print "*  Cleaning up..."
 
   if useDiskImage:
-    if saDMG.unmount():
+    startTime = time.time()
+    didUnmount = saDMG.unmount()
+    myController.recordTiming("diskImage.unmount",startTime)
+    if didUnmount:
       print "   - Unmounted Disk Image at mountpoint:'%s'" % saDMG.mountpoint
     else:
       print "   - Failed to unmount volume at '%s', hdiutil Error:%s" % (saDMG.mountpoint,saDMG.lastError)
       
   print "*  Cleanup complete."
 
+  if showTimings:
+    printTimings(myController.allTimings())
+
+  if odArchiveFailed:
+    print "Backup Failed - OD Archive could not be created!"
+    return 3
   if len(myController.services) == 0:
     print "Backup Failed - No services were found to backup!"
     return 8